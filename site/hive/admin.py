@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import PersistentData, SinglePromptChat,MoxieDevice,MoxieSchedule,HiveConfiguration,MentorBehavior,GlobalResponse
+from .models import CompletionSummary, PersistentData, SinglePromptChat,MoxieDevice,MoxieSchedule,HiveConfiguration,MentorBehavior,GlobalResponse
 
 admin.site.register(SinglePromptChat)
 admin.site.register(MoxieDevice)
@@ -8,4 +8,5 @@ admin.site.register(MoxieSchedule)
 admin.site.register(HiveConfiguration)
 admin.site.register(MentorBehavior)
 admin.site.register(GlobalResponse)
-admin.site.register(PersistentData)
\ No newline at end of file
+admin.site.register(PersistentData)
+admin.site.register(CompletionSummary)
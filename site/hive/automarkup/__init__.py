@@ -1,3 +1,4 @@
+import re
 from typing import Tuple
 from typing import Dict
 
@@ -39,6 +40,62 @@ def process(input_string, rules, mood_and_intensity: Tuple[str, float] = None, s
     return result
 
 
+class StreamingMarkup:
+    """
+    Markup for text that arrives a piece at a time, like a streamed inference.  Each sentence is
+    marked up as soon as it is complete, so when the text is finished only the last sentence
+    is left to do.  finish() gives the same result as process() on the full text.
+
+    rules (dict) - rules from initialize_rules()
+    mood_and_intensity (tuple) - two-length tuple for (str, float) to specify mood and normalized intensity
+    """
+    def __init__(self, rules, mood_and_intensity: Tuple[str, float] = None):
+        self._rules = rules
+        self._mood_and_intensity = mood_and_intensity
+        self._text_replacements = markup.get_internal_text_replacements()
+        self._sentences = {}
+        self._scanned = 0
+
+    def _markup_sentence(self, sentence, markup_pauses, synth_rate, last_sentence):
+        key = (sentence, markup_pauses, synth_rate, last_sentence)
+        if key not in self._sentences:
+            self._sentences[key] = markup.markup_sentence(s=sentence,
+                                                          rules=self._rules,
+                                                          markVoice=True,
+                                                          synthRate=synth_rate,
+                                                          markBehaviors=True,
+                                                          markMoodAndIntensity=self._mood_and_intensity,
+                                                          prettyPrint=False,
+                                                          markup_pauses=markup_pauses,
+                                                          text_replacements=self._text_replacements,
+                                                          lastSentence=last_sentence,
+                                                          debug=False)
+        return self._sentences[key]
+
+    def feed(self, text: str):
+        """
+        Mark up any newly completed sentences.  text is all of the text received so far.
+        """
+        # nothing to do until a sentence ends
+        if not re.search(r'[.!?] ', text[max(self._scanned - 1, 0):]):
+            return
+        self._scanned = len(text)
+        sentences = markup.split_to_sentences(markup.prepare_text(text))
+        markup_pauses, synth_rate = markup.sentence_params(len(sentences))
+        # the last one may still be growing
+        for sentence in sentences[:-1]:
+            self._markup_sentence(sentence, markup_pauses, synth_rate, False)
+
+    def finish(self, text: str):
+        """
+        Markup for the complete text, reusing the sentences already marked up.
+        """
+        sentences = markup.split_to_sentences(markup.prepare_text(text))
+        markup_pauses, synth_rate = markup.sentence_params(len(sentences))
+        return ' '.join(self._markup_sentence(sentence, markup_pauses, synth_rate, index == len(sentences) - 1)
+                        for index, sentence in enumerate(sentences))
+
+
 def remove_quotes(input_string: str):
     return markup.remove_quotes(input_string)
 
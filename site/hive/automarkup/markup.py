@@ -496,95 +496,74 @@ def markup_sentence(s: str,
     return result
     
 
-def markup(s: str,
-           rules: dict,
-           markVoice: bool = True,
-           markVoiceSpecialMarkGenre: bool = True,
-           markBehaviors: bool = True,
-           markMoodAndIntensity: Union[Tuple[str, int], None] = None,
-           prettyPrint: bool = True,
-           markup_pauses: float = None,
-           text_replacements: Dict[str, str] = None,
-           debug: bool = False) -> str:
+def clean_apostrophe_typos(string: str) -> str:
     """
-    Main function; proceeds as follows:
-        - Look up rules per word
-        - Create spans of rules based on start/end word indices
-            - Merge spans if rules are very close in range
-        - Remove conflicting spans that do not nest well
-        - Sort
-        - Assemble XML tree
-        - Output
-
-    Args:
-        markup_pauses: pause/break time in seconds between sentences. Defaults None.
+    Spellcheck issues like "don' t"
     """
+    string = " ".join(string.split())
+    contractions = ["d", "m", "s", "t", "ve", "re", "ll"]
+    return re.sub(fr"' (?=(" + "|".join(contractions) + r")([\s,.;+=\-()\[\]!%]|$))", "'", string)
 
-
-    def clean_apostrophe_typos(string: str) -> str:
-        """
-        Spellcheck issues like "don' t"
-        """
-        string = " ".join(string.split())
-        contractions = ["d", "m", "s", "t", "ve", "re", "ll"]
-        return re.sub(fr"' (?=(" + "|".join(contractions) + r")([\s,.;+=\-()\[\]!%]|$))", "'", string)
-
-    def remove_comma_from_large_num(string: str) -> str:
-        """
-        Ensure generated num remove any commas to prevent unnecessary pauses
-        """
-        pattern = r'\b(\d+),(\d{3})'
-        replacement = r'\1\2'
+def remove_comma_from_large_num(string: str) -> str:
+    """
+    Ensure generated num remove any commas to prevent unnecessary pauses
+    """
+    pattern = r'\b(\d+),(\d{3})'
+    replacement = r'\1\2'
+    string = re.sub(pattern, replacement, string)
+    while re.search(pattern, string):
         string = re.sub(pattern, replacement, string)
-        while re.search(pattern, string):
-            string = re.sub(pattern, replacement, string)
-        return string
+    return string
 
-    def add_space_between_listed_num(string: str) -> str:
-        """
-        If Moxie generates a num list, add a space to allow Moxie to pause correctly b/w num
-        """
-        pattern = r'(\d+),(\d+)[, .]'
-        replacement = r'\1, \2, '
-        string = re.sub(pattern, replacement, string)
-        return string
+def add_space_between_listed_num(string: str) -> str:
+    """
+    If Moxie generates a num list, add a space to allow Moxie to pause correctly b/w num
+    """
+    pattern = r'(\d+),(\d+)[, .]'
+    replacement = r'\1, \2, '
+    string = re.sub(pattern, replacement, string)
+    return string
 
-    def insert_space_between_digits_and_capitals(string: str):
-        """
-        Use regular expression to find all occurrences of a digit followed immediately by a capital letter
-        """
-        pattern = r'(\d)([A-Z])'
-        replacement = r'\1 \2'
-        string = re.sub(pattern, replacement, string)
-        return string
+def insert_space_between_digits_and_capitals(string: str):
+    """
+    Use regular expression to find all occurrences of a digit followed immediately by a capital letter
+    """
+    pattern = r'(\d)([A-Z])'
+    replacement = r'\1 \2'
+    string = re.sub(pattern, replacement, string)
+    return string
+
+def replace_ellipsis_with_period(text):
+    result = text.replace('...', '. ')
+    return result 
+
+def split_to_sentences(text):
+    # The regular expression captures the split characters (., !, ?) along with the sentence
+    allsentences = re.split(r'(?<=[.!?]) +', text)
+    sentences = [sentence.strip() for sentence in allsentences if sentence.strip()]
+    return sentences
+
+def handle_initialisms(text):
+    # Look for patterns that start with an optional period, followed by an optional
+    # space, a capital letter and a period, capturing the capital letter.
+    pattern = r'\b([A-Z])([.!?])'
+    result = re.sub(pattern, r'\1 ', text)
+    return result
 
-    def replace_ellipsis_with_period(text):
-        result = text.replace('...', '. ')
-        return result 
-
-    def split_to_sentences(text):
-        # The regular expression captures the split characters (., !, ?) along with the sentence
-        allsentences = re.split(r'(?<=[.!?]) +', text)
-        sentences = [sentence.strip() for sentence in allsentences if sentence.strip()]
-        return sentences
-
-    def handle_initialisms(text):
-        # Look for patterns that start with an optional period, followed by an optional
-        # space, a capital letter and a period, capturing the capital letter.
-        pattern = r'\b([A-Z])([.!?])'
-        result = re.sub(pattern, r'\1 ', text)
-        return result
-    
-    def handle_titles(text):
-        titles = {'Mr', 'Mrs', 'Dr', 'Ms', 'Jr', 'Sr'} 
-        def replace_match(match):
-            word = match.group(1)
-            if word in titles:
-                return word
-            else:
-                return match.group(0)
-        return re.sub(r'\b(\w+)\.', replace_match, text)
+def handle_titles(text):
+    titles = {'Mr', 'Mrs', 'Dr', 'Ms', 'Jr', 'Sr'} 
+    def replace_match(match):
+        word = match.group(1)
+        if word in titles:
+            return word
+        else:
+            return match.group(0)
+    return re.sub(r'\b(\w+)\.', replace_match, text)
 
+def prepare_text(s: str) -> str:
+    """
+    Cleans and normalizes raw text before it is split into sentences and marked up.
+    """
     # Clean any bad characters
     s = clean_apostrophe_typos(s)
     s = remove_comma_from_large_num(s)
@@ -606,14 +585,48 @@ def markup(s: str,
         s = unidecode(s)
 
     s = replace_ellipsis_with_period(s)
-    sentences = split_to_sentences(s)
-    # Add pauses between sentences
+    return s
+
+def sentence_params(sentence_count: int, markup_pauses: float = None) -> Tuple[float, float]:
+    """
+    Pause between sentences and synth rate, both depend on how much text there is.
+    """
     if markup_pauses is None:
-        markup_pauses = mlparams.PAUSE_LARGE_TEXT if len(sentences) >= mlparams.LARGE_TEXT_SENTENCE_THRESHOLD \
+        markup_pauses = mlparams.PAUSE_LARGE_TEXT if sentence_count >= mlparams.LARGE_TEXT_SENTENCE_THRESHOLD \
                                                   else mlparams.PAUSE_DEFAULT
-    synthRate = mlparams.SYNTH_RATE_LARGE_TEXT if len(sentences) >= mlparams.LARGE_TEXT_SENTENCE_THRESHOLD \
+    synthRate = mlparams.SYNTH_RATE_LARGE_TEXT if sentence_count >= mlparams.LARGE_TEXT_SENTENCE_THRESHOLD \
                                                   else mlparams.SYNTH_RATE_DEFAULT
-        
+    return markup_pauses, synthRate
+
+def markup(s: str,
+           rules: dict,
+           markVoice: bool = True,
+           markVoiceSpecialMarkGenre: bool = True,
+           markBehaviors: bool = True,
+           markMoodAndIntensity: Union[Tuple[str, int], None] = None,
+           prettyPrint: bool = True,
+           markup_pauses: float = None,
+           text_replacements: Dict[str, str] = None,
+           debug: bool = False) -> str:
+    """
+    Main function; proceeds as follows:
+        - Look up rules per word
+        - Create spans of rules based on start/end word indices
+            - Merge spans if rules are very close in range
+        - Remove conflicting spans that do not nest well
+        - Sort
+        - Assemble XML tree
+        - Output
+
+    Args:
+        markup_pauses: pause/break time in seconds between sentences. Defaults None.
+    """
+
+    s = prepare_text(s)
+    sentences = split_to_sentences(s)
+    # Add pauses between sentences
+    markup_pauses, synthRate = sentence_params(len(sentences), markup_pauses)
+
     return  ' '.join(markup_sentence(s = sentence,
                                       rules = rules,
                                       markVoice = markVoice,
@@ -0,0 +1,11 @@
+# backfill_completions.py
+from django.core.management.base import BaseCommand
+from ...mqtt.completions import rebuild_completions_atomic
+from ...mqtt.util import run_db_atomic
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-device completion summaries from the mentor behavior records.'
+
+    def handle(self, *args, **options):
+        count = run_db_atomic(rebuild_completions_atomic)
+        print(f'Rebuilt completion summaries for {count} devices.')
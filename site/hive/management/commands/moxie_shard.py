@@ -0,0 +1,29 @@
+# moxie_shard.py
+import atexit
+import signal
+import sys
+from time import sleep
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from ...mqtt.moxie_server import create_service_instance, cleanup_instance
+
+class Command(BaseCommand):
+    help = 'Run one MQTT server shard, handling only the devices that hash to its index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', type=int, required=True, help='Shard index, from 0 to count-1')
+        parser.add_argument('--count', type=int, required=True, help='Total number of shards')
+
+    def handle(self, *args, **options):
+        # runserver stops shards with SIGTERM, exit normally so buffered writes are flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        atexit.register(cleanup_instance)
+        ep = settings.MQTT_ENDPOINT
+        print(f'Starting MQTT Services shard {options["index"]} of {options["count"]}...')
+        instance = create_service_instance(project_id=ep['project'], host=ep['host'], port=ep['port'],
+                                           cert_required=ep.get('cert_required', True),
+                                           shard_index=options['index'], shard_count=options['count'],
+                                           transport=ep.get('transport', 'thread'))
+        while True:
+            sleep(60)
+            instance.print_metrics()
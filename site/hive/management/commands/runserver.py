@@ -2,12 +2,19 @@ from time import sleep
 from django.core.management.commands.runserver import Command as RunserverCommand
 from django.core.management import call_command
 from django.conf import settings
+import atexit
+import signal
+import subprocess
+import sys
 import threading
 from hive.mqtt.moxie_server import create_service_instance, cleanup_instance
 
 class Command(RunserverCommand):
     _run_enabled = True
     def handle(self, *args, **options):
+        # SIGTERM exits normally, so buffered writes and saved sessions are flushed at exit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        atexit.register(cleanup_instance)
         thread = threading.Thread(target=self.deamon_worker)
         thread.daemon = True  # Set as daemon thread so it exits when main thread exits
         thread.start()
@@ -20,7 +27,22 @@ class Command(RunserverCommand):
         print('Starting MQTT Services...')
         from hive.mqtt.moxie_server import create_service_instance
         ep = settings.MQTT_ENDPOINT
-        instance = create_service_instance(project_id=ep['project'], host=ep['host'], port=ep['port'], cert_required=ep.get('cert_required', True))
+        # With shards > 1, this process runs shard 0 and the rest run as child processes
+        shards = ep.get('shards', 1)
+        self.start_shard_workers(shards)
+        instance = create_service_instance(project_id=ep['project'], host=ep['host'], port=ep['port'], cert_required=ep.get('cert_required', True),
+                                           shard_index=0, shard_count=shards, transport=ep.get('transport', 'thread'))
         while self._run_enabled:
             sleep(60)
             instance.print_metrics()
+
+    def start_shard_workers(self, shards):
+        workers = []
+        for index in range(1, shards):
+            print(f'Starting MQTT shard worker {index}')
+            workers.append(subprocess.Popen([sys.executable, str(settings.BASE_DIR / 'manage.py'), 'moxie_shard',
+                                             '--index', str(index), '--count', str(shards)]))
+        def stop_workers():
+            for w in workers:
+                w.terminate()
+        atexit.register(stop_workers)
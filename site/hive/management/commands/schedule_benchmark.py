@@ -0,0 +1,28 @@
+# schedule_benchmark.py
+import random
+import time
+from django.core.management.base import BaseCommand
+from ...content.data import RECOMMENDABLE_MODULES
+from ...mqtt.scheduler import ransac_select, schedule_score, spread_select
+
+class Command(BaseCommand):
+    help = 'Compare schedule generation score and latency, RANSAC vs spread selection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--extra', type=int, nargs='*', default=[0, 100, 1000, 10000], help='Sizes of synthetic extra_modules lists to test')
+        parser.add_argument('--categories', type=int, default=12, help='Number of categories for synthetic modules')
+        parser.add_argument('--count', type=int, default=6, help='Modules to select per schedule')
+        parser.add_argument('--runs', type=int, default=200, help='Schedules generated per test')
+
+    def handle(self, *args, **options):
+        print(f'{"modules":>8} {"method":>8} {"avg score":>10} {"max score":>10} {"avg ms":>10}')
+        for extra in options['extra']:
+            modules = list(RECOMMENDABLE_MODULES)
+            modules.extend({ 'module_id': f'EXTRA{i}', 'category': f'CAT{random.randrange(options["categories"])}' } for i in range(extra))
+            for name, select in (('ransac', ransac_select), ('spread', spread_select)):
+                scores = []
+                start = time.perf_counter()
+                for i in range(options['runs']):
+                    scores.append(schedule_score(select(modules, options['count'])))
+                elapsed_ms = (time.perf_counter() - start) * 1000 / options['runs']
+                print(f'{len(modules):>8} {name:>8} {sum(scores) / len(scores):>10.2f} {max(scores):>10} {elapsed_ms:>10.3f}')
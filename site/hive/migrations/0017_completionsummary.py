@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hive', '0016_globalresponse_source_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counts', models.JSONField(default=dict)),
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='hive.moxiedevice')),
+            ],
+        ),
+    ]
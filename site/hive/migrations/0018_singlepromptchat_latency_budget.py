@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hive', '0017_completionsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='singlepromptchat',
+            name='fallback_models',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='singlepromptchat',
+            name='latency_budget_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
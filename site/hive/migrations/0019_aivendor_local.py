@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hive', '0018_singlepromptchat_latency_budget'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='singlepromptchat',
+            name='vendor',
+            field=models.IntegerField(choices=[(1, 'OPEN_AI'), (2, 'LOCAL')], default=1),
+        ),
+    ]
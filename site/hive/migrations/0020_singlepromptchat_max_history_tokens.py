@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hive', '0019_aivendor_local'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='singlepromptchat',
+            name='max_history_tokens',
+            field=models.IntegerField(default=1500),
+        ),
+    ]
@@ -5,6 +5,7 @@ from django.core.exceptions import ValidationError
 
 class AIVendor(Enum):
     OPEN_AI = 1
+    LOCAL = 2
 
 class SinglePromptChat(models.Model):
     name = models.CharField(max_length=200)
@@ -12,6 +13,7 @@ class SinglePromptChat(models.Model):
     content_id = models.CharField(max_length=200)
     max_history = models.IntegerField(default=20)
     max_volleys = models.IntegerField(default=9999)
+    max_history_tokens = models.IntegerField(default=1500) # estimated, older history is summarized
     opener = models.TextField()
     prompt = models.TextField()
     vendor = models.IntegerField(choices=[(tag.value, tag.name) for tag in AIVendor],default=AIVendor.OPEN_AI.value)
@@ -20,6 +22,8 @@ class SinglePromptChat(models.Model):
     temperature = models.FloatField(default=0.5)
     code = models.TextField(null=True, blank=True) # Python code for filter methods
     source_version = models.IntegerField(default=1)
+    latency_budget_ms = models.IntegerField(null=True, blank=True) # bound on response time, enables fallback models
+    fallback_models = models.CharField(max_length=255, null=True, blank=True) # comma separated, fastest last
     
     def __str__(self):
         return self.name
@@ -133,4 +137,12 @@ class PersistentData(models.Model):
     data = models.JSONField()
 
     def __str__(self):
-        return f'{self.device} - Data'
\ No newline at end of file
+        return f'{self.device} - Data'
+
+
+class CompletionSummary(models.Model):
+    device = models.OneToOneField(MoxieDevice, on_delete=models.CASCADE)
+    counts = models.JSONField(default=dict)  # COMPLETED mentor behaviors by module_id
+
+    def __str__(self):
+        return f'{self.device} - Completions'
@@ -1,14 +1,422 @@
+'''
+AI FACTORY - Shared gateway to OpenAI
+
+Every inference, summary and transcription goes through one long-lived gateway per API key,
+so HTTP connections and TLS sessions are reused rather than set up for each call.  The gateway
+applies a deadline to each call, limits how many calls run at once, retries transient errors
+with jittered backoff and can hedge slow requests with a second attempt.  Streamed calls are
+read on their own thread, so the deadline covers every piece of text and a slow start can be
+hedged or raced against another model.  Latency is recorded per call type and model, with
+the time to the first piece of text recorded separately for streams.
+
+create_openai() is kept for custom conversation code.  It returns a copy of the shared client
+that shares its connections, with the usual OpenAI retries and timeout.
+'''
 from openai import OpenAI
+import openai
+import concurrent.futures
+import contextlib
 import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+# Defaults for calls through the gateway
+_DEFAULT_TIMEOUT = 20.0
+_MAX_CONCURRENT = 16
+_MAX_RETRIES = 2
+_RETRY_BASE_DELAY = 0.25
+# Call types that may send a second request when the first is slow, and how to pick the delay
+_HEDGE_CALL_TYPES = { 'chat', 'chat_stream' }
+_HEDGE_MIN_SAMPLES = 20
+_HEDGE_PERCENTILE = 95
+_HEDGE_MIN_DELAY = 1.0
+# Latency histogram bucket upper bounds in ms, and recent samples kept for percentiles
+_HISTOGRAM_BUCKETS_MS = [ 100, 250, 500, 1000, 2000, 5000, 10000, 30000 ]
+_HISTOGRAM_SAMPLES = 200
+# Streams also record time to the first text, under the call type with this suffix
+_FIRST_TEXT_SUFFIX = '_first_text'
+# Marks the end of a stream on a reader's queue
+_STREAM_END = object()
+
+# Errors worth another attempt, anything else is returned to the caller right away
+_RETRYABLE_ERRORS = (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
 
 logger = logging.getLogger(__name__)
 
 _OPENAPI_KEY=None
+_GATEWAY=None
+_GATEWAY_LOCK = threading.Lock()
+
+'''
+Latency for one kind of call.  Counts per bucket for the whole run, plus a window of recent
+samples for percentiles.
+'''
+class LatencyHistogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = [0] * (len(_HISTOGRAM_BUCKETS_MS) + 1)
+        self._recent = deque(maxlen=_HISTOGRAM_SAMPLES)
+        self._count = 0
+        self._errors = 0
+        self._hedged = 0
+
+    def record(self, ms, error=False, hedged=False):
+        with self._lock:
+            i = 0
+            while i < len(_HISTOGRAM_BUCKETS_MS) and ms > _HISTOGRAM_BUCKETS_MS[i]:
+                i += 1
+            self._buckets[i] += 1
+            self._recent.append(ms)
+            self._count += 1
+            self._errors += 1 if error else 0
+            self._hedged += 1 if hedged else 0
+
+    # Percentile of recent latencies in ms, or None if there are too few samples
+    def percentile(self, pct, min_samples=1):
+        with self._lock:
+            if len(self._recent) < max(min_samples, 1):
+                return None
+            ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, len(ordered) * pct // 100)]
+
+    def snapshot(self):
+        with self._lock:
+            buckets = { f'le_{le}': n for le, n in zip(_HISTOGRAM_BUCKETS_MS, self._buckets) }
+            buckets['inf'] = self._buckets[-1]
+            rec = { 'count': self._count, 'errors': self._errors, 'hedged': self._hedged, 'buckets': buckets }
+        for pct in (50, 90, 99):
+            rec[f'p{pct}_ms'] = self.percentile(pct)
+        return rec
+
+# Call type for a stream's time to first text
+def first_text_type(call_type):
+    return call_type + _FIRST_TEXT_SUFFIX
+
+'''
+Reads one streamed completion on its own thread, so the caller can wait on it with a deadline
+and race it against others.  Puts (reader, item) on the shared queue for each text piece, then
+_STREAM_END or the error.
+'''
+class _StreamReader:
+    def __init__(self, gateway, model, open_fn, deadline, out):
+        self.model = model
+        self._out = out
+        self._cancelled = False
+        threading.Thread(target=self._run, args=(gateway, open_fn, deadline), name='llm-stream', daemon=True).start()
+
+    # Stop reading and close the stream when the next piece arrives
+    def cancel(self):
+        self._cancelled = True
+
+    # The concurrency slot taken to open the stream is held until it is read to the end or cancelled
+    def _run(self, gateway, open_fn, deadline):
+        with gateway._in_use():
+            try:
+                stream = gateway._attempt_with_retries(open_fn, deadline, keep_slot=True)
+            except Exception as e:
+                self._out.put((self, e))
+                return
+            try:
+                for chunk in stream:
+                    if self._cancelled:
+                        return
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        self._out.put((self, chunk.choices[0].delta.content))
+                self._out.put((self, _STREAM_END))
+            except Exception as e:
+                self._out.put((self, e))
+            finally:
+                try:
+                    stream.close()
+                finally:
+                    gateway._slots.release()
+
+'''
+LLMGateway wraps one OpenAI client, and with it one connection pool, for an API key.  All calls
+take a call_type, used for latency stats and to decide on hedging.
+'''
+class LLMGateway:
+    def __init__(self, api_key, timeout=_DEFAULT_TIMEOUT, max_concurrent=_MAX_CONCURRENT, max_retries=_MAX_RETRIES):
+        # retries are ours, so they respect the deadline and concurrency limit
+        self._client = OpenAI(api_key=api_key, timeout=timeout, max_retries=0)
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='llm-hedge')
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._in_flight = 0
+        self._closed = False
+
+    # Stop the hedge threads once they are idle, calls still running finish normally and the
+    # client's connections are closed when the last of them is done
+    def close(self):
+        self._hedge_pool.shutdown(wait=False)
+        with self._lock:
+            self._closed = True
+            idle = not self._in_flight
+        if idle:
+            self._client.close()
+
+    # Count a use of the client, so closing the gateway waits for it
+    @contextlib.contextmanager
+    def _in_use(self):
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                idle = self._closed and not self._in_flight
+            if idle:
+                self._client.close()
+
+    @property
+    def client(self):
+        return self._client
+
+    def histogram(self, call_type, model):
+        key = f'{call_type}/{model}'
+        with self._lock:
+            h = self._histograms.get(key)
+            if not h:
+                h = LatencyHistogram()
+                self._histograms[key] = h
+            return h
+
+    # Latency stats by call type and model
+    def metrics(self):
+        with self._lock:
+            items = list(self._histograms.items())
+        return { key: h.snapshot() for key, h in items }
+
+    # One attempt, holding a concurrency slot, with what is left of the deadline as its timeout.  With
+    # keep_slot a successful attempt keeps the slot, for streams, and the caller releases it.
+    def _attempt(self, fn, deadline, keep_slot=False):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+            raise openai.APITimeoutError(request=None)
+        try:
+            with self._in_use():
+                result = fn(self._client, max(deadline - time.monotonic(), 0.1))
+        except BaseException:
+            self._slots.release()
+            raise
+        if not keep_slot:
+            self._slots.release()
+        return result
+
+    # Attempts with jittered exponential backoff between them, until success or the deadline
+    def _attempt_with_retries(self, fn, deadline, keep_slot=False):
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(fn, deadline, keep_slot)
+            except _RETRYABLE_ERRORS as e:
+                delay = _RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt >= self._max_retries or time.monotonic() + delay >= deadline:
+                    raise
+                logger.info(f'Retrying LLM call in {delay:.2f}s after {type(e).__name__}')
+                time.sleep(delay)
+                attempt += 1
+
+    # Delay before hedging a call, from recent latency for the same call (or stats_type), or None to not hedge
+    def hedge_delay(self, call_type, model, stats_type=None):
+        if call_type not in _HEDGE_CALL_TYPES:
+            return None
+        ms = self.histogram(stats_type or call_type, model).percentile(_HEDGE_PERCENTILE, min_samples=_HEDGE_MIN_SAMPLES)
+        return max(ms / 1000, _HEDGE_MIN_DELAY) if ms is not None else None
+
+    # Run fn(client, timeout) under the gateway rules.  With hedge_after (seconds) a second attempt
+    # starts if the first hasn't finished by then, and the first to succeed is used.
+    def call(self, call_type, model, fn, timeout=None, hedge_after=None):
+        start = time.monotonic()
+        deadline = start + (timeout if timeout else self._timeout)
+        hedged = False
+        try:
+            if hedge_after is None or hedge_after >= deadline - start:
+                result = self._attempt_with_retries(fn, deadline)
+            else:
+                result, hedged = self._hedged_call(fn, deadline, hedge_after)
+        except Exception:
+            self.histogram(call_type, model).record((time.monotonic() - start) * 1000, error=True)
+            raise
+        self.histogram(call_type, model).record((time.monotonic() - start) * 1000, hedged=hedged)
+        return result
+
+    def _hedged_call(self, fn, deadline, hedge_after):
+        attempt = lambda: self._attempt_with_retries(fn, deadline)
+        result, index, started = self.race([ attempt, attempt ], deadline, hedge_after)
+        return result, started > 1
+
+    # Run attempts on the hedge threads, starting the next one whenever stagger seconds pass (or the
+    # running ones fail) without an answer.  Returns the first result, which attempt gave it, and
+    # how many were started.  Attempts still running are left to finish on their own.
+    def race(self, attempts, deadline, stagger):
+        futures = {}
+        pending = set()
+        error = None
+        next_attempt = 0
+        while True:
+            if next_attempt < len(attempts) and (next_attempt == 0 or not pending or time.monotonic() >= next_start):
+                if next_attempt > 0 and pending:
+                    logger.info(f'LLM call slower than {stagger:.2f}s, starting attempt {next_attempt + 1}')
+                try:
+                    f = self._hedge_pool.submit(attempts[next_attempt])
+                except RuntimeError:
+                    # the gateway was closed for a new key, make do with the attempts already running
+                    next_attempt = len(attempts)
+                    continue
+                futures[f] = next_attempt
+                pending.add(f)
+                next_attempt += 1
+                next_start = time.monotonic() + stagger
+            if not pending:
+                break
+            wait_until = deadline if next_attempt >= len(attempts) else min(next_start, deadline)
+            done, pending = concurrent.futures.wait(pending, timeout=max(wait_until - time.monotonic(), 0), return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    return f.result(), futures[f], next_attempt
+                error = f.exception()
+            if time.monotonic() >= deadline:
+                break
+        raise error if error else openai.APITimeoutError(request=None)
+
+    # Chat completion, returns the completion object.  hedge_after None picks from recent latency, False never hedges
+    def chat(self, model, messages, call_type='chat', timeout=None, hedge_after=None, **kwargs):
+        if hedge_after is None:
+            hedge_after = self.hedge_delay(call_type, model)
+        elif hedge_after is False:
+            hedge_after = None
+        return self.call(call_type, model,
+                         lambda client, t: client.chat.completions.create(model=model, messages=messages, timeout=t, **kwargs),
+                         timeout=timeout, hedge_after=hedge_after)
+
+    # Chat completion, returns just the text
+    def chat_text(self, model, messages, call_type='chat', timeout=None, hedge_after=None, **kwargs):
+        return self.chat(model, messages, call_type=call_type, timeout=timeout, hedge_after=hedge_after, **kwargs).choices[0].message.content
+
+    # Chat on the first model, moving on to the next if there's no answer in stagger seconds (or it
+    # fails), and take whichever answers first.  Returns the text and the model that gave it.
+    def chat_race(self, models, messages, call_type='chat', timeout=None, stagger=None, **kwargs):
+        timeout = timeout if timeout else self._timeout
+        deadline = time.monotonic() + timeout
+        def attempt(model):
+            return lambda: self.chat(model, messages, call_type=call_type, timeout=max(deadline - time.monotonic(), 0.1), hedge_after=False, **kwargs)
+        result, index, started = self.race([ attempt(m) for m in models ], deadline, stagger if stagger else timeout)
+        return result.choices[0].message.content, models[index]
+
+    # Streamed chat completion, yields text pieces as they arrive, all within the timeout.  Like chat(),
+    # a second request starts if there's no text by hedge_after, picked from recent time to first
+    # text when None.  Whichever produces text first is read.  Only starting a stream is retried,
+    # once text has been produced an error goes to the caller.
+    def chat_stream(self, model, messages, call_type='chat_stream', timeout=None, hedge_after=None, **kwargs):
+        timeout = timeout if timeout else self._timeout
+        if hedge_after is None:
+            hedge_after = self.hedge_delay(call_type, model, first_text_type(call_type))
+        elif hedge_after is False:
+            hedge_after = None
+        models = [ model, model ] if hedge_after is not None and hedge_after < timeout else [ model ]
+        yield from self.chat_stream_race(models, messages, call_type=call_type, timeout=timeout, stagger=hedge_after, **kwargs)
+
+    # Streamed chat on the first model, also starting the next if there's no text in stagger seconds
+    # (or it fails), and read whichever produces text first.  One deadline covers all of them.
+    def chat_stream_race(self, models, messages, call_type='chat_stream', timeout=None, stagger=None, **kwargs):
+        timeout = timeout if timeout else self._timeout
+        stagger = stagger if stagger else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        def open_fn(model):
+            return lambda client, t: client.chat.completions.create(model=model, messages=messages, timeout=t, stream=True, **kwargs)
+        out = queue.Queue()
+        readers = []
+        running = 0
+        winner = None
+        error = None
+        finished = False
+        next_start = start
+        try:
+            while True:
+                if not winner and len(readers) < len(models) and (not running or time.monotonic() >= next_start):
+                    if running:
+                        logger.info(f'No streamed text within {stagger:.2f}s, also asking {models[len(readers)]}')
+                    readers.append(_StreamReader(self, models[len(readers)], open_fn(models[len(readers)]), deadline, out))
+                    running += 1
+                    next_start = time.monotonic() + stagger
+                wait_until = deadline if winner or len(readers) >= len(models) else min(next_start, deadline)
+                try:
+                    reader, item = out.get(timeout=max(wait_until - time.monotonic(), 0))
+                except queue.Empty:
+                    if time.monotonic() >= deadline:
+                        raise openai.APITimeoutError(request=None)
+                    continue
+                if winner and reader is not winner:
+                    continue
+                if isinstance(item, Exception):
+                    if winner:
+                        raise item
+                    running -= 1
+                    error = item
+                    if not running and len(readers) >= len(models):
+                        raise error
+                    continue
+                if not winner:
+                    winner = reader
+                    self.histogram(first_text_type(call_type), winner.model).record((time.monotonic() - start) * 1000)
+                    if winner.model != models[0]:
+                        logger.info(f'Streaming from {winner.model} instead of {models[0]}')
+                    for r in readers:
+                        if r is not winner:
+                            r.cancel()
+                if item is _STREAM_END:
+                    finished = True
+                    return
+                yield item
+        finally:
+            # also stops the winner, if the caller stopped reading early
+            for r in readers:
+                r.cancel()
+            model = winner.model if winner else models[0]
+            self.histogram(call_type, model).record((time.monotonic() - start) * 1000, error=not finished, hedged=len(readers) > 1)
+
+    # Speech to text
+    def transcribe(self, model, call_type='stt', timeout=None, **kwargs):
+        return self.call(call_type, model,
+                         lambda client, t: client.audio.transcriptions.create(model=model, timeout=t, **kwargs),
+                         timeout=timeout)
 
 def set_openai_key(key):
-    global _OPENAPI_KEY
-    _OPENAPI_KEY = key
+    global _OPENAPI_KEY, _GATEWAY
+    with _GATEWAY_LOCK:
+        if key == _OPENAPI_KEY and _GATEWAY:
+            return
+        _OPENAPI_KEY = key
+        # calls already running keep their reference to the old gateway and finish normally, its
+        # connections are closed once the last of them is done
+        old, _GATEWAY = _GATEWAY, None
+    if old:
+        old.close()
+
+# Get the shared gateway for the current key, created on first use
+def get_gateway():
+    global _GATEWAY
+    with _GATEWAY_LOCK:
+        if not _GATEWAY:
+            _GATEWAY = LLMGateway(_OPENAPI_KEY)
+        return _GATEWAY
+
+# Latency stats from the current gateway, if there is one
+def gateway_metrics():
+    with _GATEWAY_LOCK:
+        gateway = _GATEWAY
+    return gateway.metrics() if gateway else {}
 
+# A client for custom code, sharing the gateway's connections but with OpenAI's own retries and
+# timeout, since these calls don't go through the gateway
 def create_openai():
-    global _OPENAPI_KEY
-    return OpenAI(api_key=_OPENAPI_KEY)
+    return get_gateway().client.with_options(max_retries=openai.DEFAULT_MAX_RETRIES, timeout=openai.DEFAULT_TIMEOUT)
@@ -0,0 +1,189 @@
+'''
+ASYNCIO TRANSPORT - Runs the MQTT client network IO on an asyncio event loop
+
+The default transport uses paho's loop_start(), where one network thread reads the socket
+and runs every message handler inline, so a slow handler delays all socket reads.  This
+transport instead registers the paho socket with an asyncio event loop.  Socket reads only
+queue messages, and a consumer coroutine awaits the handler for each one in order.  The server's
+handler decodes and routes each message on the loop, passing any real work (database, OpenAI)
+to the device queues, so it must never block.
+
+The queue is bounded.  When routing falls behind and the queue fills, the socket is not read
+until it drains to half, so the broker sees backpressure rather than this process growing
+without limit.
+'''
+import asyncio
+import logging
+import threading
+import paho.mqtt.client as mqtt
+
+# Reconnect backoff when the broker connection drops
+_RECONNECT_MIN_DELAY = 1.0
+_RECONNECT_MAX_DELAY = 30.0
+# Stop reading the socket at this many queued messages, resume once down to half
+_MAX_QUEUED_MESSAGES = 1000
+
+logger = logging.getLogger(__name__)
+
+class AsyncioMqttTransport:
+    def __init__(self, client, handler):
+        self._client = client
+        # handler is a coroutine function taking the paho message
+        self._handler = handler
+        self._loop = None
+        self._thread = None
+        self._queue = None
+        self._tasks = []
+        self._running = False
+        self._connected_once = False
+        self._sock = None
+        self._reading = False
+        self._read_pauses = 0
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        client.on_message = self.on_message
+
+    # Start the event loop thread, no-op if already running
+    def start(self):
+        if self._running:
+            return
+        started = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, args=(started,), name='mqtt-asyncio', daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def _run(self, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._tasks = [ self._loop.create_task(self.consume()), self._loop.create_task(self.misc_loop()) ]
+        self._loop.call_soon(started.set)
+        self._loop.run_forever()
+        self._loop.close()
+
+    # Stop the event loop and wait for its thread to exit
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        self._thread.join()
+
+    async def _shutdown(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._loop.stop()
+
+    # Run a blocking function on the event loop thread and return its result
+    def call(self, fn, *args, **kwargs):
+        async def runner():
+            return fn(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(runner(), self._loop).result()
+
+    # Connect to the broker, socket callbacks must happen on the loop thread
+    def connect(self, host, port, keepalive):
+        self.start()
+        self.call(self._client.connect, host, port, keepalive)
+        self._connected_once = True
+
+    # Messages waiting for their handler to run
+    def pending(self):
+        return self._queue.qsize() if self._queue else 0
+
+    # Times socket reads were paused because the queue was full
+    @property
+    def read_pauses(self):
+        return self._read_pauses
+
+    # paho callbacks, these may arrive from any thread (publish runs on workers)
+    def on_socket_open(self, client, userdata, sock):
+        self.call_soon(self._add_reader, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call_soon(self._remove_socket, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_soon(self._loop.add_writer, sock, self._on_writable)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_soon(self._loop.remove_writer, sock)
+
+    # Schedule on the loop thread, ignored once the loop is shut down
+    def call_soon(self, fn, *args):
+        if self._running and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    # Always called on the loop thread from loop_read, so just queue it.  A read may hold several
+    # messages, so the queue can go a little past the limit before reading stops.
+    def on_message(self, client, userdata, msg):
+        self._queue.put_nowait(msg)
+        if self._reading and self._queue.qsize() >= _MAX_QUEUED_MESSAGES:
+            logger.warning(f'MQTT message queue full at {self._queue.qsize()}, pausing socket reads')
+            self._pause_reading()
+
+    def _pause_reading(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock)
+        self._reading = False
+        self._read_pauses += 1
+
+    def _resume_reading(self):
+        if self._sock is not None:
+            self._loop.add_reader(self._sock, self._on_readable)
+            self._reading = True
+
+    def _add_reader(self, sock):
+        self._sock = sock
+        self._loop.add_reader(sock, self._on_readable)
+        self._reading = True
+
+    def _remove_socket(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        if self._sock is sock:
+            self._sock = None
+            self._reading = False
+
+    def _on_readable(self):
+        self._client.loop_read()
+        # TLS may already hold decrypted data the OS won't report as readable
+        sock = self._sock
+        while self._reading and sock is not None and getattr(sock, 'pending', None) and sock.pending():
+            if self._client.loop_read() != mqtt.MQTT_ERR_SUCCESS:
+                break
+            sock = self._sock
+
+    def _on_writable(self):
+        self._client.loop_write()
+
+    # Handle queued messages one at a time, in arrival order
+    async def consume(self):
+        while True:
+            msg = await self._queue.get()
+            if not self._reading and self._sock is not None and self._queue.qsize() <= _MAX_QUEUED_MESSAGES // 2:
+                self._resume_reading()
+            try:
+                await self._handler(msg)
+            except Exception:
+                logger.exception('Error handling mqtt message:')
+
+    # Keepalives and reconnects, normally done by the paho network thread
+    async def misc_loop(self):
+        delay = _RECONNECT_MIN_DELAY
+        while True:
+            rc = self._client.loop_misc()
+            if rc == mqtt.MQTT_ERR_NO_CONN and self._connected_once:
+                try:
+                    logger.info('MQTT connection lost, reconnecting.')
+                    self._client.reconnect()
+                    delay = _RECONNECT_MIN_DELAY
+                except Exception as e:
+                    logger.warning(f'MQTT reconnect failed: {e}, retry in {delay}s')
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+                    continue
+            await asyncio.sleep(1.0)
@@ -0,0 +1,188 @@
+'''
+CHAT HISTORY - Conversation history bounded by an estimated token budget
+
+Every inference sends the whole history, so an unbounded history makes each volley slower and
+more expensive than the last.  ChatHistory keeps the most recent messages that fit both a
+message count and an estimated token budget.  Messages that roll out are summarized in the
+background, and the running summary goes in front of the remaining messages, so the AI still
+knows what was said earlier in a long conversation.  Rolled out messages are still sent, after
+the summary, until a summary covering them is ready.  If summaries fail they are dropped, so
+they can't pile up.
+
+Token counts are estimates from text length, close enough for budgeting without a tokenizer.
+
+Message entries are never changed once added, a new entry replaces one that gets more text.
+So the message lists handed out share entries with the history rather than copying them,
+and the user line waiting for a response is overlaid on the list instead of cloning it.
+Treat the message dicts as read-only.
+'''
+import concurrent.futures
+import logging
+import threading
+from collections import deque
+
+# Rough token estimate, characters per token and per-message overhead for role and framing
+_CHARS_PER_TOKEN = 4
+_MESSAGE_OVERHEAD_TOKENS = 4
+# Summarize rolled out messages once there are at least this many tokens of them
+_ROLLUP_MIN_TOKENS = 150
+# Threads for background summaries, shared by all sessions
+_ROLLUP_WORKERS = 2
+# Rough memory per message beyond its text, for size estimates
+_MESSAGE_OVERHEAD_BYTES = 200
+
+logger = logging.getLogger(__name__)
+
+_rollup_pool = concurrent.futures.ThreadPoolExecutor(max_workers=_ROLLUP_WORKERS, thread_name_prefix='chat-rollup')
+
+def estimate_tokens(text):
+    return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN if text else 0
+
+def message_tokens(msg):
+    return estimate_tokens(msg.get('content')) + _MESSAGE_OVERHEAD_TOKENS
+
+def messages_tokens(msgs):
+    return sum(message_tokens(msg) for msg in msgs)
+
+# Plain text transcript of a list of messages
+def transcript(msgs):
+    return "\n".join([f"{'Moxie' if msg['role'] == 'assistant' else msg['role']}: {msg['content']}" for msg in msgs])
+
+'''
+Recent messages within a count and token budget, plus a running summary of older ones.  The
+summarizer is fn(previous_summary, messages) returning the new summary text, and runs on a
+background thread.  Without one, older messages are simply dropped.
+'''
+class ChatHistory:
+    def __init__(self, max_messages=20, token_budget=1500, summarizer=None):
+        self._lock = threading.Lock()
+        self._max_messages = max_messages
+        self._token_budget = token_budget
+        self._summarizer = summarizer
+        self._messages = deque()
+        self._tokens = 0
+        self._summary = None
+        self._summary_msg = None
+        self._rolled = []
+        self._rollup_running = False
+        # bumped by clear, so a summary finishing after a reset is thrown away
+        self._generation = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._messages)
+
+    @property
+    def tokens(self):
+        with self._lock:
+            return self._tokens
+
+    @property
+    def summary(self):
+        with self._lock:
+            return self._summary
+
+    # Add a message, text from the same role as the last message is appended to it
+    def add(self, role, content):
+        with self._lock:
+            if self._messages and self._messages[-1]['role'] == role:
+                last = self._messages.pop()
+                self._tokens -= message_tokens(last)
+                content = last.get('content', '') + ' ' + content
+            msg = { 'role': role, 'content': content }
+            self._messages.append(msg)
+            self._tokens += message_tokens(msg)
+            self._trim()
+
+    # Roll out the oldest messages until we fit, always keeping the newest one
+    def _trim(self):
+        while len(self._messages) > 1 and (len(self._messages) > self._max_messages or self._tokens > self._token_budget):
+            msg = self._messages.popleft()
+            self._tokens -= message_tokens(msg)
+            self._rolled.append(msg)
+        if not self._summarizer:
+            self._rolled = []
+        else:
+            self._maybe_rollup()
+
+    # Start summarizing the rolled out messages once there are enough of them, inside the lock
+    def _maybe_rollup(self):
+        if not self._rollup_running and messages_tokens(self._rolled) >= _ROLLUP_MIN_TOKENS:
+            self._rollup_running = True
+            _rollup_pool.submit(self._rollup, self._generation, self._summary, list(self._rolled))
+
+    def _rollup(self, generation, previous, msgs):
+        try:
+            summary = self._summarizer(previous, msgs)
+        except Exception as e:
+            # drop them rather than let them pile up while summaries are failing
+            logger.warning(f'Error summarizing chat history, dropping {len(msgs)} messages: {e}')
+            summary = None
+        with self._lock:
+            self._rollup_running = False
+            if generation == self._generation:
+                if summary:
+                    self._summary = summary
+                    self._summary_msg = { 'role': 'system', 'content': f'Summary of the conversation so far: {summary}' }
+                self._rolled = self._rolled[len(msgs):]
+                # more may have rolled out while this one ran
+                self._maybe_rollup()
+
+    # Messages to send for inference, the summary of older messages first if there is one, then any
+    # rolled out messages it doesn't cover yet.  A pending (role, content) is added to the list
+    # only, as add() would, leaving the history as is.
+    def messages(self, pending=None):
+        with self._lock:
+            msgs = [ self._summary_msg ] if self._summary_msg else []
+            msgs.extend(self._rolled)
+            msgs.extend(self._messages)
+            count = len(self._messages)
+        if pending:
+            role, content = pending
+            if count and msgs[-1]['role'] == role:
+                msgs[-1] = { 'role': role, 'content': msgs[-1].get('content', '') + ' ' + content }
+            else:
+                msgs.append({ 'role': role, 'content': content })
+                if count >= self._max_messages and not self._summarizer:
+                    # add() would drop the oldest, with a summarizer it would still be sent until summarized
+                    del msgs[-self._max_messages - 1]
+        return msgs
+
+    # Rough memory used, in bytes
+    def size_estimate(self):
+        with self._lock:
+            msgs = self._rolled + list(self._messages)
+            summary = self._summary
+        return sum(len(msg.get('content') or '') + _MESSAGE_OVERHEAD_BYTES for msg in msgs) + (len(summary) if summary else 0)
+
+    # Transcript of everything we still know about, summary, messages not yet summarized and recent ones
+    def transcript(self):
+        with self._lock:
+            summary = self._summary
+            msgs = self._rolled + list(self._messages)
+        text = transcript(msgs)
+        return f"Summary of earlier conversation: {summary}\n{text}" if summary else text
+
+    # Plain data for saving the history, the entries are shared so this copies no text
+    def get_state(self):
+        with self._lock:
+            return { 'messages': list(self._messages), 'rolled': list(self._rolled), 'summary': self._summary }
+
+    # Replace the history with saved state from get_state
+    def set_state(self, state):
+        with self._lock:
+            self._messages = deque(state.get('messages', []))
+            self._tokens = messages_tokens(self._messages)
+            self._rolled = list(state.get('rolled', []))
+            self._summary = state.get('summary')
+            self._summary_msg = { 'role': 'system', 'content': f'Summary of the conversation so far: {self._summary}' } if self._summary else None
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._messages = deque()
+            self._tokens = 0
+            self._summary = None
+            self._summary_msg = None
+            self._rolled = []
+            self._generation += 1
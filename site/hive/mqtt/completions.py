@@ -0,0 +1,59 @@
+'''
+COMPLETIONS - Per-device counts of completed content, by module
+
+Schedule generation needs to know how much of each module a device has completed.  Rather
+than counting mentor behavior rows on every request, a CompletionSummary per device is kept
+up to date as behaviors are written, and rebuilt from the behavior table when rows are
+removed or for a backfill of existing data.
+'''
+import logging
+from django.db.models import Count
+from ..models import CompletionSummary, MentorBehavior
+
+logger = logging.getLogger(__name__)
+
+# Count the COMPLETED records in a set of MentorBehavior records, by device pk and module
+def count_completions(recs):
+    device_counts = {}
+    for rec in recs:
+        if rec.action == "COMPLETED":
+            counts = device_counts.setdefault(rec.device_id, {})
+            key = rec.module_id or ''
+            counts[key] = counts.get(key, 0) + 1
+    return device_counts
+
+# Add counts to the device summaries, creating any that are missing, called inside a transaction
+def add_completions_atomic(device_counts):
+    if not device_counts:
+        return
+    summaries = { s.device_id: s for s in CompletionSummary.objects.filter(device_id__in=device_counts.keys()) }
+    created = []
+    for pk, counts in device_counts.items():
+        summary = summaries.get(pk)
+        if not summary:
+            created.append(CompletionSummary(device_id=pk, counts=counts))
+            continue
+        for module_id, count in counts.items():
+            summary.counts[module_id] = summary.counts.get(module_id, 0) + count
+    if created:
+        CompletionSummary.objects.bulk_create(created)
+    CompletionSummary.objects.bulk_update(summaries.values(), ['counts'])
+
+# Recount the summaries from the behavior records, for a list of device pks or all devices
+def rebuild_completions_atomic(device_pks=None):
+    query = MentorBehavior.objects.filter(action="COMPLETED")
+    summaries = CompletionSummary.objects.all()
+    if device_pks is not None:
+        query = query.filter(device_id__in=device_pks)
+        summaries = summaries.filter(device_id__in=device_pks)
+    device_counts = { pk: {} for pk in device_pks } if device_pks is not None else {}
+    for row in query.values('device_id', 'module_id').annotate(count=Count('id')):
+        device_counts.setdefault(row['device_id'], {})[row['module_id'] or ''] = row['count']
+    summaries.delete()
+    CompletionSummary.objects.bulk_create([ CompletionSummary(device_id=pk, counts=counts) for pk, counts in device_counts.items() ])
+    return len(device_counts)
+
+# Load the completion counts for a list of device pks, devices without a summary have none
+def load_completions(device_pks):
+    loaded = { s.device_id: s.counts for s in CompletionSummary.objects.filter(device_id__in=device_pks) }
+    return { pk: loaded.get(pk, {}) for pk in device_pks }
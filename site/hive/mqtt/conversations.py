@@ -1,57 +1,87 @@
 '''
 CONVERSATIONS - Framework for Moxie remote applications / conversations
 '''
-import logging
 import copy
+import logging
 import random
 import re
 import traceback
-from django.template import Template, Context
+from django.template import Context, Template
 from .ai_factory import create_openai
-from ..models import SinglePromptChat
+from .chat_history import ChatHistory, estimate_tokens, messages_tokens, transcript
+from .model_router import ModelRouter
+from .prompt_template import PromptTemplate
+from ..models import AIVendor, SinglePromptChat
 from .volley import Volley
 
 logger = logging.getLogger(__name__)
 
 _DEFAULT_SUMMARY_PROMPT = "Summarize the following conversation between the friendly robot Moxie, and the user.  Keep the summary brief, but include any important details."
+_ROLLUP_PROMPT = "Update the summary of a conversation between the friendly robot Moxie, and the user, to include the new part of the transcript below.  Keep the summary brief, but include any important details."
+_ROLLUP_MAX_TOKENS = 150
+# Rough memory for a session beyond its history, for session store accounting
+_SESSION_BASE_BYTES = 4096
 
 '''
 Base type of a module that has a chat session interaction on Moxie.  It
-manages the history, rotating out records to keep tokens more lean.
+manages the history, rotating out records to keep tokens more lean.  History
+is bounded by message count and estimated tokens, see ChatHistory.
 '''
 class ChatSession:
-    def __init__(self, max_history=20):
-        self._history = []
+    def __init__(self, max_history=20, max_history_tokens=1500, summarizer=None):
+        self._history = ChatHistory(max_history, max_history_tokens, summarizer)
         self._max_history = max_history
         self._total_volleys = 0
         self._local_data = {}
+        self._last_usage = None
 
+    # Add to the session history, or to a list of messages being prepared for inference
     def add_history(self, role, message, history=None):
-        if not history:
-            history = self._history
+        if history is None:
+            self._history.add(role, message)
             self._total_volleys += 1
+            return
         if history and history[-1].get("role") == role:
-            # same role, append text
-            history[-1]["content"] =  history[-1].get("content", '') + ' ' + message
+            # same role, append text, replacing the entry since entries are shared with the session history
+            history[-1] = { "role": role, "content": history[-1].get("content", '') + ' ' + message }
         else:
             history.append({ "role": role, "content": message })
             if len(history) > self._max_history:
-                history = history[-self._max_history:]
+                del history[:-self._max_history]
 
     def is_empty(self):
         return len(self._history) == 0
+
+    # Rough memory used by the session, in bytes
+    def memory_estimate(self):
+        return _SESSION_BASE_BYTES + self._history.size_estimate()
+
+    # Plain data for the session store to save, local_data must be JSON serializable to be saved
+    def get_state(self):
+        return { 'history': self._history.get_state(), 'total_volleys': self._total_volleys, 'local_data': self._local_data }
+
+    # Restore saved state into a freshly made session
+    def restore_state(self, state):
+        self._history.set_state(state.get('history', {}))
+        self._total_volleys = state.get('total_volleys', 0)
+        self._local_data = state.get('local_data', {})
     
     @property
     def total_volleys(self):
         return self._total_volleys
     
     def reset(self):
-        self._history = []
+        self._history.clear()
         self._total_volleys = 0
         
     @property
     def local_data(self):
         return self._local_data
+
+    # Estimated token usage of the last inference, or None if the last volley had none
+    @property
+    def last_usage(self):
+        return self._last_usage
     
     def get_opener(self, msg='Welcome to open chat'):
         return msg,self.overflow()
@@ -67,14 +97,15 @@ class ChatSession:
         if speech and 'animation:' not in speech and 'silent:' not in speech:
             self.add_history('assistant', speech)
 
-    def next_response(self, speech, context):
-        logger.debug(f'Inference using history:\n{self._history}')
+    # on_partial, if provided, is called with the response text so far as it is generated
+    def next_response(self, speech, context, on_partial=None):
+        logger.debug(f'Inference using history:\n{self._history.messages()}')
         return f"chat history {len(self._history)}", None
 
     def overflow(self):
         return False
     
-    def handle_volley(self, volley:Volley):
+    def handle_volley(self, volley:Volley, on_partial=None):
         pass
 
     def summarize(self, model=None, prompt_base=None, max_tokens=None):
@@ -95,20 +126,28 @@ class SingleContextChatSession(ChatSession):
     def __init__(self, 
                  max_history=20, 
                  max_volleys=9999,
+                 max_history_tokens=1500,
                  prompt="You are a having a conversation with your friend. Make it interesting and keep the conversation moving forward. Your utterances are around 30-40 words long. Ask only one question per response and ask it at the end of your response.",
                  opener="Hi there!  Welcome to Open Moxie chat!",
                  model="gpt-3.5-turbo",
                  max_tokens=70,
                  temperature=0.5,
-                 exit_line="Well, that was fun.  Let's move on."
+                 exit_line="Well, that was fun.  Let's move on.",
+                 latency_budget_ms=None,
+                 fallback_models=None,
+                 vendor=AIVendor.OPEN_AI.value,
+                 prompt_template=None,
+                 openers=None
                  ):
-        super().__init__(max_history)
+        super().__init__(max_history, max_history_tokens, summarizer=self.rollup_summary)
         self._max_volleys = max_volleys        
         self._context = [ { "role": "system", 
             "content": prompt
             } ]
         self._opener = opener
+        self._openers = openers if openers else tuple(opener.split('|'))
         self._model = model
+        self._router = ModelRouter(model, fallback_models, latency_budget_ms, vendor)
         self._max_tokens = max_tokens
         self._temperature = temperature
         self._exit_line = exit_line
@@ -117,7 +156,7 @@ class SingleContextChatSession(ChatSession):
         self._post_filter = None
         self._notify_handler = None
         self._complete_handler = None
-        self._prompt_template = Template(prompt)
+        self._prompt_template = prompt_template if prompt_template else PromptTemplate(prompt)
 
     def set_filters(self, pre_filter=None, post_filter=None, complete_handler=None, notify_handler=None):
         self._pre_filter = pre_filter
@@ -128,17 +167,23 @@ class SingleContextChatSession(ChatSession):
     # For web-based, we have no Moxie and no Notify channel, so auto-history is used
     def set_auto_history(self, val):
         self._auto_history = val
+
+    def get_state(self):
+        state = super().get_state()
+        state['auto_history'] = self._auto_history
+        return state
+
+    def restore_state(self, state):
+        super().restore_state(state)
+        self._auto_history = state.get('auto_history', False)
     
     # Check if we exceed max volleys for a conversation
     def overflow(self):
         return self._total_volleys >= self._max_volleys
     
-    # Render an updated prompt context for this volley
+    # Render an updated prompt context for this volley, static prompts share one read-only context
     def make_volley_context(self, volley:Volley):
-        ctx = self._prompt_template.render(Context({'volley': volley, 'session': self}))
-        return [ { "role": "system", 
-                    "content": ctx
-                    } ]
+        return self._prompt_template.system_context(volley=volley, session=self)
     
     # Handle Moxie saying something, accumulate to history
     def ingest_notify(self, volley:Volley):
@@ -146,9 +191,10 @@ class SingleContextChatSession(ChatSession):
         if self._notify_handler:
             self._notify_handler(volley, self)
 
-    # Handle a volley, using its request and populating the response
-    def handle_volley(self, volley:Volley):
+    # Handle a volley, using its request and populating the response, optionally streaming the inference
+    def handle_volley(self, volley:Volley, on_partial=None):
         volley.assign_local_data(self._local_data)
+        self._last_usage = None
         try:
             cmd = volley.request.get('command')
             # when prompting into a convo, make sure its clean
@@ -167,7 +213,7 @@ class SingleContextChatSession(ChatSession):
                 text,overflow = self.get_opener()
             else:
                 speech = "hm" if volley.request.get("command")=="reprompt" else volley.request["speech"]
-                text,overflow = self.next_response(speech, self.make_volley_context(volley))
+                text,overflow = self.next_response(speech, self.make_volley_context(volley), on_partial=on_partial)
             volley.set_output(text, None)
             if overflow:
                 volley.add_launch_or_exit()
@@ -184,28 +230,35 @@ class SingleContextChatSession(ChatSession):
             volley.create_response() # flush any pre-exception response changes
             volley.set_output(err_text,err_text)
 
-    # Get the next thing we should say, given the user speech and the history
-    def next_response(self, speech, context):
+    # Get the next thing we should say, given the user speech and the history.  With on_partial, the
+    # inference is streamed and on_partial gets the text so far as each piece arrives.
+    def next_response(self, speech, context, on_partial=None):
         of = self.overflow()
         if self._auto_history:
             # accumulating automatically, no interruptions or aborts
             self.add_history('user', speech)
-            history = self._history
+            history = self._history.messages()
         else:
-            # clone, add new input, official history comes from notify
-            history = copy.deepcopy(self._history)
-            self.add_history('user', speech, history)
+            # new input only overlaid on the history, official history comes from notify
+            history = self._history.messages(pending=('user', speech))
         try:
-            client = create_openai()
-            resp = client.chat.completions.create(
-                        model=self._model,
-                        messages=context + history,
-                        max_tokens=self._max_tokens,
-                        temperature=self._temperature
-                    ).choices[0].message.content
+            if on_partial:
+                resp = ''
+                for text in self._router.chat_stream(context + history,
+                                                    max_tokens=self._max_tokens,
+                                                    temperature=self._temperature):
+                    resp += text
+                    on_partial(resp)
+            else:
+                resp = self._router.chat_text(context + history,
+                                              max_tokens=self._max_tokens,
+                                              temperature=self._temperature)
         except Exception as e:
             logger.warning(f'Exception attempting inference: {e}')
             resp = "Oh no.  I have run into a bug"
+        self._last_usage = { 'prompt_tokens': messages_tokens(context + history),
+                             'history_tokens': messages_tokens(history),
+                             'completion_tokens': estimate_tokens(resp) }
         if of:
             resp += " " + self._exit_line
         if self._auto_history:
@@ -215,35 +268,37 @@ class SingleContextChatSession(ChatSession):
     # Prompt in this case is an opener line to say when we start the conversation module
     def get_opener(self):
         # Supports multiple random prompts separated by |, pick a random one
-        opener = random.choice(self._opener.split('|'))
+        opener = random.choice(self._openers)
         resp,overflow = super().get_opener(msg=opener)
         if self._auto_history:
             self.add_history('assistant', resp)
         return resp,overflow
     
+    # Run a summary prompt, errors go to the caller
+    def complete_summary(self, prompt, model=None, max_tokens=None):
+        msgs = [ { "role": "user", 
+            "content": prompt
+            } ]
+        return self._router.gateway().chat_text(model if model else self._model, msgs, call_type='summary',
+                                                max_tokens=max_tokens if max_tokens else self._max_tokens,
+                                                temperature=self._temperature)
+
+    # Fold messages rolled out of the history into the running summary, runs in the background
+    def rollup_summary(self, previous, msgs):
+        prompt = _ROLLUP_PROMPT
+        if previous:
+            prompt += f"\n\nSUMMARY:\n{previous}"
+        prompt += f"\n\nTranscript:\n\n{transcript(msgs)}"
+        return self.complete_summary(prompt, max_tokens=_ROLLUP_MAX_TOKENS)
+
     def summarize(self, model=None, prompt_base=None, max_tokens=None, append_transcript=True):
         try:
-            if not model:
-                model = self._model
-            if not max_tokens:
-                max_tokens = self._max_tokens
-            client = create_openai()
             prompt = prompt_base if prompt_base else _DEFAULT_SUMMARY_PROMPT
             if append_transcript:
                 # Concatenate the chat history into a single string
-                chat_transcript = "\n".join([f"{'Moxie' if msg['role'] == 'assistant' else msg['role']}: {msg['content']}" for msg in self._history])
-                prompt += f"\nTranscript:\n\n{chat_transcript}"
+                prompt += f"\nTranscript:\n\n{self._history.transcript()}"
             # Summarize the chat transcript
-            msgs = [ { "role": "user", 
-                "content": prompt
-                } ]
-            resp = client.chat.completions.create(
-                    model=model,
-                    messages=msgs,
-                    max_tokens=max_tokens,
-                    temperature=self._temperature
-                    ).choices[0].message.content
-            return resp
+            return self.complete_summary(prompt, model=model, max_tokens=max_tokens)
         except Exception as e:
             stack = traceback.format_exc()
             logger.error(f"Error summarizing chat: {e}\n{stack}")
@@ -260,18 +315,50 @@ class SingleContextChatSession(ChatSession):
             stack = traceback.format_exc()
             logger.error(f"Error running complete hook: {e}\n{stack}")
 
-# A database backed version, the way we normally load them
-class SinglePromptDBChatSession(SingleContextChatSession):
-    def __init__(self, pk):
-        source = SinglePromptChat.objects.get(pk=pk)
-        super().__init__(max_history=source.max_history, max_volleys=source.max_volleys, model=source.model, prompt=source.prompt, opener=source.opener, max_tokens=source.max_tokens, temperature=source.temperature)
+# Globals for a chat's custom code, the names it has always been able to use without importing
+def code_namespace(source):
+    return { 'copy': copy, 'logging': logging, 'logger': logger, 'random': random, 're': re, 'traceback': traceback,
+             'Context': Context, 'Template': Template, 'Volley': Volley, 'create_openai': create_openai,
+             'source': source }
+
+'''
+ChatPrototype holds everything a session for a SinglePromptChat needs that is the same for every
+session, built once when content is loaded from the database.  The prompt template is classified and compiled,
+the code is compiled and run to find its filter methods, and the openers are split.  Sessions
+made from a prototype share these, so starting one needs no database access or compiling.
+'''
+class ChatPrototype:
+    def __init__(self, source:SinglePromptChat):
+        self.pk = source.pk
+        self.name = source.name
+        fallback_models = [ m.strip() for m in source.fallback_models.split(',') ] if source.fallback_models else None
+        self.session_params = { 'max_history': source.max_history, 'max_volleys': source.max_volleys,
+                                'max_history_tokens': source.max_history_tokens, 'model': source.model,
+                                'prompt': source.prompt, 'opener': source.opener, 'max_tokens': source.max_tokens,
+                                'temperature': source.temperature, 'latency_budget_ms': source.latency_budget_ms,
+                                'fallback_models': fallback_models, 'vendor': source.vendor,
+                                'prompt_template': PromptTemplate(source.prompt), 'openers': tuple(source.opener.split('|')) }
+        self.filters = {}
         if source.code:
             try:
-                loc = locals()
-                exec(source.code, globals(), loc)
-                self.set_filters(pre_filter=loc.get('pre_process'), 
-                                 post_filter=loc.get('post_process'),
-                                 complete_handler=loc.get('complete_handler'),
-                                 notify_handler=loc.get('notify_handler'))
-            except Exception as e:
-                logger.error(f"Error loading code for chat session: {e}")
\ No newline at end of file
+                code = compile(source.code, f'<{source.name}>', 'exec')
+                namespace = code_namespace(source)
+                exec(code, namespace)
+                self.filters = { 'pre_filter': namespace.get('pre_process'),
+                                 'post_filter': namespace.get('post_process'),
+                                 'complete_handler': namespace.get('complete_handler'),
+                                 'notify_handler': namespace.get('notify_handler') }
+            except Exception:
+                logger.exception(f"Error loading code for chat {source.name}")
+
+    def make_session(self):
+        return SinglePromptDBChatSession(prototype=self)
+
+# A database backed version, the way we normally load them, from a prototype or straight from the database
+class SinglePromptDBChatSession(SingleContextChatSession):
+    def __init__(self, pk=None, prototype=None):
+        if not prototype:
+            prototype = ChatPrototype(SinglePromptChat.objects.get(pk=pk))
+        super().__init__(**prototype.session_params)
+        if prototype.filters:
+            self.set_filters(**prototype.filters)
\ No newline at end of file
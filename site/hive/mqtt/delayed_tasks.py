@@ -0,0 +1,75 @@
+'''
+DELAYED TASKS - Run small tasks at a later time without tying up a worker thread
+
+A single timer thread keeps a heap of tasks ordered by due time.  Tasks run on the timer
+thread, so they should be quick, typically just handing real work to a worker queue.
+'''
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class DelayedTask:
+    def __init__(self, due, fn, args, kwargs):
+        self.due = due
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    # Prevent the task from running, if it hasn't already
+    def cancel(self):
+        self.cancelled = True
+
+class DelayedTaskScheduler:
+    def __init__(self, name='timer'):
+        self._name = name
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # Run fn(*args, **kwargs) after delay seconds, returns a task that may be cancelled
+    def schedule(self, delay, fn, *args, **kwargs):
+        task = DelayedTask(time.monotonic() + delay, fn, args, kwargs)
+        with self._cond:
+            heapq.heappush(self._heap, (task.due, next(self._seq), task))
+            # only need to wake the thread if this is now the earliest task
+            if self._heap[0][2] is task:
+                self._cond.notify()
+        return task
+
+    # Number of tasks waiting to run
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if self._heap and self._heap[0][0] <= time.monotonic():
+                        break
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                task = heapq.heappop(self._heap)[2]
+            if task.cancelled:
+                continue
+            try:
+                task.fn(*task.args, **task.kwargs)
+            except Exception:
+                logger.exception(f'Error running {self._name} task')
+
+    # Stop the timer thread, any tasks not yet due are dropped
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
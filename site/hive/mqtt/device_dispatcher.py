@@ -0,0 +1,132 @@
+'''
+DEVICE DISPATCHER - Per-device ordered work queues with fair scheduling
+
+Work for a device is kept in its own FIFO queue, so two events from the same Moxie are
+always handled in the order they arrived.  Worker threads pull from devices in round-robin
+order, taking one item per turn, so a chatty or slow device only ever occupies one worker
+and cannot starve the rest of the fleet.
+'''
+import threading
+import logging
+from collections import deque
+from .util import now_ms
+
+logger = logging.getLogger(__name__)
+
+'''
+DeviceDispatcher replaces a shared ThreadPoolExecutor for device work.  Submit work with the
+device_id that owns it.  At most one item per device runs at a time, and devices with pending
+work take turns on the worker threads.  Queue depth and wait times are tracked per device.
+'''
+class DeviceDispatcher:
+    def __init__(self, name, max_workers=5):
+        self._name = name
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._ready = deque()
+        self._active = set()
+        self._stats = {}
+        self._running = True
+        self._threads = []
+        for i in range(max_workers):
+            t = threading.Thread(target=self._worker, name=f'{name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    # Queue work for a device, runs after any work already queued for the same device
+    def submit(self, device_id, fn, *args, **kwargs):
+        with self._cond:
+            if not self._running:
+                logger.warning(f'Dispatcher {self._name} stopped, dropping work for {device_id}')
+                return
+            q = self._queues.get(device_id)
+            if q is None:
+                q = deque()
+                self._queues[device_id] = q
+            q.append((now_ms(), fn, args, kwargs))
+            # a device is either waiting in the ready list or running, never both
+            if len(q) == 1 and device_id not in self._active:
+                self._ready.append(device_id)
+                self._cond.notify()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                device_id = self._ready.popleft()
+                enqueue_ts, fn, args, kwargs = self._queues[device_id].popleft()
+                self._active.add(device_id)
+            wait_ms = now_ms() - enqueue_ts
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception(f'Error running {self._name} work for {device_id}')
+            with self._cond:
+                self._active.discard(device_id)
+                self.record_wait(device_id, wait_ms)
+                if self._queues[device_id]:
+                    # back of the line, so other devices get a turn first
+                    self._ready.append(device_id)
+                    self._cond.notify()
+                else:
+                    del self._queues[device_id]
+
+    # Called inside the lock, accumulates wait statistics for a device
+    def record_wait(self, device_id, wait_ms):
+        stats = self._stats.get(device_id)
+        if not stats:
+            stats = { 'processed': 0, 'total_wait_ms': 0, 'max_wait_ms': 0, 'last_wait_ms': 0 }
+            self._stats[device_id] = stats
+        stats['processed'] += 1
+        stats['total_wait_ms'] += wait_ms
+        stats['last_wait_ms'] = wait_ms
+        stats['max_wait_ms'] = max(stats['max_wait_ms'], wait_ms)
+
+    # Number of items waiting to run for a device
+    def queue_depth(self, device_id):
+        with self._cond:
+            q = self._queues.get(device_id)
+            return len(q) if q else 0
+
+    # How long the oldest queued item for a device has been waiting
+    def oldest_wait_ms(self, device_id):
+        with self._cond:
+            q = self._queues.get(device_id)
+            return now_ms() - q[0][0] if q else 0
+
+    # Forget statistics for a device, typically when it disconnects
+    def forget(self, device_id):
+        with self._cond:
+            self._stats.pop(device_id, None)
+
+    # Snapshot of queue depth and wait times per device, plus totals
+    def metrics(self):
+        with self._cond:
+            ts = now_ms()
+            devices = {}
+            for device_id, stats in self._stats.items():
+                devices[device_id] = { 'processed': stats['processed'],
+                                      'avg_wait_ms': stats['total_wait_ms'] // stats['processed'],
+                                      'max_wait_ms': stats['max_wait_ms'],
+                                      'last_wait_ms': stats['last_wait_ms'],
+                                      'depth': 0, 'oldest_wait_ms': 0 }
+            for device_id, q in self._queues.items():
+                rec = devices.setdefault(device_id, { 'processed': 0, 'avg_wait_ms': 0, 'max_wait_ms': 0, 'last_wait_ms': 0 })
+                rec['depth'] = len(q)
+                rec['oldest_wait_ms'] = ts - q[0][0] if q else 0
+            return { 'name': self._name,
+                     'queued': sum(len(q) for q in self._queues.values()),
+                     'active': len(self._active),
+                     'devices': devices }
+
+    # Stop accepting work, optionally waiting for queued work to drain
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
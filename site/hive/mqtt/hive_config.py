@@ -0,0 +1,74 @@
+'''
+HIVE CONFIG - Process-wide snapshot of the 'default' HiveConfiguration
+
+Almost everything reads the hive configuration and almost nothing writes it, so we load the
+record once and keep it in memory.  Saves are caught with a signal and swap in a freshly
+loaded snapshot.  Each change bumps a version counter, so caches built from the config only
+need to compare an integer, and listeners are told about changes as they happen.
+
+The snapshot is shared, treat it as read-only.  To make changes, load the record from the
+database, edit and save it, and the snapshot follows.
+'''
+import logging
+import threading
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.forms.models import model_to_dict
+from ..models import HiveConfiguration
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_loaded = False
+_config = None
+_version = 0
+_listeners = []
+
+# Load the record, and replace the snapshot if anything changed.  Returns the current config.
+def reload_hive_config():
+    global _loaded, _config, _version
+    cfg = HiveConfiguration.objects.filter(name='default').first()
+    with _lock:
+        changed = not _loaded or (model_to_dict(cfg) if cfg else None) != (model_to_dict(_config) if _config else None)
+        if changed:
+            _config = cfg
+            _version += 1
+            _loaded = True
+            logger.info(f'Loaded hive configuration, version {_version}')
+        listeners = list(_listeners) if changed else []
+    for fn in listeners:
+        try:
+            fn(cfg)
+        except Exception:
+            logger.exception('Error notifying hive config listener')
+    return cfg
+
+# Get the version and config together, loading on first use
+def hive_config_snapshot():
+    with _lock:
+        if _loaded:
+            return _version, _config
+    reload_hive_config()
+    with _lock:
+        return _version, _config
+
+# Get the current config, may be None if setup hasn't been completed
+def get_hive_config():
+    return hive_config_snapshot()[1]
+
+# Get the current version, which changes whenever the config does
+def hive_config_version():
+    return hive_config_snapshot()[0]
+
+# Register fn(config) to be called after the config changes
+def add_hive_config_listener(fn):
+    with _lock:
+        _listeners.append(fn)
+
+def on_hive_config_saved(sender, instance, **kwargs):
+    if instance.name == 'default':
+        # after commit, so the reload sees the new values
+        transaction.on_commit(reload_hive_config)
+
+post_save.connect(on_hive_config_saved, sender=HiveConfiguration, dispatch_uid='hive_config_saved')
+post_delete.connect(on_hive_config_saved, sender=HiveConfiguration, dispatch_uid='hive_config_deleted')
@@ -0,0 +1,308 @@
+'''
+LOCAL LLM - Inference on a local quantized model, for the LOCAL AI vendor
+
+Short canned-style conversations don't need a large remote model, and a small model on the
+CPU answers them without the WAN round trip.  Models are GGUF files run with llama-cpp-python,
+which is optional and only imported when a LOCAL conversation is first used.
+
+Each model is loaded once and owned by a worker thread, since a llama context can't run
+two inferences at once.  Requests from all robots queue for the worker, which takes them in
+batches and runs identical requests (same messages and parameters) only once, handing the
+result to every caller.  The gateway offers the same chat_text/chat_stream/chat_race calls
+and latency stats as the OpenAI gateway, so conversations and the model router use either.
+'''
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from django.conf import settings
+from .ai_factory import LatencyHistogram
+
+# Defaults for the LOCAL_LLM setting
+_DEFAULT_SETTINGS = {
+    'model_dir': None,
+    'threads': 4,
+    'context': 2048,
+    'batch_size': 8,
+    'batch_wait_ms': 10,
+    'timeout': 20.0,
+}
+# Marks the end of a streamed response on a caller's queue
+_STREAM_END = object()
+
+logger = logging.getLogger(__name__)
+
+_GATEWAY = None
+_GATEWAY_LOCK = threading.Lock()
+
+def local_llm_settings():
+    cfg = dict(_DEFAULT_SETTINGS)
+    cfg.update(getattr(settings, 'LOCAL_LLM', {}))
+    return cfg
+
+# Find the model file, either a path or a file name in the model directory
+def resolve_model_path(model, model_dir=None):
+    if os.path.isfile(model) or not model_dir:
+        return model
+    return os.path.join(model_dir, model)
+
+'''
+One inference request, possibly shared by several callers asking the exact same thing.
+Streaming callers each get a queue of text pieces, everyone gets the final text.
+'''
+class _LocalRequest:
+    def __init__(self, messages, params, stream):
+        self.messages = messages
+        self.params = params
+        self.key = json.dumps([messages, params], sort_keys=True)
+        self.streams = [ queue.Queue() ] if stream else []
+        self.followers = []
+        self.done = threading.Event()
+        self.text = None
+        self.error = None
+        self.cancelled = False
+
+    # The caller gave up waiting
+    def cancel(self):
+        self.cancelled = True
+
+    # Still worth running, if any caller is waiting for it
+    def wanted(self):
+        return not self.cancelled or any(not f.cancelled for f in self.followers)
+
+    def add_text(self, text):
+        for q in self.streams:
+            q.put(text)
+
+    def finish(self, text=None, error=None):
+        self.text = text
+        self.error = error
+        for q in self.streams:
+            q.put(_STREAM_END)
+        self.done.set()
+
+'''
+Worker for one model file, loading it on first use and running batches from its queue.
+'''
+class _LocalModelWorker:
+    def __init__(self, path, cfg):
+        self._path = path
+        self._cfg = cfg
+        self._queue = queue.Queue()
+        self._llm = None
+        self._batches = 0
+        self._coalesced = 0
+        self._skipped = 0
+        self._thread = threading.Thread(target=self._run, name=f'local-llm-{os.path.basename(path)}', daemon=True)
+        self._thread.start()
+
+    def submit(self, req):
+        self._queue.put(req)
+
+    def _load(self):
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise RuntimeError('LOCAL AI vendor needs llama-cpp-python, install it with pip install llama-cpp-python')
+        logger.info(f'Loading local model {self._path}')
+        return Llama(model_path=self._path, n_ctx=self._cfg['context'], n_threads=self._cfg['threads'], verbose=False)
+
+    # Wait for a request, then collect whatever else arrives within the batch window
+    def _next_batch(self):
+        batch = [ self._queue.get() ]
+        until = time.monotonic() + self._cfg['batch_wait_ms'] / 1000
+        while len(batch) < self._cfg['batch_size']:
+            try:
+                batch.append(self._queue.get(timeout=max(until - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # identical requests are run once, with all their callers attached to the first
+            unique = {}
+            for req in batch:
+                first = unique.get(req.key)
+                if first:
+                    first.streams += req.streams
+                    first.followers.append(req)
+                    self._coalesced += 1
+                else:
+                    unique[req.key] = req
+            self._batches += 1
+            for req in unique.values():
+                if not req.wanted():
+                    # everyone timed out while it was queued
+                    self._skipped += 1
+                    error = TimeoutError('Local inference cancelled')
+                    req.finish(None, error)
+                    for follower in req.followers:
+                        follower.finish(None, error)
+                    continue
+                try:
+                    if not self._llm:
+                        self._llm = self._load()
+                    text = self._infer(req)
+                    error = None
+                except Exception as e:
+                    text = None
+                    error = e
+                req.finish(text, error)
+                for follower in req.followers:
+                    follower.finish(text, error)
+
+    def _infer(self, req):
+        if not req.streams:
+            resp = self._llm.create_chat_completion(messages=req.messages, **req.params)
+            return resp['choices'][0]['message'].get('content') or ''
+        text = ''
+        for chunk in self._llm.create_chat_completion(messages=req.messages, stream=True, **req.params):
+            piece = chunk['choices'][0]['delta'].get('content') if chunk.get('choices') else None
+            if piece:
+                text += piece
+                req.add_text(piece)
+            if not req.wanted():
+                # nobody is reading any more, stop generating
+                break
+        return text
+
+    def metrics(self):
+        return { 'loaded': self._llm is not None, 'pending': self._queue.qsize(),
+                 'batches': self._batches, 'coalesced': self._coalesced, 'skipped': self._skipped }
+
+'''
+Gateway to local models, with the same calls as LLMGateway.  Models are named by GGUF file,
+relative to the model_dir setting.
+'''
+class LocalLLMGateway:
+    def __init__(self, cfg=None):
+        self._cfg = cfg if cfg else local_llm_settings()
+        self._lock = threading.Lock()
+        self._workers = {}
+        self._histograms = {}
+
+    def histogram(self, call_type, model):
+        key = f'{call_type}/{model}'
+        with self._lock:
+            h = self._histograms.get(key)
+            if not h:
+                h = LatencyHistogram()
+                self._histograms[key] = h
+            return h
+
+    def metrics(self):
+        with self._lock:
+            items = list(self._histograms.items())
+            workers = list(self._workers.items())
+        m = { key: h.snapshot() for key, h in items }
+        for path, worker in workers:
+            m[f'worker/{os.path.basename(path)}'] = worker.metrics()
+        return m
+
+    def _worker(self, model):
+        path = resolve_model_path(model, self._cfg['model_dir'])
+        with self._lock:
+            worker = self._workers.get(path)
+            if not worker:
+                worker = _LocalModelWorker(path, self._cfg)
+                self._workers[path] = worker
+            return worker
+
+    # Queue a request, only the sampling parameters llama understands are passed on
+    def _submit(self, model, messages, stream, kwargs):
+        params = { k: kwargs[k] for k in ('max_tokens', 'temperature', 'top_p', 'stop') if k in kwargs }
+        req = _LocalRequest(messages, params, stream)
+        self._worker(model).submit(req)
+        return req
+
+    # Chat completion, returns just the text.  hedge_after is accepted for compatibility, there's
+    # no point hedging on a single local worker.
+    def chat_text(self, model, messages, call_type='chat', timeout=None, hedge_after=None, **kwargs):
+        start = time.monotonic()
+        req = self._submit(model, messages, False, kwargs)
+        ok = req.done.wait(timeout if timeout else self._cfg['timeout'])
+        if not ok:
+            req.cancel()
+        error = req.error if ok else TimeoutError(f'Local inference on {model} timed out')
+        self.histogram(call_type, model).record((time.monotonic() - start) * 1000, error=error is not None)
+        if error:
+            raise error
+        return req.text
+
+    # Streamed chat completion, yields text pieces as they arrive.  hedge_after is accepted for compatibility.
+    def chat_stream(self, model, messages, call_type='chat_stream', timeout=None, hedge_after=None, **kwargs):
+        start = time.monotonic()
+        deadline = start + (timeout if timeout else self._cfg['timeout'])
+        req = self._submit(model, messages, True, kwargs)
+        stream = req.streams[0]
+        error = True
+        try:
+            while True:
+                try:
+                    piece = stream.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    raise TimeoutError(f'Local inference on {model} timed out')
+                if piece is _STREAM_END:
+                    break
+                yield piece
+            if req.error:
+                raise req.error
+            error = False
+        finally:
+            # timed out, failed or the caller stopped reading, the worker can stop too
+            req.cancel()
+            self.histogram(call_type, model).record((time.monotonic() - start) * 1000, error=error)
+
+    # Models share the CPU, so rather than racing them try each in turn until one answers
+    def chat_race(self, models, messages, call_type='chat', timeout=None, stagger=None, **kwargs):
+        deadline = time.monotonic() + (timeout if timeout else self._cfg['timeout'])
+        error = None
+        for model in models:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                return self.chat_text(model, messages, call_type=call_type, timeout=remaining, **kwargs), model
+            except Exception as e:
+                logger.info(f'Local inference on {model} failed: {e}')
+                error = e
+        raise error if error else TimeoutError('Local inference timed out')
+
+    # Streamed version of chat_race, moving to the next model if one fails before producing any text
+    def chat_stream_race(self, models, messages, call_type='chat_stream', timeout=None, stagger=None, **kwargs):
+        deadline = time.monotonic() + (timeout if timeout else self._cfg['timeout'])
+        error = None
+        for model in models:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            started = False
+            try:
+                for text in self.chat_stream(model, messages, call_type=call_type, timeout=remaining, **kwargs):
+                    started = True
+                    yield text
+                return
+            except Exception as e:
+                if started:
+                    raise
+                logger.info(f'Local inference on {model} failed: {e}')
+                error = e
+        raise error if error else TimeoutError('Local inference timed out')
+
+# Get the shared local gateway, created on first use
+def get_local_gateway():
+    global _GATEWAY
+    with _GATEWAY_LOCK:
+        if not _GATEWAY:
+            _GATEWAY = LocalLLMGateway()
+        return _GATEWAY
+
+# Latency and worker stats, if local inference has been used
+def local_gateway_metrics():
+    with _GATEWAY_LOCK:
+        gateway = _GATEWAY
+    return gateway.metrics() if gateway else {}
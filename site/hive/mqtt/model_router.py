@@ -0,0 +1,74 @@
+'''
+MODEL ROUTER - Chooses the model for conversation inference within a latency budget
+
+A conversation may declare a latency budget and fallback models.  The router asks the first
+model that has recently been answering within budget, and if there's no answer by half the
+budget it also asks the next model, taking whichever answers first.  Streams race the same
+way to their first text.  Errors move on to the next model right away.  Recent latency percentiles from the LLM gateway feed back into the
+model order, so a model that has gone slow is skipped until it recovers.
+
+The vendor picks the gateway, OpenAI or local models, and all of a router's models come from it.
+'''
+import logging
+from ..models import AIVendor
+from .ai_factory import get_gateway
+from .local_llm import get_local_gateway
+
+# Part of the budget to wait before racing the next model
+_RACE_FRACTION = 0.5
+# Latency percentile compared against the budget, and samples needed before we trust it
+_FEEDBACK_PERCENTILE = 90
+_FEEDBACK_MIN_SAMPLES = 10
+
+logger = logging.getLogger(__name__)
+
+# The gateway for an AIVendor value
+def get_vendor_gateway(vendor):
+    if vendor == AIVendor.LOCAL.value:
+        return get_local_gateway()
+    return get_gateway()
+
+class ModelRouter:
+    def __init__(self, model, fallback_models=None, latency_budget_ms=None, vendor=AIVendor.OPEN_AI.value):
+        self._vendor = vendor
+        self._models = [ model ] + [ m for m in (fallback_models or []) if m and m != model ]
+        self._budget = latency_budget_ms / 1000 if latency_budget_ms else None
+
+    # Models in the order to try them, those recently within budget first, otherwise in declared order
+    def candidates(self, gateway, call_type='chat'):
+        if not self._budget or len(self._models) == 1:
+            return self._models
+        fast = []
+        slow = []
+        for model in self._models:
+            ms = gateway.histogram(call_type, model).percentile(_FEEDBACK_PERCENTILE, min_samples=_FEEDBACK_MIN_SAMPLES)
+            (slow if ms is not None and ms > self._budget * 1000 else fast).append(model)
+        return fast + slow
+
+    def gateway(self):
+        return get_vendor_gateway(self._vendor)
+
+    # Chat completion text from the best model available within the budget
+    def chat_text(self, messages, call_type='chat', **kwargs):
+        gateway = self.gateway()
+        if not self._budget:
+            return gateway.chat_text(self._models[0], messages, call_type=call_type, **kwargs)
+        models = self.candidates(gateway, call_type)
+        text, model = gateway.chat_race(models, messages, call_type=call_type, timeout=self._budget,
+                                        stagger=self._budget * _RACE_FRACTION, **kwargs)
+        if model != self._models[0]:
+            logger.info(f'Routed inference to {model} instead of {self._models[0]}')
+        return text
+
+    # Streamed chat completion from the best model available within the budget.  Models race to
+    # the first text the same way chat_text races for answers, and once text is flowing we stay
+    # with that model.  One deadline covers every model tried.
+    def chat_stream(self, messages, call_type='chat_stream', **kwargs):
+        gateway = self.gateway()
+        if len(self._models) == 1:
+            yield from gateway.chat_stream(self._models[0], messages, call_type=call_type, timeout=self._budget, **kwargs)
+            return
+        # without a budget, only move on to the next model when one fails
+        stagger = self._budget * _RACE_FRACTION if self._budget else None
+        yield from gateway.chat_stream_race(self.candidates(gateway, call_type), messages, call_type=call_type,
+                                            timeout=self._budget, stagger=stagger, **kwargs)
@@ -10,21 +10,33 @@ the remote service everytime it says something.  This data is used to accumulate
 history of the conversation and provides mostly seemless conversation context for the AI,
 even when the user provides input in multiple speech windows before hearing a response.
 '''
-import concurrent.futures
 from ..models import SinglePromptChat
 from ..automarkup import process as automarkup_process
 from ..automarkup import initialize_rules as automarkup_initialize_rules
+from ..automarkup import StreamingMarkup
 import logging
+import threading
 from datetime import datetime
+from django.conf import settings
 from .global_responses import GlobalResponses
-from .conversations import ChatSession, SinglePromptDBChatSession
+from .conversations import ChatPrototype, ChatSession, SinglePromptDBChatSession
 from .volley import Volley
+from .device_dispatcher import DeviceDispatcher
+from .session_store import SessionStore, make_session_backend
 
 # Turn on to enable global commands in the cloud
 _ENABLE_GLOBAL_COMMANDS = True
 _LOG_ALL_RCR = False
 _LOG_NOTIFY_RCR = True
 _MAX_WORKER_THREADS = 5
+# Limits for active sessions, idle time (seconds), count, and estimated memory (bytes)
+_SESSION_IDLE_TTL = 3600
+_SESSION_MAX_ENTRIES = 2000
+_SESSION_MAX_BYTES = 64*1024*1024
+# Stream inferences, marking up each sentence while the rest is still being generated
+_STREAM_MARKUP = True
+# Log the estimated token usage of each inference
+_LOG_USAGE = True
 
 logger = logging.getLogger(__name__)
 
@@ -38,16 +50,59 @@ class RemoteChat:
     _global_responses: GlobalResponses
     def __init__(self, server):
         self._server = server
-        self._device_sessions = {}
+        self._device_sessions = SessionStore(on_evict=self.on_chat_complete, max_entries=_SESSION_MAX_ENTRIES,
+                                             idle_ttl=_SESSION_IDLE_TTL, max_bytes=_SESSION_MAX_BYTES,
+                                             backend=make_session_backend(getattr(settings, 'CHAT_SESSION_STORE', None)),
+                                             restore=self.restore_session)
         self._modules = { }
         self._modules_info = { "modules": [], "version": "openmoxie_v1" }
-        self._worker_queue = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKER_THREADS)
+        self._worker_queue = DeviceDispatcher('remote_chat', max_workers=_MAX_WORKER_THREADS)
         self._automarkup_rules = automarkup_initialize_rules()
         self._global_responses = GlobalResponses()
+        self._usage_lock = threading.Lock()
+        self._usage = { 'volleys': 0, 'prompt_tokens': 0, 'completion_tokens': 0 }
 
     def register_module(self, module_id, content_id, cname):
         self._modules[f'{module_id}/{content_id}'] = cname
 
+    # Per-device queue depth and wait times for remote chat work
+    def worker_metrics(self):
+        return self._worker_queue.metrics()
+
+    # Drop per-device worker stats for a device that disconnected
+    def forget_device(self, device_id):
+        self._worker_queue.forget(device_id)
+
+    # Active session count, memory estimate and evictions
+    def session_metrics(self):
+        return self._device_sessions.metrics()
+
+    # Make a new session for a module/content id, for saved sessions being loaded
+    def restore_session(self, id):
+        maker = self._modules.get(id)
+        return maker['xtor'](**maker['params']) if maker else None
+
+    # Save a session after it changes, if the session store keeps them
+    def save_session(self, device_id):
+        self._device_sessions.save(device_id)
+
+    # Write out saved sessions
+    def shutdown(self):
+        self._device_sessions.shutdown()
+
+    # Estimated token totals over all inferences
+    def usage_metrics(self):
+        with self._usage_lock:
+            return dict(self._usage)
+
+    def record_usage(self, device_id, id, usage):
+        if _LOG_USAGE:
+            logger.info(f'Chat usage [{device_id} {id}]: {usage}')
+        with self._usage_lock:
+            self._usage['volleys'] += 1
+            self._usage['prompt_tokens'] += usage['prompt_tokens']
+            self._usage['completion_tokens'] += usage['completion_tokens']
+
     # Gets the remote module info record to share remote modules with Moxie
     def get_modules_info(self):
         return self._modules_info
@@ -57,10 +112,17 @@ class RemoteChat:
         new_modules = {}
         mod_map = {}
         for chat in SinglePromptChat.objects.all():
+            try:
+                # compile once here, so sessions are cheap to start
+                maker = { 'xtor': ChatPrototype(chat).make_session, 'params': {} }
+            except Exception:
+                # leave it to fail when used, as it would have before
+                logger.exception(f'Error preparing chat {chat.name}')
+                maker = { 'xtor': SinglePromptDBChatSession, 'params': { 'pk': chat.pk } }
             # one module can support many content IDs, separated by | like openers
             cid_list = chat.content_id.split('|')
             for content_id in cid_list:
-                new_modules[f'{chat.module_id}/{content_id}'] = { 'xtor': SinglePromptDBChatSession, 'params': { 'pk': chat.pk } }
+                new_modules[f'{chat.module_id}/{content_id}'] = maker
                 logger.debug(f'Registering {chat.module_id}/{content_id}')
                 # Group content IDs under module IDs
                 if chat.module_id in mod_map:
@@ -85,29 +147,37 @@ class RemoteChat:
     def on_chat_complete(self, device_id, id, session:ChatSession):
         logger.info(f'Chat Session Complete: {id} {session.has_complete_hook()}')
         if session.has_complete_hook():
-            # make a data-only Volley for the completion hook
-            volley = Volley({}, device_id=device_id, data_only=True, robot_data=self._server.robot_data().get_volley_data(device_id), local_data=session.local_data)
-            self._worker_queue.submit(session.complete_hook, volley)
+            self._worker_queue.submit(device_id, self.run_complete_hook, device_id, id, session)
+
+    # NOTE: Called in the device's lane.  Hooks read and change the robot's persistent data, which
+    # is only loaded (and saved when it disconnects) while the device is connected to this process,
+    # so sessions evicted for an offline device or one served by another shard are skipped.
+    def run_complete_hook(self, device_id, id, session:ChatSession):
+        robot_data = self._server.robot_data()
+        if not robot_data.device_online(device_id):
+            logger.info(f'Skipping complete hook for {id}, {device_id} is not loaded here')
+            return
+        # make a data-only Volley for the completion hook
+        volley = Volley({}, device_id=device_id, data_only=True, robot_data=robot_data.get_volley_data(device_id), local_data=session.local_data)
+        session.complete_hook(volley)
 
     # Get the current or a new session for this device for this module/content ID pair
     def active_session_data(self, device_id):
-        if device_id in self._device_sessions:
-            return self._device_sessions[device_id]['session'].local_data
-        return None
+        entry = self._device_sessions.peek(device_id)
+        return entry.session.local_data if entry else None
             
     # Get the current or a new session for this device for this module/content ID pair
     def get_session(self, device_id, id, maker) -> ChatSession:
         # each device has a single session only for now
-        if device_id in self._device_sessions:
-            if self._device_sessions[device_id]['id'] == id:
-                return self._device_sessions[device_id]['session']
+        entry = self._device_sessions.get(device_id)
+        if entry:
+            if entry.id == id:
+                return entry.session
             else:
-                self.on_chat_complete(device_id, self._device_sessions[device_id]['id'], self._device_sessions[device_id]['session'])
+                self.on_chat_complete(device_id, entry.id, entry.session)
 
         # new session needed
-        new_session = { 'id': id, 'session': maker['xtor'](**maker['params']) }
-        self._device_sessions[device_id] = new_session
-        return new_session['session']
+        return self._device_sessions.put(device_id, id, maker['xtor'](**maker['params'])).session
 
     # Get's a chat session object for use in the web chat
     def get_web_session_for_module(self, device_id, module_id, content_id):
@@ -129,17 +199,25 @@ class RemoteChat:
     def make_markup(self, text, mood_and_intensity = None):
         return automarkup_process(text, self._automarkup_rules, mood_and_intensity=mood_and_intensity)
 
+    # Markup for text that is still arriving
+    def make_markup_stream(self, mood_and_intensity = None):
+        return StreamingMarkup(self._automarkup_rules, mood_and_intensity=mood_and_intensity)
+
     # Get the next response to a chat
     def create_session_response(self, device_id, sess:ChatSession, volley: Volley):
-        sess.handle_volley(volley)
+        stream = self.make_markup_stream() if _STREAM_MARKUP else None
+        sess.handle_volley(volley, on_partial=stream.feed if stream else None)
         if 'markup' not in volley.response['output']:
-            # if we don't have markup, create it
+            # if we don't have markup, create it, most of it is done already when streaming
             text = volley.response['output']['text']
-            volley.set_output(text, self.make_markup(text))
+            volley.set_output(text, stream.finish(text) if stream else self.make_markup(text))
+        if sess.last_usage:
+            self.record_usage(device_id, volley.request.get('module_id', '') + '/' + volley.request.get('content_id', ''), sess.last_usage)
 
         if _LOG_ALL_RCR:
             logger.info(f"RemoteChatResponse\n{volley.response}")
         self._server.send_command_to_bot_json(device_id, 'remote_chat', volley.response)
+        self.save_session(device_id)
     
     # Produce / execute a global response
     def global_response(self, device_id, functor):
@@ -169,37 +247,58 @@ class RemoteChat:
             self.log_notify(rcr)
 
         maker = self._modules.get(id)
+        # sessions may be loaded from and saved to the session store, so everything touching them
+        # runs in the device's lane rather than here on the MQTT thread, and in arrival order
         if maker:
-            # THIS IS THE PATH FOR REMOTE CONTENT - MODULE/CONTENT HOSTED IN OPENMOXIE
-            logger.debug(f'Handling RCR:{cmd} for {id}') 
-            sess = self.get_session(device_id, id, maker)
-            if cmd == 'notify':
-                volley = Volley(rcr, device_id=device_id, robot_data=volley_data, local_data=sess.local_data, data_only=True)
-                sess.ingest_notify(volley)
-            else:
-                volley = Volley(rcr, device_id=device_id, robot_data=volley_data, local_data=sess.local_data)
-                if not self.handled_global(device_id, volley):
-                    self._worker_queue.submit(self.create_session_response, device_id, sess, volley)
+            self._worker_queue.submit(device_id, self.handle_session_request, device_id, id, maker, rcr, volley_data)
         else:
-            # THIS IS THE PATH FOR MOXIE ON-BOARD CONTENT
-            session_reset = False
-            if device_id in self._device_sessions:
-                session = self._device_sessions.pop(device_id, None)
-                self.on_chat_complete(device_id, session['id'], session['session'])
-                session_reset = True
-            if cmd != 'notify':
-                volley = Volley(rcr, device_id=device_id, robot_data=volley_data)
-                if not self.handled_global(device_id, volley):
-                    logger.debug(f'Ignoring request for other module: {id} SessionReset:{session_reset}')
-                    # Rather than ignoring these, we return a generic FALLBACK response
-                    fbline = "I'm sorry. Can  you repeat that?"
-                    volley.set_output(fbline, fbline, output_type='FALLBACK')
-                    self._server.send_command_to_bot_json(device_id, 'remote_chat', volley.response)
-    
+            self._worker_queue.submit(device_id, self.handle_other_request, device_id, id, rcr, volley_data)
+
+    # NOTE: Called in the device's lane, a request for a module we host
+    def handle_session_request(self, device_id, id, maker, rcr, volley_data):
+        # THIS IS THE PATH FOR REMOTE CONTENT - MODULE/CONTENT HOSTED IN OPENMOXIE
+        cmd = rcr.get('command')
+        logger.debug(f'Handling RCR:{cmd} for {id}') 
+        sess = self.get_session(device_id, id, maker)
+        if cmd == 'notify':
+            self.ingest_session_notify(device_id, sess, rcr, volley_data)
+            return
+        volley = Volley(rcr, device_id=device_id, robot_data=volley_data, local_data=sess.local_data)
+        global_functor = self.check_global(volley)
+        if global_functor:
+            logger.debug(f'Global response inside {id}')
+            self.global_response(device_id, global_functor)
+        else:
+            self.create_session_response(device_id, sess, volley)
+
+    # NOTE: Called in the device's lane, a request for content on Moxie, which ends any session we had
+    def handle_other_request(self, device_id, id, rcr, volley_data):
+        # THIS IS THE PATH FOR MOXIE ON-BOARD CONTENT
+        cmd = rcr.get('command')
+        session_reset = False
+        entry = self._device_sessions.pop(device_id)
+        if entry:
+            self.on_chat_complete(device_id, entry.id, entry.session)
+            session_reset = True
+        if cmd != 'notify':
+            volley = Volley(rcr, device_id=device_id, robot_data=volley_data)
+            if not self.handled_global(device_id, volley):
+                logger.debug(f'Ignoring request for other module: {id} SessionReset:{session_reset}')
+                # Rather than ignoring these, we return a generic FALLBACK response
+                fbline = "I'm sorry. Can  you repeat that?"
+                volley.set_output(fbline, fbline, output_type='FALLBACK')
+                self._server.send_command_to_bot_json(device_id, 'remote_chat', volley.response)
+
+    # Add what Moxie said to the session history
+    def ingest_session_notify(self, device_id, sess:ChatSession, rcr, volley_data):
+        volley = Volley(rcr, device_id=device_id, robot_data=volley_data, local_data=sess.local_data, data_only=True)
+        sess.ingest_notify(volley)
+        self.save_session(device_id)
+
     def handled_global(self, device_id, volley):
         global_functor = self.check_global(volley)
         if global_functor:
             logger.debug(f'Global response inside {id}')
-            self._worker_queue.submit(self.global_response, device_id, global_functor)
+            self._worker_queue.submit(device_id, self.global_response, device_id, global_functor)
             return True
         return False
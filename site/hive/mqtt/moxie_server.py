@@ -1,7 +1,6 @@
 '''
 MOXIE SERVER - Primary service handler for Moxie
 '''
-import concurrent
 import paho.mqtt.client as mqtt
 import json
 import time
@@ -9,15 +8,23 @@ import re
 import logging
 import base64
 import ssl
-from .ai_factory import set_openai_key
+import zlib
+import threading
+import asyncio
+from .ai_factory import gateway_metrics, set_openai_key
+from .local_llm import local_gateway_metrics
+from .hive_config import add_hive_config_listener, get_hive_config, reload_hive_config
 from .robot_credentials import RobotCredentials
-from .robot_data import RobotData
+from .robot_data import RobotData, config_digest, encode_config
+from .device_dispatcher import DeviceDispatcher
+from .delayed_tasks import DelayedTaskScheduler
+from .asyncio_transport import AsyncioMqttTransport
 from .moxie_remote_chat import RemoteChat
 from .protos.embodied.logging.Log_pb2 import ProtoSubscribe
 from .protos.embodied.logging.Cloud2_pb2 import ServiceConfiguration2
 from .protos.embodied.wifiapp.QRCommands_pb2 import StartPairingQR
 from .zmq_stt_handler import STTHandler
-from ..models import HiveConfiguration
+from ..models import MoxieDevice
 
 _BASIC_FORMAT = '{1}'
 _MOXIE_SERVICE_INSTANCE = None
@@ -25,10 +32,34 @@ _MOXIE_SERVICE_INSTANCE = None
 _PROVIDE_HTTP_TOKENS=False
 # As this key is expressly shared and thus usably by any clients, this turns it off
 _SHARE_GOOGLE_KEY=True
+# Worker threads shared by all devices, each device uses at most one at a time
+_MAX_WORKER_THREADS = 5
+# Connects and disconnects have their own lane, so a reconnect storm can't block other work
+_MAX_CONNECT_THREADS = 2
+# Delay after connecting before we send config/subscriptions, so the client is ready
+_CONNECT_CONFIG_DELAY = 1.0
+# Connects and disconnects all run in order in this lane of the connect queue, so a device's
+# disconnect never overtakes the batch that loads it
+_CONNECT_LANE = 'connect_batch'
+# Connects arriving within this window are loaded together in one batch, up to the max size
+_CONNECT_BATCH_WINDOW = 0.25
+_CONNECT_BATCH_MAX = 200
+# Max config pushes per second after connects, spreads out the load during reconnect storms
+_CONFIG_PUSH_RATE = 50
+# Sharded servers coordinate using this topic, messages are JSON with a command and optional device_id
+_SHARD_CONTROL_TOPIC = '/openmoxie/shards/control'
+# How long to wait for other shards to answer a query about the devices they hold
+_SHARD_QUERY_TIMEOUT = 2.0
 
 def now_ms():
     return time.time_ns() // 1_000_000
 
+# Query bounds from a robot must be non-negative integers, anything else is ignored
+def query_bound(value):
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    return None
+
 logger = logging.getLogger(__name__)
 
 '''
@@ -42,6 +73,21 @@ message paylods.  Moxie Server notably:
 As implemented there is a singleton MoxieService created using the instance creation method
 near the end of this file.  It connects to the MQTT broker, which cooredinates all exchanges
 of topics between Moxie's and MoxieServer.
+
+MoxieServer can also run as one of N shards, each in its own process.  Every shard receives
+all topics, but drops messages for devices it doesn't own (a stable hash of the device_id)
+before doing any decoding, so all state for a device (RobotData, RemoteChat sessions) lives
+in exactly one process.  Requests that start in another process, like web edits, are
+forwarded to the owning shard over the shard control topic.
+
+Device configs are published as retained messages, so the broker hands a Moxie its config
+as soon as it subscribes.  Configs are only republished when they change, which we detect by
+also subscribing to the config topics and remembering the hash of what the broker has retained.
+
+The MQTT network IO runs either on paho's own network thread (transport='thread') or on an
+asyncio event loop (transport='asyncio').  Either way routing a message never blocks: it
+decodes the JSON, matches the broker log patterns, and hands database and OpenAI work to the
+device queues.
 '''
 class MoxieServer:
     _robot : any
@@ -56,14 +102,19 @@ class MoxieServer:
     _google_service_account: str
     _robot_data: RobotData
     _remote_chat: RemoteChat
-    def __init__(self, robot, rbdata, project_id, mqtt_host, mqtt_port, cert_required=True):
+    def __init__(self, robot, rbdata, project_id, mqtt_host, mqtt_port, cert_required=True, shard_index=0, shard_count=1, transport='thread'):
         self._robot = robot
         self._robot_data = rbdata
         self._mqtt_project_id = project_id
         self._mqtt_endpoint = mqtt_host
         self._port = mqtt_port
         self._cert_required = cert_required
+        self._shard_index = shard_index
+        self._shard_count = shard_count
         self._mqtt_client_id = _BASIC_FORMAT.format(self._mqtt_project_id, self._robot.device_id)
+        if self._shard_count > 1:
+            # each shard needs its own client id, or the broker kicks the others off
+            self._mqtt_client_id += f'-shard{self._shard_index}'
         logger.info(f"Creating client with id: {self._mqtt_client_id}")
         self._client = mqtt.Client(client_id=self._mqtt_client_id, transport="tcp")
         if self._cert_required:
@@ -79,7 +130,30 @@ class MoxieServer:
         self._client_metrics = {}
         self._connect_pattern = r"connected from (.*) as (d_[a-f0-9-]+)"
         self._disconnect_pattern = r"Client (d_[a-f0-9-]+) (closed its connection|disconnected)"
-        self._worker_queue = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        self._worker_queue = DeviceDispatcher('device', max_workers=_MAX_WORKER_THREADS)
+        self._connect_queue = DeviceDispatcher('connect', max_workers=_MAX_CONNECT_THREADS)
+        self._timer = DelayedTaskScheduler()
+        self._connect_lock = threading.Lock()
+        self._pending_connects = {}
+        self._online_devices = set()
+        self._connect_batch_task = None
+        self._connect_batches_queued = 0
+        self._next_config_push = 0
+        self._backlog_start = None
+        self._backlog_count = 0
+        self._connect_metrics = { 'last_backlog': 0, 'last_drain_ms': 0 }
+        self._retained_configs = {}
+        self._shard_query_lock = threading.Lock()
+        self._shard_query_seq = 0
+        self._shard_queries = {}
+        self._hive_config_snapshot = None
+        self._hive_config_loaded = False
+        self._transport = None
+        if transport == 'asyncio':
+            self._transport = AsyncioMqttTransport(self._client, self.on_message_async)
+        add_hive_config_listener(self.on_hive_config_changed)
+        self._robot_data.add_schedule_listener(self.on_schedule_changed)
+        self.on_hive_config_changed(get_hive_config())
         self.update_from_database()
 
     # Connect to the broker - the jwt stuff left in place, but isn't required
@@ -87,7 +161,10 @@ class MoxieServer:
         jwt_token = self._robot.create_jwt(self._mqtt_project_id)
         self._client.username_pw_set(username='unknown', password=jwt_token)
         logger.info(f"connecting to: {self._mqtt_endpoint}")
-        self._client.connect(self._mqtt_endpoint, self._port, 60)
+        if self._transport:
+            self._transport.connect(self._mqtt_endpoint, self._port, 60)
+        else:
+            self._client.connect(self._mqtt_endpoint, self._port, 60)
         if start:
             self.start()
 
@@ -119,9 +196,14 @@ class MoxieServer:
         # The only two supported in IOT - commands for a wildcard of commands, config for our robot configuration
         client.subscribe('/devices/+/events/#')
         client.subscribe('/devices/+/state')
+        # Retained configs, the broker may have restarted so start fresh
+        self._retained_configs = {}
+        client.subscribe('/devices/+/config')
         # Subscriptions to monitor clients and broker logs
         client.subscribe('$SYS/broker/clients/#')
         client.subscribe('$SYS/broker/log/#')
+        if self._shard_count > 1:
+            client.subscribe(_SHARD_CONTROL_TOPIC)
         for ch in self._connect_handlers:
             ch(self, rc) 
 
@@ -131,10 +213,18 @@ class MoxieServer:
             dec = msg.topic.split('/')
             fromdevice = dec[2]
             basetype = dec[3]
-            if basetype == "events":
+            if dec[1] == "devices" and not self.owns_device(fromdevice):
+                # another shard handles this device
+                return
+            if msg.topic == _SHARD_CONTROL_TOPIC:
+                self.on_shard_control(json.loads(msg.payload))
+            elif basetype == "events":
                 self.on_device_event(fromdevice, dec[4], msg)
             elif basetype == "state":
                 self.on_device_state(fromdevice, msg)
+            elif basetype == "config":
+                # retained config, either delivered on subscribe or our own publish
+                self._retained_configs[fromdevice] = config_digest(msg.payload)
             elif fromdevice == "clients":
                 self.on_client_metrics(basetype, msg)
             elif fromdevice == "log":
@@ -145,17 +235,219 @@ class MoxieServer:
             logging.exception("Error handling mqtt messsage:")
     
 
+    # Entry point for ALL incoming messages when using the asyncio transport.  Routing only decodes
+    # the message and submits any database or OpenAI work to the device queues, so it runs right
+    # here on the event loop, then yields so socket reads and keepalives get a turn.
+    async def on_message_async(self, msg):
+        self.on_message(self._client, None, msg)
+        await asyncio.sleep(0)
+
     # Handle messages FROM mosquitto syslog topic, looking for connect/disconnects
     def on_sys_log_message(self, basetype, msg):
         if basetype == "N": # Notifications
             line = msg.payload.decode('utf-8')
             match = re.search(self._connect_pattern, line)
             match2 = None if match else re.search(self._disconnect_pattern, line)
+            if match and not self.owns_device(match.group(2)):
+                return
+            if match2 and not self.owns_device(match2.group(1)):
+                return
             if match:
-                if self._robot_data.connect_init_needed(match.group(2)):
-                    self._worker_queue.submit(self.on_device_connect, match.group(2), True, match.group(1))
+                if self.mark_device_online(match.group(2)):
+                    self.queue_device_connect(match.group(2), match.group(1))
             elif match2:
-                self._worker_queue.submit(self.on_device_connect, match2.group(1), False)
+                self.cancel_device_connect(match2.group(1))
+                self._connect_queue.submit(_CONNECT_LANE, self.on_device_connect, match2.group(1), False)
+
+    # Remember a device is connected, returns True if it wasn't already so it needs loading
+    def mark_device_online(self, device_id):
+        with self._connect_lock:
+            needed = device_id not in self._online_devices
+            self._online_devices.add(device_id)
+            return needed
+
+    # Add a connect to the next batch, connects are loaded together to handle reconnect storms
+    def queue_device_connect(self, device_id, ip_addr):
+        batch = None
+        with self._connect_lock:
+            if self._backlog_start is None:
+                self._backlog_start = now_ms()
+                self._backlog_count = 0
+            self._pending_connects[device_id] = ip_addr
+            self._backlog_count += 1
+            if len(self._pending_connects) >= _CONNECT_BATCH_MAX:
+                if self._connect_batch_task:
+                    self._connect_batch_task.cancel()
+                batch = self.take_connect_batch()
+            elif not self._connect_batch_task:
+                self._connect_batch_task = self._timer.schedule(_CONNECT_BATCH_WINDOW, self.flush_connect_batch)
+        if batch:
+            self._connect_queue.submit(_CONNECT_LANE, self.run_connect_batch, batch)
+
+    # A device disconnected, drop it if it was still waiting in a batch
+    def cancel_device_connect(self, device_id):
+        with self._connect_lock:
+            self._online_devices.discard(device_id)
+            self._pending_connects.pop(device_id, None)
+
+    # Called inside the connect lock, take the pending batch
+    def take_connect_batch(self):
+        batch, self._pending_connects = self._pending_connects, {}
+        self._connect_batch_task = None
+        if batch:
+            self._connect_batches_queued += 1
+        return batch
+
+    # Called from timer when the batch window closes
+    def flush_connect_batch(self):
+        with self._connect_lock:
+            batch = self.take_connect_batch()
+        if batch:
+            self._connect_queue.submit(_CONNECT_LANE, self.run_connect_batch, batch)
+
+    # NOTE: Called from worker thread pool, loads a batch and reports when the backlog is drained
+    def run_connect_batch(self, batch):
+        try:
+            self.on_devices_connect(batch)
+        finally:
+            with self._connect_lock:
+                self._connect_batches_queued -= 1
+                drained = not self._connect_batches_queued and not self._pending_connects and self._backlog_start is not None
+                if drained:
+                    self._connect_metrics['last_backlog'] = self._backlog_count
+                    self._connect_metrics['last_drain_ms'] = now_ms() - self._backlog_start
+                    self._backlog_start = None
+            if drained:
+                logger.info(f"Connect backlog drained, {self._connect_metrics['last_backlog']} devices in {self._connect_metrics['last_drain_ms']}ms")
+
+    # Check if this server instance is the shard that handles a device
+    def owns_device(self, device_id):
+        if self._shard_count <= 1:
+            return True
+        # crc32 rather than hash(), as it must agree across processes
+        return zlib.crc32(device_id.encode('utf-8')) % self._shard_count == self._shard_index
+
+    # Handle requests forwarded from other shards
+    def on_shard_control(self, cmd):
+        device_id = cmd.get('device_id')
+        if device_id and not self.owns_device(device_id):
+            return
+        logger.debug(f'Rx shard control {cmd}')
+        if cmd.get('command') == 'reload':
+            if cmd.get('shard') != self._shard_index:
+                self._worker_queue.submit('shard_control', self.update_from_database, broadcast=False)
+        elif cmd.get('command') == 'config_updated':
+            self._worker_queue.submit(device_id, self.refresh_device_config, device_id)
+        elif cmd.get('command') == 'schedule_updated':
+            if cmd.get('shard') != self._shard_index:
+                self._worker_queue.submit('shard_control', self._robot_data.refresh_schedule, cmd.get('schedule'))
+        elif cmd.get('command') == 'mbh_updated':
+            self.handle_mbh_updated(device_id)
+        elif cmd.get('command') == 'query':
+            if cmd.get('shard') != self._shard_index:
+                self.answer_shard_query(cmd)
+        elif cmd.get('command') == 'query_result':
+            if cmd.get('to') == self._shard_index:
+                self.on_shard_query_result(cmd)
+
+    # Forward a request to other shards
+    def send_shard_control(self, command, device_id=None, **fields):
+        cmd = { 'command': command, 'shard': self._shard_index, **fields }
+        if device_id:
+            cmd['device_id'] = device_id
+        self._client.publish(_SHARD_CONTROL_TOPIC, payload=json.dumps(cmd))
+
+    # Ask other shards about the devices they hold and wait for the answers.  A query for a device
+    # is answered by the shard that owns it, otherwise every other shard answers.  Returns the
+    # results that arrived in time.  Never call this from the MQTT thread, answers arrive there.
+    def query_shards(self, query, device_id=None):
+        pending = { 'event': threading.Event(), 'results': [], 'expected': 1 if device_id else self._shard_count - 1 }
+        with self._shard_query_lock:
+            self._shard_query_seq += 1
+            query_id = self._shard_query_seq
+            self._shard_queries[query_id] = pending
+        try:
+            self.send_shard_control('query', device_id, query=query, query_id=query_id)
+            if not pending['event'].wait(_SHARD_QUERY_TIMEOUT):
+                logger.warning(f'Shard query {query} got {len(pending["results"])} of {pending["expected"]} answers')
+            with self._shard_query_lock:
+                return list(pending['results'])
+        finally:
+            with self._shard_query_lock:
+                self._shard_queries.pop(query_id, None)
+
+    # Answer a query from another shard, from the state we hold in memory
+    def answer_shard_query(self, cmd):
+        query = cmd.get('query')
+        device_id = cmd.get('device_id')
+        if query == 'connected':
+            result = self._robot_data.connected_list()
+        elif query == 'device_state':
+            result = { 'online': self._robot_data.device_online(device_id), 'puppet_state': self._robot_data.get_puppet_state(device_id) }
+        elif query == 'wakeup':
+            result = self.send_wakeup_to_bot(device_id)
+        elif query == 'flush_mbh':
+            # database work, so it runs in the device's lane after any reports already queued there
+            self._worker_queue.submit(device_id, self.answer_flush_mbh, cmd)
+            return
+        else:
+            logger.warning(f'Unknown shard query {query}')
+            return
+        self.send_shard_control('query_result', to=cmd.get('shard'), query_id=cmd.get('query_id'), result=result)
+
+    # NOTE: Called from worker thread pool, flush queued mentor behaviors for another shard
+    def answer_flush_mbh(self, cmd):
+        self._robot_data.flush_mbh(cmd.get('device_id'))
+        self.send_shard_control('query_result', to=cmd.get('shard'), query_id=cmd.get('query_id'), result=True)
+
+    def on_shard_query_result(self, cmd):
+        with self._shard_query_lock:
+            pending = self._shard_queries.get(cmd.get('query_id'))
+            if not pending:
+                # too late, the caller gave up waiting
+                return
+            pending['results'].append(cmd.get('result'))
+            if len(pending['results']) >= pending['expected']:
+                pending['event'].set()
+
+    # Devices connected to any shard
+    def connected_list(self):
+        live = self._robot_data.connected_list()
+        if self._shard_count > 1:
+            for result in self.query_shards('connected'):
+                live.extend(result)
+        return live
+
+    # Check if a device is online, from whichever shard owns it
+    def device_online(self, device_id):
+        return self.get_device_state(device_id)['online']
+
+    # Online and puppet state for a device, from whichever shard owns it
+    def get_device_state(self, device_id):
+        if self.owns_device(device_id):
+            return { 'online': self._robot_data.device_online(device_id), 'puppet_state': self._robot_data.get_puppet_state(device_id) }
+        results = self.query_shards('device_state', device_id)
+        return results[0] if results else { 'online': False, 'puppet_state': None }
+
+    # Write any queued mentor behaviors for a device, on whichever shard owns it.  Returns False
+    # if the owning shard didn't answer in time.
+    def flush_mbh(self, device_id):
+        if self.owns_device(device_id):
+            self._robot_data.flush_mbh(device_id)
+            return True
+        return bool(self.query_shards('flush_mbh', device_id))
+
+    # A schedule was saved here, the other shards have live devices using it too
+    def on_schedule_changed(self, schedule_pk):
+        if self._shard_count > 1:
+            logger.info(f'Schedule {schedule_pk} updated, forwarding to other shards.')
+            self.send_shard_control('schedule_updated', schedule=schedule_pk)
+
+    # NOTE: Called from worker thread pool, for a device config changed by another shard
+    def refresh_device_config(self, device_id):
+        device = MoxieDevice.objects.filter(device_id=device_id).first()
+        if device:
+            self.handle_config_updated(device)
 
     # Handles metrics from mosquitto
     def on_client_metrics(self, basetype, msg):
@@ -185,12 +477,17 @@ class MoxieServer:
                     # SCHEDULE REQUEST - Robot asking what schedule to follow this session
                     logger.debug("Rx Schedule request.")
                     req_id = csa.get('request_id')
-                    self._worker_queue.submit(self.provide_schedule, req_id, device_id)
+                    self._worker_queue.submit(device_id, self.provide_schedule, req_id, device_id)
                 elif csa.get("query") == "mentor_behaviors":
                     # MENTOR BEHAVIOR REQUEST - Robot asking what user has done before
                     logger.debug("Rx MBH request.")
                     req_id = csa.get('request_id')
-                    self._worker_queue.submit(self.provide_mentor_behaviors, req_id, device_id)
+                    limit = query_bound(csa.get('limit'))
+                    since = query_bound(csa.get('since'))
+                    if limit is None and csa.get('limit') is not None or since is None and csa.get('since') is not None:
+                        logger.warning(f"Ignoring bad MBH query bounds from {device_id}: limit={csa.get('limit')!r} since={csa.get('since')!r}")
+                    self._worker_queue.submit(device_id, self.provide_mentor_behaviors, req_id, device_id,
+                                              limit=limit, since=since)
                 elif csa.get("query") == "license":
                     # ROBOT IS ASKING FOR ANY LICENSES IT CAN USE (e.g. google speech)
                     req_id = csa.get('request_id')
@@ -204,7 +501,7 @@ class MoxieServer:
                                                         })
             elif 'mentor_behavior' in csa:
                 # MENTOR BEHAVIOR REPORT - Robot informing what user has done
-                self._worker_queue.submit(self.ingest_mentor_behavior, device_id, csa['mentor_behavior'])
+                self._worker_queue.submit(device_id, self.ingest_mentor_behavior, device_id, csa['mentor_behavior'])
             elif csa.get("subtopic") == "telehealth":
                 # ROBOT TELEHEALTH INTERFACE
                 logger.info(f'Rx TELEHEALTH: {csa.get("message")}')
@@ -233,8 +530,10 @@ class MoxieServer:
 
     # NOTE: Called from worker thread pool
     def provide_schedule(self, req_id, device_id):
-        schedule = self._robot_data.get_schedule(device_id)
-        self.send_command_to_bot_json(device_id, 'query_result', { 'command': 'query_result', 'query': 'schedule', 'request_id': req_id, 'schedule': schedule} )
+        schedule = self._robot_data.get_schedule_payload(device_id)
+        # the schedule is already serialized, so splice it into the result
+        result = json.dumps({ 'command': 'query_result', 'query': 'schedule', 'request_id': req_id })
+        self.send_command_to_bot_raw(device_id, 'query_result', result[:-1].encode('utf-8') + b', "schedule": ' + schedule + b'}')
 
     # NOTE: Called from worker thread pool
     def ingest_mentor_behavior(self, device_id, mbh):
@@ -244,66 +543,138 @@ class MoxieServer:
     def ingest_robot_state(self, device_id, statedata):
         self._robot_data.put_state(device_id, statedata)
 
-    # NOTE: Called from worker thread pool
-    def provide_mentor_behaviors(self, req_id, device_id):
-        mbh = self._robot_data.get_mbh(device_id)
+    # NOTE: Called from worker thread pool, limit and since bound the reply for robots with long histories
+    def provide_mentor_behaviors(self, req_id, device_id, limit=None, since=None):
+        mbh = self._robot_data.get_mbh(device_id, limit=limit, since=since)
         logger.info(f'Providing {len(mbh)} MBH records to {device_id}')
-        self.send_command_to_bot_json(device_id, 'query_result', { 'command': 'query_result', 'query': 'mentor_behaviors', 'request_id': req_id, 'mentor_behaviors': mbh} )
+        result = { 'command': 'query_result', 'query': 'mentor_behaviors', 'request_id': req_id, 'mentor_behaviors': mbh}
+        if limit is not None or since is not None:
+            # newest timestamp provided, to pass as since next time
+            result['cursor'] = mbh[0]['timestamp'] if mbh else since
+        self.send_command_to_bot_json(device_id, 'query_result', result)
+
+    # Mentor behaviors for a device were changed outside of robot reports, drop any cached copy
+    def handle_mbh_updated(self, device_id):
+        if not self.owns_device(device_id):
+            self.send_shard_control('mbh_updated', device_id)
+            return
+        self._worker_queue.submit(device_id, self._robot_data.invalidate_mbh, device_id)
 
     # NOTE: Called from worker thread pool
     def on_device_connect(self, device_id, connected, ip_addr=None):
         if connected:
-            logger.info(f'Moxie CONNECTED {device_id} from {ip_addr}')
-            self._robot_data.db_connect(device_id)
-            # Sleep to avoid sending sub/config before client is ready
-            time.sleep(1.0)
-            self.send_config_to_bot_json(device_id, self._robot_data.get_config(device_id))
-            # subscripe to ZMQ STT
-            sub = ProtoSubscribe()
-            sub.protos.append('embodied.perception.audio.zmqSTTRequest')
-            sub.timestamp = now_ms()
-            logger.debug(f'Subscribed to ZMQ STT')
-            self.send_zmq_to_bot(device_id, sub)
+            self.on_devices_connect({ device_id: ip_addr })
         else:
             self._robot_data.db_release(device_id)
+            self._worker_queue.forget(device_id)
+            self._connect_queue.forget(device_id)
+            self._remote_chat.forget_device(device_id)
+            for handler in self._zmq_handlers.values():
+                handler.forget_device(device_id)
             logger.info(f'Moxie DISCONNECTED {device_id}')
 
+    # NOTE: Called from worker thread pool, load a batch of connected devices, map of device_id to ip
+    def on_devices_connect(self, batch):
+        loaded = self._robot_data.db_connect_bulk(list(batch.keys()))
+        for device_id in loaded:
+            logger.info(f'Moxie CONNECTED {device_id} from {batch[device_id]}')
+        # Delay to avoid sending sub/config before client is ready, without holding a worker, and
+        # rate limited so a storm of connects doesn't turn into a storm of config pushes
+        with self._connect_lock:
+            earliest = time.monotonic() + _CONNECT_CONFIG_DELAY
+            for device_id in loaded:
+                push_at = max(earliest, self._next_config_push)
+                self._next_config_push = push_at + 1.0 / _CONFIG_PUSH_RATE
+                self._timer.schedule(push_at - time.monotonic(), self._connect_queue.submit, device_id, self.send_connect_config, device_id)
+
+    # NOTE: Called from worker thread pool, a short time after a device connects
+    def send_connect_config(self, device_id):
+        if not self._robot_data.device_online(device_id):
+            logger.debug(f'Device {device_id} went offline before config was sent')
+            return
+        # usually the retained config is current, and the broker already delivered it
+        self.send_config_payload(device_id, *self._robot_data.get_config_payload(device_id))
+        # subscripe to ZMQ STT
+        sub = ProtoSubscribe()
+        sub.protos.append('embodied.perception.audio.zmqSTTRequest')
+        sub.timestamp = now_ms()
+        logger.debug(f'Subscribed to ZMQ STT')
+        self.send_zmq_to_bot(device_id, sub)
+
     # Fallback, we missed the connect message but robot is connected
     def check_device_connect(self, device_id, info="Missing"):
-        if self._robot_data.connect_init_needed(device_id):
+        if self.mark_device_online(device_id):
             logger.info(f"Unconnected robot {device_id} location {info}.  Connecting now.")
-            self._worker_queue.submit(self.on_device_connect, device_id, True, info)
+            self.queue_device_connect(device_id, info)
 
     # Moxie reporting its own state information
     def on_device_state(self, device_id, msg):
         logger.debug(f"Rx STATE topic for device {device_id}")
         self.check_device_connect(device_id, "State")
-        self._worker_queue.submit(self.ingest_robot_state, device_id, json.loads(msg.payload))
+        self._worker_queue.submit(device_id, self.ingest_robot_state, device_id, json.loads(msg.payload))
 
     # Callback when a moxie config has changed and may need to be provided
     def handle_config_updated(self, device):
+        if not self.owns_device(device.device_id):
+            logger.info(f'Moxie device {device.device_id} updated, forwarding to owning shard.')
+            self.send_shard_control('config_updated', device.device_id)
+            return
         # Update if connected
         if self._robot_data.config_update_live(device):
             logger.info(f'Moxie device {device.device_id} updated, sending updated config.')
-            self.send_config_to_bot_json(device.device_id, self._robot_data.get_config(device.device_id))
+            self.send_config_payload(device.device_id, *self._robot_data.get_config_payload(device.device_id))
         else:
-            logger.info(f'Moxie device {device.device_id} updated, but device offline')
+            # retained, so it will be waiting when the device connects
+            logger.info(f'Moxie device {device.device_id} updated, device offline, updating retained config')
+            self.send_config_payload(device.device_id, *self._robot_data.get_config_payload_for_device(device))
+
+    # NOTE: Called from worker thread pool, update the retained configs for all our devices
+    def refresh_retained_configs(self):
+        updated = 0
+        for device in MoxieDevice.objects.all():
+            if not self.owns_device(device.device_id):
+                continue
+            if self._robot_data.config_update_live(device):
+                data, digest = self._robot_data.get_config_payload(device.device_id)
+            else:
+                data, digest = self._robot_data.get_config_payload_for_device(device)
+            if self.send_config_payload(device.device_id, data, digest):
+                updated += 1
+        logger.info(f'Refreshed retained configs, {updated} changed')
 
     # For Robots using wake_button_enabled, wake them from screen off
     def send_wakeup_to_bot(self, device_id):
+        if not self.owns_device(device_id):
+            # owning shard knows if it is online, it sends the wakeup and tells us if it did
+            results = self.query_shards('wakeup', device_id)
+            return bool(results and results[0])
         if self._robot_data.device_online(device_id):
             self.send_command_to_bot_json(device_id, 'wakeup', {'command': 'wakeup'})
             return True
         return False
 
-    # Send Moxie its configuration data
-    def send_config_to_bot_json(self, device_id, payload: dict):
-        self._client.publish(f"/devices/{device_id}/config", payload=json.dumps(payload))
+    # Send Moxie its configuration data as a retained message
+    def send_config_to_bot_json(self, device_id, payload: dict, only_changed=False):
+        return self.send_config_payload(device_id, *encode_config(payload), only_changed=only_changed)
+
+    # Send Moxie a serialized config as a retained message, by default only if its hash differs
+    # from what is already retained.  Returns True if it was published.
+    def send_config_payload(self, device_id, data: bytes, digest: str, only_changed=True):
+        if only_changed and self._retained_configs.get(device_id) == digest:
+            logger.debug(f'Retained config for {device_id} is current')
+            return False
+        self._retained_configs[device_id] = digest
+        self._client.publish(f"/devices/{device_id}/config", payload=data, retain=True)
+        return True
 
     # Send a Command (JSON) to Moxie
     def send_command_to_bot_json(self, device_id, command, payload: dict):
         self._client.publish(f"/devices/{device_id}/commands/{command}", payload=json.dumps(payload))
 
+    # Send Moxie a command payload that is already serialized
+    def send_command_to_bot_raw(self, device_id, command, payload: bytes):
+        self._client.publish(f"/devices/{device_id}/commands/{command}", payload=payload)
+
     # Send a binary ZMQ message to Moxie
     def send_zmq_to_bot(self, device_id, msgobject):
         payload = (msgobject.DESCRIPTOR.full_name + ":").encode('utf-8') + msgobject.SerializeToString()
@@ -341,14 +712,44 @@ class MoxieServer:
     # Print out client metrics, called periodically in the background
     def print_metrics(self):
         logger.info(f"Client Metrics: {self._client_metrics}")
+        if self._transport:
+            logger.info(f"Transport Metrics: pending={self._transport.pending()} read_pauses={self._transport.read_pauses}")
+        logger.info(f"Timer Metrics: pending={self._timer.pending()}")
+        logger.info(f"Connect Metrics: pending={len(self._pending_connects)} {self._connect_metrics}")
+        for wm in self.worker_metrics():
+            backlog = { k: v for k, v in wm['devices'].items() if v['depth'] }
+            logger.info(f"Worker Metrics [{wm['name']}]: queued={wm['queued']} active={wm['active']} backlog={backlog}")
+        for wm in self._robot_data.write_metrics():
+            logger.info(f"Write Metrics: {wm}")
+        logger.info(f"Chat Usage Metrics: {self._remote_chat.usage_metrics()}")
+        logger.info(f"Chat Session Metrics: {self._remote_chat.session_metrics()}")
+        for call, lm in gateway_metrics().items():
+            logger.info(f"LLM Metrics [{call}]: {lm}")
+        for call, lm in local_gateway_metrics().items():
+            logger.info(f"Local LLM Metrics [{call}]: {lm}")
+
+    # Per-device queue depth and wait times for all worker queues
+    def worker_metrics(self):
+        metrics = [ self._worker_queue.metrics(), self._connect_queue.metrics(), self._remote_chat.worker_metrics() ]
+        for handler in self._zmq_handlers.values():
+            hm = handler.worker_metrics()
+            if hm:
+                metrics.append(hm)
+        return metrics
 
     # Start client connection loop
     def start(self):
-        self._client.loop_start()
+        if self._transport:
+            self._transport.start()
+        else:
+            self._client.loop_start()
 
     # Stop client connection loop
     def stop(self):
-        self._client.loop_stop()
+        if self._transport:
+            self._transport.stop()
+        else:
+            self._client.loop_stop()
 
     # Get's a chat session object for use in the web chat
     def get_web_session_for_module(self, device_id, module_id, content_id):
@@ -356,6 +757,10 @@ class MoxieServer:
         sess.set_auto_history(True)
         return sess
     
+    # Save a web chat session after a volley, if sessions are kept in a shared store
+    def save_web_session(self, device_id):
+        self._remote_chat.save_session(device_id)
+
     # Check global commands for interactive web
     def get_web_session_global_response(self, speech):
         return self._remote_chat.get_web_session_global_response(speech)
@@ -368,16 +773,29 @@ class MoxieServer:
     def robot_data(self):
         return self._robot_data
 
-    # Reload records from the database
-    def update_from_database(self):
-        hive_config = HiveConfiguration.objects.filter(name="default").first()
+    # Reload records from the database, and tell any other shards to do the same
+    def update_from_database(self, broadcast=True):
+        if not broadcast:
+            # saved by another shard process, so our save signal never saw it
+            reload_hive_config()
+        self._remote_chat.update_from_database()
+        if broadcast and self._shard_count > 1:
+            self.send_shard_control('reload')
+
+    # Hive config changed, from a save in this process or a reload, update everything derived from it
+    def on_hive_config_changed(self, hive_config):
         set_openai_key(hive_config.openai_api_key if hive_config else None)
         self._google_service_account = hive_config.google_api_key if hive_config else None
-        self._remote_chat.update_from_database()
+        # Shared config changes apply to every device, so refresh the retained configs
+        snapshot = (hive_config.common_config, hive_config.common_settings) if hive_config else None
+        if self._hive_config_loaded and snapshot != self._hive_config_snapshot:
+            self._worker_queue.submit('retained_config', self.refresh_retained_configs)
+        self._hive_config_snapshot = snapshot
+        self._hive_config_loaded = True
 
     # Get the endppint / moxie relocate QR code to move a Moxie to this service
     def get_endpoint_qr_data(self):
-        hiveconfig = HiveConfiguration.objects.filter(name="default").first()
+        hiveconfig = get_hive_config()
         scfg = ServiceConfiguration2()
         scfg.gcp_project = self._mqtt_project_id
         scfg.mqtt_host = hiveconfig.external_host if hiveconfig and hiveconfig.external_host else self._mqtt_endpoint
@@ -406,6 +824,8 @@ def cleanup_instance():
     global _MOXIE_SERVICE_INSTANCE
     if _MOXIE_SERVICE_INSTANCE:
         _MOXIE_SERVICE_INSTANCE._client.disconnect()
+        _MOXIE_SERVICE_INSTANCE.robot_data().shutdown()
+        _MOXIE_SERVICE_INSTANCE.remote_chat().shutdown()
         _MOXIE_SERVICE_INSTANCE = None
 
 # Instance method, accessor
@@ -413,13 +833,13 @@ def get_instance():
     global _MOXIE_SERVICE_INSTANCE
     return _MOXIE_SERVICE_INSTANCE
 
-# Instance method, create singleton service
-def create_service_instance(project_id, host, port, cert_required=True):
+# Instance method, create singleton service, optionally as one shard of several server processes
+def create_service_instance(project_id, host, port, cert_required=True, shard_index=0, shard_count=1, transport='thread'):
     global _MOXIE_SERVICE_INSTANCE
     if not _MOXIE_SERVICE_INSTANCE:
         creds = RobotCredentials(True)
         rbdata = RobotData()
-        _MOXIE_SERVICE_INSTANCE = MoxieServer(creds, rbdata, project_id, host, port, cert_required)
+        _MOXIE_SERVICE_INSTANCE = MoxieServer(creds, rbdata, project_id, host, port, cert_required, shard_index=shard_index, shard_count=shard_count, transport=transport)
         _MOXIE_SERVICE_INSTANCE.add_zmq_handler('embodied.perception.audio.zmqSTTRequest', STTHandler(_MOXIE_SERVICE_INSTANCE))
         _MOXIE_SERVICE_INSTANCE.connect(start=True)
     
@@ -10,5 +10,13 @@ class ZMQHandler:
     def handle_zmq(self, device_id, protoname, protodata):
         print(f'ZMQ Handler RX: {protoname}')
 
+    # Handlers with their own worker queue report its metrics here
+    def worker_metrics(self):
+        return None
+
+    # Drop anything kept per device, for a device that disconnected
+    def forget_device(self, device_id):
+        pass
+
     def zmq_reply(self, device_id, proto):
         self._server.send_zmq_to_bot(device_id, proto)
@@ -0,0 +1,62 @@
+'''
+PROMPT TEMPLATE - Conversation prompts, classified when loaded so rendering is cheap
+
+Most prompts are plain text, yet every volley used to render them through the template engine.
+A PromptTemplate looks at the template tokens once.  A prompt without any tags is static and
+always gives the same pre-built system message.  A dynamic prompt is compiled once, and each
+render builds a context holding only the names the template refers to.
+
+Render time is logged at DEBUG level.
+'''
+import logging
+import re
+import time
+from django.template import Template, Context
+from django.template.base import Lexer, TokenType
+
+# Names in tag and variable tokens, not preceded by a dot so attribute lookups are skipped
+_NAME_PATTERN = re.compile(r'(?<![\w.])[A-Za-z_]\w*')
+
+logger = logging.getLogger(__name__)
+
+class PromptTemplate:
+    def __init__(self, source):
+        self._source = source
+        tokens = Lexer(source).tokenize()
+        self._static = all(t.token_type == TokenType.TEXT for t in tokens)
+        if self._static:
+            self._template = None
+            self._names = frozenset()
+            # shared by every volley, treat as read-only
+            self._static_context = [ { "role": "system", "content": source } ]
+        else:
+            self._template = Template(source)
+            # every identifier is a superset of the context names used, which is all we need
+            self._names = frozenset(name for t in tokens if t.token_type in (TokenType.VAR, TokenType.BLOCK)
+                                    for name in _NAME_PATTERN.findall(t.contents))
+            self._static_context = None
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def static(self):
+        return self._static
+
+    # Render the prompt text, values are the names available to the template
+    def render(self, **values):
+        if self._static:
+            return self._source
+        return self._template.render(Context({ k: v for k, v in values.items() if k in self._names }))
+
+    # The prompt as the system message list for inference
+    def system_context(self, **values):
+        if self._static:
+            return self._static_context
+        if not logger.isEnabledFor(logging.DEBUG):
+            return [ { "role": "system", "content": self.render(**values) } ]
+        start = time.perf_counter()
+        ctx = [ { "role": "system", "content": self.render(**values) } ]
+        logger.debug(f'Rendered prompt in {(time.perf_counter() - start) * 1000:.3f}ms using {sorted(self._names & values.keys())}')
+        return ctx
@@ -6,17 +6,26 @@ pertinent data from the database when robots connect, and unload them when
 they disconnect, and provide various APIs to access data like schedule, config,
 and state.
 '''
+import copy
 import json
+import hashlib
 import logging
+import threading
+import time
 import deepmerge
+from datetime import date
 from django.db import connections
 from django.db import transaction
-from ..models import HiveConfiguration, MoxieDevice, MoxieSchedule, MentorBehavior, PersistentData
+from django.db.models.signals import post_save, post_delete
+from ..models import MoxieDevice, MoxieSchedule, MentorBehavior, PersistentData
 from django.conf import settings
 from django.forms.models import model_to_dict
 from django.utils import timezone
-from .scheduler import expand_schedule
+from .completions import add_completions_atomic, count_completions, load_completions
+from .hive_config import hive_config_snapshot
+from .scheduler import expand_schedule, ftue_remove
 from .util import run_db_atomic, now_ms
+from .write_behind import MentorBehaviorWriteBehind, StateWriteBehind
 
 logger = logging.getLogger(__name__)
 
@@ -62,10 +71,38 @@ DEFAULT_COMBINED_CONFIG["settings"] = DEFAULT_ROBOT_SETTINGS
 
 DEFAULT_SCHEDULE = {}
 
+# How long an expanded schedule is reused for a device, settings.SCHEDULE_CACHE_SECONDS overrides
+_SCHEDULE_CACHE_SECONDS = 3600
+
+# Content hash of a serialized config, used to skip sending configs that haven't changed
+def config_digest(data: bytes):
+    return hashlib.sha1(data).hexdigest()
+
+# Serialize a config once, returns the bytes to publish and their hash
+def encode_config(cfg):
+    data = json.dumps(cfg).encode('utf-8')
+    return data, config_digest(data)
+
+DEFAULT_COMBINED_PAYLOAD = encode_config(DEFAULT_COMBINED_CONFIG)
+
 class RobotData:
     def __init__(self):
         global DEFAULT_SCHEDULE
         self._robot_map = {}
+        self._state_writer = StateWriteBehind()
+        self._mbh_writer = MentorBehaviorWriteBehind()
+        # Merged configs are cached, keyed on versions of their inputs, which signals bump on save
+        self._config_lock = threading.Lock()
+        self._device_versions = {}
+        self._config_cache = {}
+        post_save.connect(self.on_device_saved, sender=MoxieDevice, dispatch_uid='robot_data_device')
+        # Expanded schedules are cached per device, keyed in part on a version bumped when the schedule is saved
+        self._schedule_versions = {}
+        self._schedule_listeners = []
+        self._schedule_cache_seconds = getattr(settings, 'SCHEDULE_CACHE_SECONDS', _SCHEDULE_CACHE_SECONDS)
+        post_save.connect(self.on_schedule_saved, sender=MoxieSchedule, dispatch_uid='robot_data_schedule')
+        post_delete.connect(self.on_schedule_saved, sender=MoxieSchedule, dispatch_uid='robot_data_schedule_delete')
+        post_delete.connect(self.on_device_saved, sender=MoxieDevice, dispatch_uid='robot_data_device_delete')
         db_default = MoxieSchedule.objects.filter(name="default").first()
         if db_default:
             logger.info("Using 'default' schedule from database as schedule fallback")
@@ -87,16 +124,22 @@ class RobotData:
     def db_release(self, robot_id):
         if robot_id in self._robot_map:
             logger.info(f'Releasing device data for {robot_id}')
+            # make sure the last state is written before we let go
+            self._state_writer.flush(robot_id)
+            self._state_writer.forget(robot_id)
+            self._mbh_writer.flush(robot_id)
+            self._mbh_writer.forget(robot_id)
             run_db_atomic(self.release_to_db, robot_id)
             del self._robot_map[robot_id]
 
-    # Check if init after connection for this bot is needed, and remember it so we only init once
-    def connect_init_needed(self, robot_id):
-        needed = robot_id not in self._robot_map
-        if needed:
-            # set an empty record, so we don't try again
-            self._robot_map[robot_id] = {}
-        return needed
+    # Write anything buffered, called on shutdown
+    def shutdown(self):
+        self._state_writer.shutdown()
+        self._mbh_writer.shutdown()
+
+    # Metrics for buffered database writes
+    def write_metrics(self):
+        return [ self._state_writer.metrics(), self._mbh_writer.metrics() ]
     
     # Check if a device is online
     def device_online(self, robot_id):
@@ -110,46 +153,73 @@ class RobotData:
     def build_config(self, device, hive_cfg):
         # Robot config is base config and settings merged with robot config and settings
         # NOTE: Uses copies of everything, to avoid altering db records when merging in settings
-        base_cfg = (hive_cfg.common_config if hive_cfg and hive_cfg.common_config else DEFAULT_ROBOT_CONFIG).copy()
-        base_cfg["settings"] = hive_cfg.common_settings if hive_cfg and hive_cfg.common_settings else DEFAULT_ROBOT_SETTINGS
+        # Deep copies, since the hive config record is cached and shared by every device
+        base_cfg = copy.deepcopy(hive_cfg.common_config if hive_cfg and hive_cfg.common_config else DEFAULT_ROBOT_CONFIG)
+        base_cfg["settings"] = copy.deepcopy(hive_cfg.common_settings if hive_cfg and hive_cfg.common_settings else DEFAULT_ROBOT_SETTINGS)
         robot_cfg = device.robot_config.copy() if device.robot_config else {}
         robot_cfg["settings"] = device.robot_settings if device.robot_settings else {}
         return deepmerge.always_merger.merge(base_cfg, robot_cfg)
 
     # Load/create records for a Robot
     def init_from_db(self, robot_id):
-        device, created = MoxieDevice.objects.get_or_create(device_id=robot_id)
-        curr_cfg = HiveConfiguration.objects.filter(name='default').first()
-        device.last_connect = timezone.now()
-        if created:
-            logger.info(f'Created new model for this device {robot_id}')
-            schedule = MoxieSchedule.objects.get(name='default')
+        self.init_from_db_bulk([robot_id])
+
+    # Load/create records for a set of Robots, using a fixed number of queries regardless of count
+    def init_from_db_bulk(self, robot_ids):
+        devices = {}
+        # device_id isn't unique in the schema, if two records were ever made use the first one
+        for d in MoxieDevice.objects.filter(device_id__in=robot_ids).select_related('schedule').order_by('pk'):
+            devices.setdefault(d.device_id, d)
+        missing = [ rid for rid in robot_ids if rid not in devices ]
+        if missing:
+            schedule = MoxieSchedule.objects.filter(name='default').first()
             if schedule:
-                logger.info(f'Setting schedule to {schedule}')
-                device.schedule = schedule
-                self._robot_map[robot_id] = { "schedule": schedule.schedule }
+                logger.info(f'Setting schedule to {schedule} for {len(missing)} new devices')
             else:
                 logger.warning('Failed to locate default schedule.')
-        else:
-            logger.info(f'Existing model for this device {robot_id}')
-            self._robot_map[robot_id] = { "schedule": device.schedule.schedule if device.schedule else DEFAULT_SCHEDULE }
-        # build our config
-        self._robot_map[robot_id]["config"] = self.build_config(device, curr_cfg)
-        # load our robot's persistent data
-        persistent_data, persistent_data_created = PersistentData.objects.get_or_create(device=device, defaults={'data': {}})
-        self._robot_map[robot_id]["persistent_data"] = persistent_data
-        device.save()
+            # another process may create some of them at the same time, so re-query and take the
+            # first record for each, which every process agrees on
+            MoxieDevice.objects.bulk_create([ MoxieDevice(device_id=rid, schedule=schedule) for rid in missing ], ignore_conflicts=True)
+            for d in MoxieDevice.objects.filter(device_id__in=missing).select_related('schedule').order_by('pk'):
+                if d.device_id not in devices:
+                    logger.info(f'Created new model for this device {d.device_id}')
+                    devices[d.device_id] = d
+        # load our robots' persistent data, creating any that are missing
+        pdata = { p.device_id: p for p in PersistentData.objects.filter(device__in=devices.values()) }
+        new_pdata = [ PersistentData(device=d, data={}) for d in devices.values() if d.pk not in pdata ]
+        if new_pdata:
+            PersistentData.objects.bulk_create(new_pdata, ignore_conflicts=True)
+            pdata.update({ p.device_id: p for p in PersistentData.objects.filter(device__in=[p.device for p in new_pdata]) })
+        completions = load_completions([ d.pk for d in devices.values() ])
+        ts = timezone.now()
+        for robot_id, device in devices.items():
+            device.last_connect = ts
+            self._mbh_writer.set_device_pk(robot_id, device.pk)
+            self._robot_map[robot_id] = { "schedule": device.schedule.schedule if device.schedule else DEFAULT_SCHEDULE,
+                                         "schedule_pk": device.schedule_id,
+                                         "persistent_data": pdata[device.pk],
+                                         "completions": completions[device.pk] }
+            self.set_config(robot_id, *self.get_cached_config(device))
+        MoxieDevice.objects.bulk_update(devices.values(), ['last_connect'])
+
+    # Called when a batch of Robots connect to the MQTT network from a worker thread
+    def db_connect_bulk(self, robot_ids):
+        # Skip any that are already loaded
+        load_ids = [ rid for rid in robot_ids if not self._robot_map.get(rid) ]
+        if load_ids:
+            logger.info(f'Devices LOADING: {load_ids}')
+            run_db_atomic(self.init_from_db_bulk, load_ids)
+        return load_ids
 
     # Finalize device record on disconnect
     def release_to_db(self, robot_id):
-        device = MoxieDevice.objects.get(device_id=robot_id)
-        if device:
-            device.last_disconnect = timezone.now()
-            device.save()
+        # may not exist yet if the device disconnected before it was loaded.  Only the one field, a
+        # full save would fire post_save and drop the device's cached config for nothing.
+        MoxieDevice.objects.filter(device_id=robot_id).update(last_disconnect=timezone.now())
         # save persistent data for the robot
         pdata = self._robot_map.get(robot_id, {}).get("persistent_data")
         if pdata:
-            pdata.save()
+            pdata.save(update_fields=['data'])
 
     # Get persist record, cached or from db
     def get_persist_for_device(self, device:MoxieDevice):
@@ -160,17 +230,66 @@ class RobotData:
             persistent_data, persistent_data_created = PersistentData.objects.get_or_create(device=device, defaults={'data': {}})
             return persistent_data.data
     
+    # Signal handler, a device record changed (or was removed) so its merged config is stale
+    def on_device_saved(self, sender, instance, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields and not {'robot_config', 'robot_settings'} & set(update_fields):
+            return
+        self.invalidate_device_config(instance.device_id)
+
+    # Drop the merged config for one device
+    def invalidate_device_config(self, robot_id):
+        with self._config_lock:
+            self._device_versions[robot_id] = self._device_versions.get(robot_id, 0) + 1
+            self._config_cache.pop(robot_id, None)
+
+    # Get the merged config and its payload for a device, only merging when the hive or device changed
+    def get_cached_config(self, device):
+        hive_version, hive_cfg = hive_config_snapshot()
+        with self._config_lock:
+            key = (hive_version, self._device_versions.get(device.device_id, 0))
+            entry = self._config_cache.get(device.device_id)
+            if entry and entry[0] == key:
+                return entry[1], entry[2]
+        cfg = self.build_config(device, hive_cfg)
+        payload = encode_config(cfg)
+        with self._config_lock:
+            # only keep it if the device didn't change while we were merging
+            if key[1] == self._device_versions.get(device.device_id, 0):
+                self._config_cache[device.device_id] = (key, cfg, payload)
+        return cfg, payload
+
     # Get the active configuration for a device from the database objects
     def get_config_for_device(self, device):
-        curr_cfg = HiveConfiguration.objects.filter(name='default').first()
-        return self.build_config(device, curr_cfg)
+        return self.get_cached_config(device)[0]
     
+    # Get the active configuration for a device, serialized and hashed, from the database objects
+    def get_config_payload_for_device(self, device):
+        return self.get_cached_config(device)[1]
+
+    # Cache a device config along with its serialized form and hash
+    def set_config(self, robot_id, cfg, payload=None):
+        rec = self._robot_map[robot_id]
+        rec["config"] = cfg
+        rec["config_payload"] = payload if payload else encode_config(cfg)
+
     # Update an active device config, and return if the device is connected and needs the config provided
     def config_update_live(self, device):
+        # the save may have happened in another process, where our signals didn't see it
+        self.invalidate_device_config(device.device_id)
         if self.device_online(device.device_id):
-            self._robot_map[device.device_id]["config"] = self.get_config_for_device(device)
+            self.set_config(device.device_id, *self.get_cached_config(device))
+            rec = self._robot_map[device.device_id]
+            if rec.get("schedule_pk") != device.schedule_id:
+                # device was moved to another schedule
+                rec["schedule"] = device.schedule.schedule if device.schedule else DEFAULT_SCHEDULE
+                rec["schedule_pk"] = device.schedule_id
             return True
         return False
+
+    # Get the cached serialized config and its hash for a robot
+    def get_config_payload(self, robot_id):
+        return self._robot_map.get(robot_id, {}).get("config_payload", DEFAULT_COMBINED_PAYLOAD)
     
     # Get the cached config record for a robot
     def get_config(self, robot_id):
@@ -190,13 +309,17 @@ class RobotData:
         data["persist"] = prec.data if prec else {}
         return data
 
-    # Save robot state data
+    # Save robot state data, the database write is buffered and coalesced
     def put_state(self, robot_id, state):
-        run_db_atomic(self.update_state_atomic, robot_id, state)
         rec = self._robot_map.get(robot_id)
         if rec:
+            prev = rec.get("state")
+            if prev and "battery_level" not in state and "battery_level" in prev:
+                # sometimes state is missing the battery key, use the previous one if it isnt included
+                state["battery_level"] = prev["battery_level"]
             # only add to a non-empty (initialized) record
             rec["state"] = state
+        self._state_writer.put(robot_id, state)
 
     def put_puppet_state(self, robot_id, state):
         rec = self._robot_map.get(robot_id)
@@ -208,37 +331,68 @@ class RobotData:
         rec = self._robot_map.get(robot_id)
         return rec.get("puppet_state") if rec else None
     
-    # Update the device record with the state data
-    def update_state_atomic(self, robot_id, state):
-        device = MoxieDevice.objects.get(device_id=robot_id)
-        if "battery_level" not in state and "battery_level" in device.state:
-            # sometimes state is missing the battery key, use the previous one if it isnt included
-            state["battery_level"] = device.state["battery_level"]
-        device.state = state
-        device.state_updated = timezone.now()
-        device.save()
-
-    # Get all the mentor behaviors for a specific robot, in most recent first order
-    def extract_mbh_atomic(self, robot_id):
+    # Get the mentor behaviors for a specific robot, in most recent first order, optionally only the
+    # most recent limit records and/or those newer than the since timestamp
+    def extract_mbh_atomic(self, robot_id, limit=None, since=None):
         device = MoxieDevice.objects.get(device_id=robot_id)
+        query = MentorBehavior.objects.filter(device=device).order_by('-timestamp')
+        if since is not None:
+            query = query.filter(timestamp__gt=since)
+        if limit is not None:
+            query = query[:limit]
         mbh_list = []
-        for mbh in MentorBehavior.objects.filter(device=device).order_by('-timestamp'):
+        for mbh in query:
             mbh_list.append(model_to_dict(mbh, exclude=['device', 'id']))
         return mbh_list
 
-    # Add a new mentor behavior for a robot, called inside a lock
-    def insert_mbh_atomic(self, robot_id, mbh):
-        device = MoxieDevice.objects.get(device_id=robot_id)
-        rec = MentorBehavior(device=device)
+    # Add a new mentor behavior, the database write is queued and batched with others
+    def add_mbh(self, robot_id, mbh):
+        if not isinstance(mbh.get('timestamp'), int):
+            # can't be stored or ordered, drop it before it reaches the cache or the database
+            logger.warning(f"Ignoring MBH record from {robot_id} with bad timestamp {mbh.get('timestamp')!r}")
+            return
+        rec = MentorBehavior()
         rec.__dict__.update(mbh)
-        rec.save()
+        self._mbh_writer.put(robot_id, rec)
+        counts = self._robot_map.get(robot_id, {}).get("completions")
+        if counts is not None and rec.action == "COMPLETED":
+            counts[rec.module_id or ''] = counts.get(rec.module_id or '', 0) + 1
+        cached = self._robot_map.get(robot_id, {}).get("mbh")
+        if cached is not None:
+            entry = model_to_dict(rec, exclude=['device', 'id'])
+            # almost always the newest, but keep most recent first order if not
+            pos = 0
+            while pos < len(cached) and cached[pos]['timestamp'] > entry['timestamp']:
+                pos += 1
+            cached.insert(pos, entry)
 
-    # Add a new mentor behavior
-    def add_mbh(self, robot_id, mbh):
-        run_db_atomic(self.insert_mbh_atomic, robot_id, mbh)
+    # Write any queued mentor behaviors for a robot, before reading or changing them in the database
+    def flush_mbh(self, robot_id):
+        self._mbh_writer.flush(robot_id)
+
+    # Drop the cached mentor behaviors for a robot, after they were changed outside of add_mbh
+    def invalidate_mbh(self, robot_id):
+        rec = self._robot_map.get(robot_id)
+        if rec:
+            rec.pop("mbh", None)
+            rec.pop("completions", None)
+
+    # Get the count of completed content by module for a robot, cached while it is online
+    def get_completions(self, robot_id):
+        rec = self._robot_map.get(robot_id)
+        if rec and "completions" in rec:
+            return rec["completions"]
+        # the summary is updated when queued behaviors are written
+        self.flush_mbh(robot_id)
+        device = MoxieDevice.objects.filter(device_id=robot_id).first()
+        counts = load_completions([device.pk])[device.pk] if device else {}
+        if rec:
+            rec["completions"] = counts
+        return counts
 
     # Add a set of completions for content IDs in a module
     def add_mbh_completion_bulk(self, robot_id, module_id, content_id_list):
+        self.flush_mbh(robot_id)
         device = MoxieDevice.objects.get(device_id=robot_id)
         last_mbh = MentorBehavior.objects.filter(device=device).order_by('-timestamp').first()
         inst_id = last_mbh.instance_id if last_mbh else 1
@@ -258,21 +412,84 @@ class RobotData:
             inst_id += 1
             rec_ts += 1
         MentorBehavior.objects.bulk_create(recs)
+        run_db_atomic(add_completions_atomic, count_completions(recs))
 
-    # Get mentor behaviors
-    def get_mbh(self, robot_id):
-        return run_db_atomic(self.extract_mbh_atomic, robot_id)
+    # Get mentor behaviors, most recent first, optionally bounded by count and/or timestamp
+    def get_mbh(self, robot_id, limit=None, since=None):
+        self.flush_mbh(robot_id)
+        rec = self._robot_map.get(robot_id)
+        if not rec:
+            # not online (or not loaded yet), so let the database do the filtering
+            return run_db_atomic(self.extract_mbh_atomic, robot_id, limit=limit, since=since)
+        cached = rec.get("mbh")
+        if cached is None:
+            # loaded on first request rather than at connect, many sessions never ask
+            cached = run_db_atomic(self.extract_mbh_atomic, robot_id)
+            rec["mbh"] = cached
+        end = len(cached)
+        if since is not None:
+            end = 0
+            while end < len(cached) and cached[end]['timestamp'] > since:
+                end += 1
+        if limit is not None:
+            end = min(end, limit)
+        return cached[:end]
 
     # Get the current schedule for the robot, typically expanded when including a generate block
     def get_schedule(self, robot_id, expand=True):
-        robot_rec = self._robot_map.get(robot_id, {})
-        s = robot_rec.get("schedule", DEFAULT_SCHEDULE)
         if expand:
-            # do any custom schedule automatic generation
-            s = expand_schedule(s, robot_id)
+            return self.get_expanded_schedule(robot_id)[0]
+        s = self._robot_map.get(robot_id, {}).get("schedule", DEFAULT_SCHEDULE)
         logger.debug(f'Providing schedule {s} to {robot_id}')
         return s
 
+    # Get the expanded schedule for a robot as JSON, ready to publish
+    def get_schedule_payload(self, robot_id):
+        return self.get_expanded_schedule(robot_id)[1]
+
+    # Expand the schedule for a robot, returning it and its JSON.  Online robots reuse the last one
+    # for the same schedule version, day and FTUE status, until the cache window runs out.
+    def get_expanded_schedule(self, robot_id):
+        robot_rec = self._robot_map.get(robot_id, {})
+        s = robot_rec.get("schedule", DEFAULT_SCHEDULE)
+        completions = self.get_completions(robot_id)
+        pk = robot_rec.get("schedule_pk")
+        key = (pk, self._schedule_versions.get(pk, 0), date.today(), tuple(ftue_remove(completions)))
+        cached = robot_rec.get("schedule_cache")
+        if cached and cached[0] == key and cached[1] > time.monotonic():
+            return cached[2], cached[3]
+        # do any custom schedule automatic generation
+        s = expand_schedule(s, robot_id, completions)
+        logger.debug(f'Providing schedule {s} to {robot_id}')
+        payload = json.dumps(s).encode('utf-8')
+        if robot_rec:
+            robot_rec["schedule_cache"] = (key, time.monotonic() + self._schedule_cache_seconds, s, payload)
+        return s, payload
+
+    # Register fn(schedule_pk) to be called after a schedule is saved or deleted in this process
+    def add_schedule_listener(self, fn):
+        self._schedule_listeners.append(fn)
+
+    # Signal handler, a schedule changed so live devices using it pick up the change
+    def on_schedule_saved(self, sender, instance, **kwargs):
+        deleted = kwargs.get('signal') is post_delete
+        self.apply_schedule(instance.pk, None if deleted else instance.schedule)
+        for fn in self._schedule_listeners:
+            # after commit, so anyone reloading it sees the new values
+            transaction.on_commit(lambda fn=fn: fn(instance.pk))
+
+    # Reload a schedule changed by another process
+    def refresh_schedule(self, pk):
+        schedule = MoxieSchedule.objects.filter(pk=pk).first()
+        self.apply_schedule(pk, schedule.schedule if schedule else None)
+
+    # Use new schedule data for live devices on a schedule, None if it was deleted
+    def apply_schedule(self, pk, schedule):
+        self._schedule_versions[pk] = self._schedule_versions.get(pk, 0) + 1
+        for rec in list(self._robot_map.values()):
+            if rec and rec.get("schedule_pk") == pk:
+                rec["schedule"] = DEFAULT_SCHEDULE if schedule is None else schedule
+
 
 if __name__ == "__main__":
     data = RobotData()
@@ -1,15 +1,30 @@
 import random
 import logging
-import numpy
-from .util import run_db_atomic
-from ..models import MoxieDevice,MentorBehavior
+from datetime import date
 from ..content.data import RECOMMENDABLE_MODULES, TNT_CIDS, SYSTEMSCHECK_CIDS
 
 logger = logging.getLogger(__name__)
 
+# Penalty score for a list of modules, lower is better
+def schedule_score(modules):
+    cat_map = {}
+    last_cat = None
+    score = 0
+    for module in modules:
+        cat = module.get('category', 'User')
+        if cat == last_cat:
+            score += 5 # penalty for two adjacent categories
+        if cat in cat_map:
+            cat_map[cat] += 1
+            score += 1 # penalty for dupe category
+        else:
+            cat_map[cat] = 1
+        last_cat = cat
+    return score
+
 '''
 Quick and dirty auto-scheduler; attempts to pick a random set of modules avoiding adjacencies
-and preferring a broad range of categories
+and preferring a broad range of categories.  Replaced by spread_select, kept for comparison.
 '''
 def ransac_select(modules, count):
     count = len(modules) if count > len(modules) else count
@@ -18,19 +33,7 @@ def ransac_select(modules, count):
 
     for i in range(20):
         random_list = random.sample(modules, len(modules))
-        cat_map = {}
-        last_cat = None
-        score = 0
-        for m in range(count):
-            cat = random_list[m].get('category', 'User')
-            if cat == last_cat:
-                score += 5 # penalty for two adjacent categories
-            if cat in cat_map:
-                cat_map[cat] += 1
-                score += 1 # penalty for dupe category
-            else:
-                cat_map[cat] = 1
-            last_cat = cat
+        score = schedule_score(random_list[:count])
         #logger.info(f'Run {i} - Score {score} - Best {best_score}')
         if score < best_score:
             best_score = score
@@ -38,6 +41,46 @@ def ransac_select(modules, count):
 
     return best_list
 
+'''
+Picks a random set of modules with the lowest possible score in one pass.  Categories take turns
+(in random order) supplying a module, which uses as many categories as possible and keeps their
+counts level.  Then the list is arranged by always placing the category with the most left that
+isn't the one just placed, which avoids adjacent categories whenever that is possible.
+'''
+def spread_select(modules, count, rng=random):
+    by_cat = {}
+    for module in modules:
+        by_cat.setdefault(module.get('category', 'User'), []).append(module)
+    cats = list(by_cat.keys())
+    rng.shuffle(cats)
+    # round robin over the categories until we have enough, then sample that many from each
+    take = dict.fromkeys(cats, 0)
+    remaining = min(count, len(modules))
+    while remaining > 0:
+        for cat in cats:
+            if remaining > 0 and take[cat] < len(by_cat[cat]):
+                take[cat] += 1
+                remaining -= 1
+    picked = { cat: rng.sample(by_cat[cat], take[cat]) for cat in cats }
+    # arrange, most remaining first, ties keep the random category order
+    result = []
+    last_cat = None
+    while True:
+        choices = [ cat for cat in cats if picked[cat] ]
+        if not choices:
+            break
+        best = max(choices, key=lambda cat: (cat != last_cat, len(picked[cat])))
+        result.append(picked[best].pop())
+        last_cat = best
+    return result
+
+# Random generator for a schedule, seeded per device and day when the schedule asks for a daily seed
+# so the same device gets the same schedule all day
+def schedule_rng(generate, device_id):
+    if generate.get('daily_seed'):
+        return random.Random(f'{device_id}:{date.today().isoformat()}')
+    return random.Random()
+
 # mix list2 elements into list1
 def distribute_elements(list2, list1):
     # swap lists so list2 is always larger
@@ -55,27 +98,23 @@ def distribute_elements(list2, list1):
 A bit hokey, but these "training" (first time user experience) modules have content IDs in order but
 the robot internal scheduler switches to a random cid once they exhaust, so they have to be removed
 or TNT and SYSTEMSCHECK will still be in every session.  WELCOME is also removed once you complete
-anything.
+anything.  Uses the device's completion counts by module_id.
 '''
-def ftue_remove(device_id):
+def ftue_remove(completions):
     purge_list = []
-    try:
-        if MentorBehavior.objects.filter(device__device_id=device_id, module_id="TNT", action="COMPLETED").count() >= TNT_CIDS:
-            purge_list.append("TNT")
-        if MentorBehavior.objects.filter(device__device_id=device_id, module_id="SYSTEMSCHECK", action="COMPLETED").count() >= SYSTEMSCHECK_CIDS:
-            purge_list.append("SYSTEMSCHECK")
-        if purge_list or MentorBehavior.objects.filter(device__device_id=device_id, action="COMPLETED").first():
-            purge_list.append("WELCOME")
-
-    except Exception as e:
-        logger.warning(f'Error checking FTUE completions {e}')
+    if completions.get("TNT", 0) >= TNT_CIDS:
+        purge_list.append("TNT")
+    if completions.get("SYSTEMSCHECK", 0) >= SYSTEMSCHECK_CIDS:
+        purge_list.append("SYSTEMSCHECK")
+    if purge_list or any(completions.values()):
+        purge_list.append("WELCOME")
     return purge_list
 
 '''
 Schedule Generation - generates a set of additional modules according to the generate key
 to make a random schedule for the session.
 '''
-def expand_schedule(schedule, device_id):
+def expand_schedule(schedule, device_id, completions):
     if 'generate' in schedule:
         logger.info("Using generative schedule")
         # Update schedule data with automatic stuff
@@ -87,18 +126,19 @@ def expand_schedule(schedule, device_id):
         provided = schedule.get('provided_schedule', [])
 
         # TNT and SYSTEMSCHECK have to be removed manually, as robot will keep playing something
-        ftue_remove_list = run_db_atomic(ftue_remove, device_id)
+        ftue_remove_list = ftue_remove(completions)
         if ftue_remove_list:
             provided = [item for item in provided if item.get('module_id') not in ftue_remove_list]
 
         # modules we can pick from, all recommmended unless excluded, plus any user defined extra modules
         auto_modules = [item for item in RECOMMENDABLE_MODULES if item['module_id'] not in excluded_module_ids]
         auto_modules.extend(extra_modules)
-        generated = ransac_select(auto_modules, module_count)
+        rng = schedule_rng(schedule['generate'], device_id)
+        generated = spread_select(auto_modules, module_count, rng)
 
         # insert some random chats
         if chat_count > 0 and len(chat_modules) > 0:
-            generated_chats = list(numpy.random.choice(chat_modules, size=chat_count, replace=True))
+            generated_chats = rng.choices(chat_modules, k=chat_count)
             generated = distribute_elements(generated, generated_chats)
 
         # make a copy, so we don't alter the original
@@ -0,0 +1,342 @@
+'''
+SESSION STORE - Bounded store for active chat sessions
+
+Robots keep one session while they are in a remote module, and every web chat page gets its
+own, so sessions can't simply be kept forever.  The store holds sessions in least recently used
+order and evicts them when idle past a TTL, when there are too many, or when their estimated
+memory goes over a limit.  Evicted sessions are handed to a callback, so their complete hook
+still runs.  Idle sessions are found as a side effect of using the store, at most once per
+sweep interval.
+
+Sessions may also be saved to a backend, so conversations survive a restart or move to another
+server process.  The memory backend saves nothing.  The SQLite backend keeps each session as
+zlib compressed JSON, written in batches on a background thread after the session changes, and
+loaded when a session we don't have in memory is first asked for.  With a saving backend, a
+session evicted for count or memory is only dropped from memory and reloaded when next used, it
+is only complete when idle past the TTL.  A device is served by one process at a time (shards
+partition devices by id), so the copy in memory is the current one while a process holds it.
+'''
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from .write_behind import WriteBehindBuffer
+from .util import now_ms
+
+_SQLITE_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+# Compact saved form of a session state, JSON text when saved and compressed when written
+def state_to_json(state):
+    return json.dumps(state, separators=(',', ':'))
+
+def compress_state(text):
+    return zlib.compress(text.encode('utf-8'))
+
+def decode_state(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+'''
+In-memory backend, sessions only live in the process that created them
+'''
+class SessionBackend:
+    persistent = False
+
+    # Get (id, state) for a key, or None
+    def load(self, key):
+        return None
+
+    # Write a batch, { key: (id, encoded state) }, a None value deletes the key
+    def write(self, batch):
+        pass
+
+    # Remove sessions not saved for max_age seconds, returns how many
+    def prune(self, max_age):
+        return 0
+
+'''
+SQLite file backend, shared by all server processes on the host
+'''
+class SQLiteSessionBackend(SessionBackend):
+    persistent = True
+
+    def __init__(self, path):
+        self._path = str(path)
+        self._local = threading.local()
+        self._conn().execute('CREATE TABLE IF NOT EXISTS chat_session (key TEXT PRIMARY KEY, module TEXT NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL)')
+
+    # One connection per thread, sqlite connections aren't shared between threads
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if not conn:
+            conn = sqlite3.connect(self._path, timeout=_SQLITE_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, key):
+        row = self._conn().execute('SELECT module, data FROM chat_session WHERE key = ?', (key,)).fetchone()
+        return (row[0], decode_state(row[1])) if row else None
+
+    def write(self, batch):
+        ts = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT OR REPLACE INTO chat_session (key, module, data, updated) VALUES (?, ?, ?, ?)',
+                             [ (key, rec[0], rec[1], ts) for key, rec in batch.items() if rec ])
+            conn.executemany('DELETE FROM chat_session WHERE key = ?', [ (key,) for key, rec in batch.items() if not rec ])
+
+    def prune(self, max_age):
+        conn = self._conn()
+        with conn:
+            return conn.execute('DELETE FROM chat_session WHERE updated < ?', (time.time() - max_age,)).rowcount
+
+# Make the backend for a CHAT_SESSION_STORE setting
+def make_session_backend(cfg):
+    backend = (cfg or {}).get('backend', 'memory')
+    if backend == 'sqlite':
+        return SQLiteSessionBackend(cfg['path'])
+    if backend != 'memory':
+        logger.warning(f'Unknown chat session backend {backend}, sessions kept in memory only')
+    return SessionBackend()
+
+'''
+Write-back for saved sessions.  Only the latest state for each key is kept, and a delete replaces
+any save not yet written, so a finished session isn't written back after it is removed.
+'''
+class SessionWriteBehind(WriteBehindBuffer):
+    def __init__(self, backend, flush_interval=1.0, flush_threshold=50):
+        self._backend = backend
+        self._pending = {}
+        self._written_count = 0
+        super().__init__('sessions', flush_interval, flush_threshold)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    # Queue the state (JSON text) to save for a key, or None to delete it
+    def put(self, key, id, text):
+        with self._cond:
+            self._pending[key] = (id, text) if text is not None else None
+            self.check_threshold()
+
+    # Check for a change not yet written, returns (found, (id, text) or None for a delete)
+    def pending(self, key):
+        with self._cond:
+            return key in self._pending, self._pending.get(key)
+
+    def flush(self):
+        with self._cond:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        start = now_ms()
+        encoded = { key: (rec[0], compress_state(rec[1])) if rec else None for key, rec in batch.items() }
+        try:
+            self._backend.write(encoded)
+        except Exception:
+            # put back anything that hasn't been replaced since, and try again later
+            with self._cond:
+                for key, rec in batch.items():
+                    self._pending.setdefault(key, rec)
+            raise
+        with self._cond:
+            self._written_count += len(batch)
+            self.record_flush(start)
+
+    def metrics(self):
+        m = super().metrics()
+        m.update({ 'written': self._written_count })
+        return m
+
+'''
+One session and which module/content it belongs to, with its last use and memory estimate
+'''
+class SessionEntry:
+    def __init__(self, id, session):
+        self.id = id
+        self.session = session
+        self.last_used = time.monotonic()
+        self.size = session.memory_estimate()
+
+'''
+Sessions by key (device id, or web chat token).  restore(id) makes a new session for a
+module/content id, used to bring back saved sessions.
+'''
+class SessionStore:
+    def __init__(self, on_evict=None, max_entries=2000, idle_ttl=3600, max_bytes=64*1024*1024, sweep_interval=60,
+                 backend=None, restore=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._on_evict = on_evict
+        self._max_entries = max_entries
+        self._idle_ttl = idle_ttl
+        self._max_bytes = max_bytes
+        self._sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._bytes = 0
+        self._evictions = { 'idle': 0, 'entries': 0, 'memory': 0 }
+        self._backend = backend if backend else SessionBackend()
+        self._restore = restore
+        self._loads = 0
+        self._writer = None
+        if self._backend.persistent:
+            # saved sessions nobody came back to are long finished
+            pruned = self._backend.prune(idle_ttl)
+            if pruned:
+                logger.info(f'Removed {pruned} expired saved chat sessions')
+            self._writer = SessionWriteBehind(self._backend)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    # Get the entry for a key, marking it as used, or None.  Saved sessions are loaded on first use.
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                entry.last_used = time.monotonic()
+                # history grows as the session is used, so keep the estimate current
+                size = entry.session.memory_estimate()
+                self._bytes += size - entry.size
+                entry.size = size
+        if not entry and self._writer:
+            entry = self._load(key)
+        self.maybe_sweep()
+        return entry
+
+    def _load(self, key):
+        try:
+            # anything still waiting to be written is newer than the saved copy
+            found, rec = self._writer.pending(key)
+            if found:
+                saved = (rec[0], json.loads(rec[1])) if rec else None
+            else:
+                saved = self._backend.load(key)
+            session = self._restore(saved[0]) if saved and self._restore else None
+            if not session:
+                return None
+            session.restore_state(saved[1])
+        except Exception:
+            logger.exception(f'Error loading saved chat session for {key}')
+            return None
+        with self._lock:
+            self._loads += 1
+            if key in self._entries:
+                # someone else loaded it first
+                return self._entries[key]
+        return self.put(key, saved[0], session, save=False)
+
+    # Look at an entry without counting it as a use
+    def peek(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    # Add or replace the session for a key, returns the new entry
+    def put(self, key, id, session, save=True):
+        entry = SessionEntry(id, session)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            evicted = self._evict_over_limits()
+        if save:
+            self.save(key)
+        self._notify(evicted)
+        self.maybe_sweep()
+        return entry
+
+    # Queue the current state of a session to be saved, call after it changes
+    def save(self, key):
+        if not self._writer:
+            return
+        entry = self.peek(key)
+        if entry:
+            self._save_entry(key, entry)
+
+    def _save_entry(self, key, entry):
+        try:
+            # serialized now, while the session isn't changing, compressed and written later
+            text = state_to_json(entry.session.get_state())
+        except (TypeError, ValueError) as e:
+            logger.warning(f'Chat session {entry.id} for {key} not saved, local_data is not serializable: {e}')
+            return
+        self._writer.put(key, entry.id, text)
+
+    # Remove and return the entry for a key, without calling the eviction callback
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._bytes -= entry.size
+        if self._writer:
+            self._writer.put(key, None, None)
+        return entry
+
+    # Evict least recently used entries until within the count and memory limits, inside the lock
+    def _evict_over_limits(self):
+        evicted = []
+        while len(self._entries) > 1 and (len(self._entries) > self._max_entries or self._bytes > self._max_bytes):
+            reason = 'entries' if len(self._entries) > self._max_entries else 'memory'
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._evictions[reason] += 1
+            evicted.append((key, entry, reason))
+        return evicted
+
+    def maybe_sweep(self):
+        if time.monotonic() >= self._next_sweep:
+            self.sweep()
+
+    # Evict everything idle for longer than the TTL
+    def sweep(self):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            self._next_sweep = now + self._sweep_interval
+            # oldest first, so stop at the first one still in use
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if now - entry.last_used < self._idle_ttl:
+                    break
+                del self._entries[key]
+                self._bytes -= entry.size
+                self._evictions['idle'] += 1
+                evicted.append((key, entry, 'idle'))
+        self._notify(evicted)
+
+    def _notify(self, evicted):
+        for key, entry, reason in evicted:
+            if self._writer and reason != 'idle':
+                # only out of memory, it comes back from the backend when next used
+                self._save_entry(key, entry)
+                continue
+            logger.info(f'Evicting chat session {entry.id} for {key}')
+            if self._writer:
+                self._writer.put(key, None, None)
+            if self._on_evict:
+                try:
+                    self._on_evict(key, entry.id, entry.session)
+                except Exception:
+                    logger.exception('Error handling evicted chat session')
+
+    # Write any sessions waiting to be saved, and stop the writer
+    def shutdown(self):
+        if self._writer:
+            self._writer.shutdown()
+
+    def metrics(self):
+        with self._lock:
+            m = { 'sessions': len(self._entries), 'bytes': self._bytes, 'evictions': dict(self._evictions), 'loads': self._loads }
+        if self._writer:
+            m['writer'] = self._writer.metrics()
+        return m
@@ -0,0 +1,285 @@
+'''
+WRITE BEHIND - Buffered database writes for high rate robot data
+
+Robots report some data far more often than anyone reads it from the database.  Rather than
+a transaction per message, these buffers hold pending writes in memory and a background
+thread flushes them in batches, on an interval or when enough writes are pending.
+'''
+import json
+import logging
+import threading
+from django.db import transaction
+from django.utils import timezone
+from ..models import MentorBehavior, MoxieDevice
+from .completions import add_completions_atomic, count_completions
+from .util import run_db_atomic, now_ms
+
+# Mentor behavior records are dropped after this many failed flushes, so a database outage
+# can't grow the queue forever
+_MBH_MAX_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+'''
+Base class for a write buffer with a background flush thread.  Subclasses provide pending_count()
+and flush(), which must take the pending records under the lock and write them outside of it.
+'''
+class WriteBehindBuffer:
+    def __init__(self, name, flush_interval, flush_threshold):
+        self._name = name
+        self._flush_interval = flush_interval
+        self._flush_threshold = flush_threshold
+        self._cond = threading.Condition()
+        self._running = True
+        self._flushes = 0
+        self._last_flush_ms = 0
+        self._thread = threading.Thread(target=self._run, name=f'{name}-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._running and self.pending_count() < self._flush_threshold:
+                    self._cond.wait(timeout=self._flush_interval)
+                running = self._running
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(f'Error flushing {self._name}')
+            if not running:
+                return
+
+    # Called inside the lock by subclasses, wake the flusher early if we have a full batch
+    def check_threshold(self):
+        if self.pending_count() >= self._flush_threshold:
+            self._cond.notify()
+
+    # Called by subclasses after a flush to keep stats
+    def record_flush(self, start_ms):
+        self._flushes += 1
+        self._last_flush_ms = now_ms() - start_ms
+
+    def pending_count(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def metrics(self):
+        return { 'name': self._name, 'pending': self.pending_count(), 'flushes': self._flushes, 'last_flush_ms': self._last_flush_ms }
+
+    # Stop the flush thread, after a final flush of anything pending
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+'''
+Coalescing buffer for robot state.  Only the latest state for each device is kept, and states
+identical to the last one written are skipped entirely.
+'''
+class StateWriteBehind(WriteBehindBuffer):
+    def __init__(self, flush_interval=5.0, flush_threshold=200):
+        self._pending = {}
+        self._written = {}
+        self._skipped = 0
+        self._written_count = 0
+        super().__init__('state', flush_interval, flush_threshold)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    # Queue the latest state for a device, replacing any state not yet written
+    def put(self, robot_id, state):
+        encoded = json.dumps(state, sort_keys=True)
+        with self._cond:
+            if robot_id not in self._pending and self._written.get(robot_id) == encoded:
+                self._skipped += 1
+                return
+            self._pending[robot_id] = (state, encoded)
+            self.check_threshold()
+
+    # Write pending states, for all devices or just one (on disconnect)
+    def flush(self, robot_id=None):
+        with self._cond:
+            if robot_id:
+                batch = { robot_id: self._pending.pop(robot_id) } if robot_id in self._pending else {}
+            else:
+                batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        start = now_ms()
+        try:
+            updated = run_db_atomic(self.write_atomic, batch)
+        except Exception:
+            # put back anything that hasn't been replaced by a newer state, and try again later
+            with self._cond:
+                for rid, rec in batch.items():
+                    self._pending.setdefault(rid, rec)
+            raise
+        with self._cond:
+            for rid in updated:
+                self._written[rid] = batch[rid][1]
+            self._written_count += len(updated)
+            self.record_flush(start)
+
+    # Update the device records with the state data, in one bulk update.  Returns the ids of the
+    # devices updated.
+    def write_atomic(self, batch):
+        devices = list(MoxieDevice.objects.filter(device_id__in=batch.keys()))
+        missing = batch.keys() - { device.device_id for device in devices }
+        if missing:
+            logger.warning(f'Dropping state for {len(missing)} unknown devices: {sorted(missing)}')
+        ts = timezone.now()
+        for device in devices:
+            state = batch[device.device_id][0]
+            if "battery_level" not in state and device.state and "battery_level" in device.state:
+                # sometimes state is missing the battery key, use the previous one if it isnt included
+                state["battery_level"] = device.state["battery_level"]
+            device.state = state
+            device.state_updated = ts
+        MoxieDevice.objects.bulk_update(devices, ['state', 'state_updated'])
+        return [ device.device_id for device in devices ]
+
+    # Drop the unchanged-check record for a device that has gone away
+    def forget(self, robot_id):
+        with self._cond:
+            self._written.pop(robot_id, None)
+
+    def metrics(self):
+        m = super().metrics()
+        m.update({ 'written': self._written_count, 'skipped': self._skipped })
+        return m
+
+'''
+Write queue for mentor behavior reports.  Records from all devices are collected and written
+with one bulk_create per flush, using a cache of device primary keys so no lookup is needed
+per record.  If the bulk insert fails, records are inserted one at a time and any that still
+fail are dropped, so one bad record from a robot can't hold up everyone else's.  A flush
+that fails outright is retried, up to _MBH_MAX_ATTEMPTS times for each record.  Lag is how
+long a record waited in the queue before it was written.
+'''
+class MentorBehaviorWriteBehind(WriteBehindBuffer):
+    def __init__(self, flush_interval=2.0, flush_threshold=100):
+        self._pending = {}
+        self._pending_count = 0
+        self._device_pks = {}
+        self._written_count = 0
+        self._dropped_count = 0
+        self._last_lag_ms = 0
+        self._max_lag_ms = 0
+        super().__init__('mbh', flush_interval, flush_threshold)
+
+    def pending_count(self):
+        return self._pending_count
+
+    # Remember the database id for a device, so writes don't need to look it up
+    def set_device_pk(self, robot_id, pk):
+        with self._cond:
+            self._device_pks[robot_id] = pk
+
+    # Queue an unsaved MentorBehavior record, its device is filled in when written
+    def put(self, robot_id, rec):
+        with self._cond:
+            self._pending.setdefault(robot_id, []).append((now_ms(), rec, 0))
+            self._pending_count += 1
+            self.check_threshold()
+
+    # Write pending records, for all devices or just one (on disconnect, or before reading them back)
+    def flush(self, robot_id=None):
+        with self._cond:
+            if robot_id:
+                batch = { robot_id: self._pending.pop(robot_id) } if robot_id in self._pending else {}
+            else:
+                batch, self._pending = self._pending, {}
+            count = sum(len(recs) for recs in batch.values())
+            self._pending_count -= count
+            pks = { rid: self._device_pks.get(rid) for rid in batch.keys() }
+        if not batch:
+            return
+        start = now_ms()
+        try:
+            dropped = run_db_atomic(self.write_atomic, batch, pks)
+        except Exception:
+            self.requeue(batch)
+            raise
+        lag = max(start - ts for recs in batch.values() for ts, rec, attempts in recs)
+        with self._cond:
+            self._written_count += count - dropped
+            self._dropped_count += dropped
+            self._last_lag_ms = lag
+            self._max_lag_ms = max(self._max_lag_ms, lag)
+            self.record_flush(start)
+
+    # Put a failed batch back in front of anything newer to try again later, dropping records
+    # that have failed too many times
+    def requeue(self, batch):
+        dropped = 0
+        with self._cond:
+            for rid, recs in batch.items():
+                retry = [ (ts, rec, attempts + 1) for ts, rec, attempts in recs if attempts + 1 < _MBH_MAX_ATTEMPTS ]
+                dropped += len(recs) - len(retry)
+                if retry:
+                    self._pending[rid] = retry + self._pending.get(rid, [])
+                    self._pending_count += len(retry)
+            self._dropped_count += dropped
+        if dropped:
+            logger.error(f'Dropping {dropped} MBH records after {_MBH_MAX_ATTEMPTS} failed writes')
+
+    # Insert all the records in one bulk create, looking up any devices we don't know yet, and
+    # update the completion summaries to match.  Returns how many records were dropped.
+    def write_atomic(self, batch, pks):
+        missing = [ rid for rid, pk in pks.items() if pk is None ]
+        if missing:
+            for device in MoxieDevice.objects.filter(device_id__in=missing):
+                pks[device.device_id] = device.pk
+        recs = []
+        dropped = 0
+        for rid, items in batch.items():
+            if pks.get(rid) is None:
+                logger.warning(f'Dropping {len(items)} MBH records for unknown device {rid}')
+                dropped += len(items)
+                continue
+            for ts, rec, attempts in items:
+                rec.device_id = pks[rid]
+                recs.append(rec)
+        try:
+            with transaction.atomic():
+                MentorBehavior.objects.bulk_create(recs)
+        except Exception as e:
+            logger.warning(f'Bulk insert of {len(recs)} MBH records failed, inserting one at a time: {e}')
+            recs, bad = self.write_each(recs)
+            dropped += bad
+        add_completions_atomic(count_completions(recs))
+        return dropped
+
+    # Insert records one at a time, dropping any that fail.  Returns the records written and the
+    # number dropped.
+    def write_each(self, recs):
+        written = []
+        for rec in recs:
+            # a failed bulk insert may have set ids on some of them
+            rec.pk = None
+            rec._state.adding = True
+            try:
+                with transaction.atomic():
+                    rec.save(force_insert=True)
+                written.append(rec)
+            except Exception as e:
+                logger.error(f'Dropping bad MBH record for device {rec.device_id}: {e}')
+        return written, len(recs) - len(written)
+
+    # Forget the cached id for a device that has gone away
+    def forget(self, robot_id):
+        with self._cond:
+            self._device_pks.pop(robot_id, None)
+
+    def metrics(self):
+        with self._cond:
+            ts = now_ms()
+            oldest = min((recs[0][0] for recs in self._pending.values()), default=ts)
+            m = super().metrics()
+            m.update({ 'written': self._written_count, 'dropped': self._dropped_count, 'last_lag_ms': self._last_lag_ms,
+                       'max_lag_ms': self._max_lag_ms, 'oldest_pending_ms': ts - oldest })
+        return m
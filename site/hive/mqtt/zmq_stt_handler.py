@@ -5,8 +5,8 @@ import numpy as np
 import io
 import time
 import logging
-import concurrent.futures
-from .ai_factory import create_openai
+from .ai_factory import get_gateway
+from .device_dispatcher import DeviceDispatcher
 
 LOG_WAV=False
 OPENAI_MODEL='whisper-1'
@@ -55,10 +55,9 @@ class STTSession:
         resp.timestamp = now_ms()
 
         try:
-            client = create_openai()
-            transcript = client.audio.transcriptions.create(
+            transcript = get_gateway().transcribe(
+                OPENAI_MODEL,
                 file=('test.wav', wav_bytes),
-                model=OPENAI_MODEL,
                 response_format="verbose_json",
                 timestamp_granularities=["word"])
             resp.speech = transcript.text
@@ -92,7 +91,7 @@ class STTHandler(ZMQHandler):
     def __init__(self, server):
         super().__init__(server)
         self._sessions = {}
-        self._worker_queue = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        self._worker_queue = DeviceDispatcher('stt', max_workers=5)
 
     def handle_zmq(self, device_id, protoname, protodata):
         req = zmqSTTRequest()
@@ -107,4 +106,10 @@ class STTHandler(ZMQHandler):
             logger.info(f'Session reached END OF SPEECH')
             # session is done, do the work
             sess = self._sessions.pop(sesskey)
-            self._worker_queue.submit(sess.perform)
+            self._worker_queue.submit(device_id, sess.perform)
+
+    def worker_metrics(self):
+        return self._worker_queue.metrics()
+
+    def forget_device(self, device_id):
+        self._worker_queue.forget(device_id)
@@ -1,3 +1,744 @@
-from django.test import TestCase
+from pathlib import Path
+import queue
+import random
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+from django.db import DatabaseError
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase
+from .automarkup import StreamingMarkup, initialize_rules, process
+from .models import CompletionSummary, MentorBehavior, MoxieDevice, MoxieSchedule, PersistentData, SinglePromptChat
+from .mqtt.ai_factory import LLMGateway, _StreamReader
+from .mqtt.chat_history import ChatHistory, messages_tokens
+from .mqtt.completions import add_completions_atomic, count_completions, load_completions, rebuild_completions_atomic
+from .mqtt.conversations import ChatPrototype, ChatSession
+from .mqtt.device_dispatcher import DeviceDispatcher
+from .mqtt.moxie_remote_chat import RemoteChat
+from .mqtt.moxie_server import query_bound
+from .mqtt.prompt_template import PromptTemplate
+from .mqtt.robot_data import RobotData
+from .mqtt.scheduler import ransac_select, schedule_score, spread_select
+from .mqtt.session_store import SQLiteSessionBackend, SessionStore, compress_state, state_to_json
+from .mqtt.util import run_db_atomic
+from .mqtt.write_behind import MentorBehaviorWriteBehind, StateWriteBehind, _MBH_MAX_ATTEMPTS
 
-# Create your tests here.
+# Wait for a condition set by another thread, False if it doesn't happen in time
+def wait_for(check, timeout=5.0):
+    until = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > until:
+            return False
+        time.sleep(0.01)
+    return True
+
+def make_modules(counts):
+    return [ { 'module_id': f'{cat}{i}', 'category': cat } for cat, n in counts.items() for i in range(n) ]
+
+
+class DeviceDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.dispatcher = DeviceDispatcher('test', max_workers=4)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def test_work_for_a_device_runs_in_order(self):
+        lock = threading.Lock()
+        ran = { d: [] for d in ('a', 'b', 'c') }
+        def work(device_id, i):
+            # uneven durations, so a device running out of order would show
+            time.sleep(random.random() / 500)
+            with lock:
+                ran[device_id].append(i)
+        for i in range(50):
+            for device_id in ran:
+                self.dispatcher.submit(device_id, work, device_id, i)
+        self.assertTrue(wait_for(lambda: all(len(r) == 50 for r in ran.values())))
+        for device_id, order in ran.items():
+            self.assertEqual(order, list(range(50)), device_id)
+
+    def test_one_item_per_device_at_a_time(self):
+        lock = threading.Lock()
+        running = {}
+        overlaps = []
+        done = []
+        def work(device_id):
+            with lock:
+                running[device_id] = running.get(device_id, 0) + 1
+                if running[device_id] > 1:
+                    overlaps.append(device_id)
+            time.sleep(0.002)
+            with lock:
+                running[device_id] -= 1
+                done.append(device_id)
+        for i in range(20):
+            self.dispatcher.submit('a', work, 'a')
+            self.dispatcher.submit('b', work, 'b')
+        self.assertTrue(wait_for(lambda: len(done) == 40))
+        self.assertEqual(overlaps, [])
+
+    def test_slow_device_does_not_block_others(self):
+        release = threading.Event()
+        ran = threading.Event()
+        self.dispatcher.submit('slow', release.wait, 5)
+        self.dispatcher.submit('slow', lambda: None)
+        self.dispatcher.submit('fast', ran.set)
+        self.assertTrue(ran.wait(1))
+        release.set()
+
+    def test_forget_drops_stats(self):
+        ran = threading.Event()
+        self.dispatcher.submit('a', ran.set)
+        self.assertTrue(ran.wait(1))
+        self.assertTrue(wait_for(lambda: 'a' in self.dispatcher.metrics()['devices']))
+        self.dispatcher.forget('a')
+        self.assertNotIn('a', self.dispatcher.metrics()['devices'])
+
+
+class StateWriteBehindTests(TestCase):
+    def setUp(self):
+        self.device = MoxieDevice.objects.create(device_id='d_state', state={ 'battery_level': 50 })
+        # flushed by the tests, never by the background thread
+        self.writer = StateWriteBehind(flush_interval=3600, flush_threshold=10000)
+
+    def tearDown(self):
+        # write anything left here, the flush thread can't see the test transaction
+        self.writer.flush()
+        self.writer.shutdown()
+
+    def test_latest_state_wins(self):
+        self.writer.put('d_state', { 'battery_level': 60 })
+        self.writer.put('d_state', { 'battery_level': 70 })
+        self.assertEqual(self.writer.pending_count(), 1)
+        self.writer.flush()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.state, { 'battery_level': 70 })
+        self.assertEqual(self.writer.metrics()['written'], 1)
+
+    def test_unchanged_state_is_skipped(self):
+        self.writer.put('d_state', { 'battery_level': 60 })
+        self.writer.flush()
+        self.writer.put('d_state', { 'battery_level': 60 })
+        self.assertEqual(self.writer.pending_count(), 0)
+        self.assertEqual(self.writer.metrics()['skipped'], 1)
+
+    def test_missing_battery_level_is_kept(self):
+        self.writer.put('d_state', { 'volume': 3 })
+        self.writer.flush()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.state, { 'volume': 3, 'battery_level': 50 })
+
+    def test_flush_one_device(self):
+        MoxieDevice.objects.create(device_id='d_other')
+        self.writer.put('d_state', { 'battery_level': 60 })
+        self.writer.put('d_other', { 'battery_level': 10 })
+        self.writer.flush('d_state')
+        self.assertEqual(self.writer.pending_count(), 1)
+        self.assertIsNone(MoxieDevice.objects.get(device_id='d_other').state)
+
+    def test_unknown_device_not_marked_written(self):
+        self.writer.put('d_missing', { 'battery_level': 60 })
+        self.writer.flush()
+        self.assertEqual(self.writer.metrics()['written'], 0)
+        # once the device exists the same state is written, not skipped as unchanged
+        MoxieDevice.objects.create(device_id='d_missing')
+        self.writer.put('d_missing', { 'battery_level': 60 })
+        self.writer.flush()
+        self.assertEqual(MoxieDevice.objects.get(device_id='d_missing').state, { 'battery_level': 60 })
+
+    def test_failed_flush_is_retried(self):
+        self.writer.put('d_state', { 'battery_level': 60 })
+        with mock.patch.object(self.writer, 'write_atomic', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                self.writer.flush()
+        self.assertEqual(self.writer.pending_count(), 1)
+        self.writer.flush()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.state, { 'battery_level': 60 })
+
+
+class DeviceLoadTests(TestCase):
+    def setUp(self):
+        self.robot_data = RobotData()
+
+    def tearDown(self):
+        self.robot_data.shutdown()
+
+    def test_load_creates_missing_devices(self):
+        MoxieDevice.objects.create(device_id='d_old')
+        self.robot_data.init_from_db_bulk([ 'd_old', 'd_new' ])
+        self.assertEqual(sorted(self.robot_data.connected_list()), [ 'd_new', 'd_old' ])
+        self.assertEqual(PersistentData.objects.count(), 2)
+
+    def test_load_survives_device_created_elsewhere(self):
+        real_filter = MoxieSchedule.objects.filter
+        def create_then_filter(*args, **kwargs):
+            # another process creates the device after we found it missing
+            MoxieDevice.objects.get_or_create(device_id='d_race')
+            return real_filter(*args, **kwargs)
+        with mock.patch.object(MoxieSchedule.objects, 'filter', side_effect=create_then_filter):
+            self.robot_data.init_from_db_bulk([ 'd_race' ])
+        first = MoxieDevice.objects.filter(device_id='d_race').order_by('pk').first()
+        self.assertTrue(self.robot_data.device_online('d_race'))
+        self.assertEqual(PersistentData.objects.get().device, first)
+
+    def test_release_keeps_config_cache(self):
+        self.robot_data.init_from_db_bulk([ 'd_rel' ])
+        self.robot_data._robot_map['d_rel']['persistent_data'].data['visits'] = 3
+        version = self.robot_data._device_versions.get('d_rel')
+        self.robot_data.release_to_db('d_rel')
+        self.assertEqual(self.robot_data._device_versions.get('d_rel'), version)
+        self.assertIsNotNone(MoxieDevice.objects.get(device_id='d_rel').last_disconnect)
+        self.assertEqual(PersistentData.objects.get(device__device_id='d_rel').data, { 'visits': 3 })
+
+
+class QueryBoundTests(SimpleTestCase):
+    def test_accepts_non_negative_ints(self):
+        self.assertEqual(query_bound(0), 0)
+        self.assertEqual(query_bound(25), 25)
+
+    def test_ignores_anything_else(self):
+        for value in [ None, -1, 2.5, '10', True, [ 1 ], { 'a': 1 } ]:
+            self.assertIsNone(query_bound(value))
+
+class AddMentorBehaviorTests(TestCase):
+    def setUp(self):
+        MoxieDevice.objects.create(device_id='d_add')
+        self.robot_data = RobotData()
+        self.robot_data._robot_map['d_add'] = { 'mbh': [], 'completions': {} }
+
+    def tearDown(self):
+        self.robot_data.flush_mbh('d_add')
+        self.robot_data.shutdown()
+
+    def mbh(self, timestamp):
+        return { 'module_id': 'AB', 'content_id': 'c', 'action': 'COMPLETED', 'instance_id': 1, 'timestamp': timestamp }
+
+    def test_cache_kept_newest_first(self):
+        for ts in [ 10, 30, 20 ]:
+            self.robot_data.add_mbh('d_add', self.mbh(ts))
+        self.assertEqual([ m['timestamp'] for m in self.robot_data.get_mbh('d_add') ], [ 30, 20, 10 ])
+        self.assertEqual([ m['timestamp'] for m in self.robot_data.get_mbh('d_add', limit=1, since=10) ], [ 30 ])
+
+    def test_bad_timestamp_ignored(self):
+        self.robot_data.add_mbh('d_add', self.mbh(10))
+        self.robot_data.add_mbh('d_add', self.mbh(None))
+        self.robot_data.add_mbh('d_add', self.mbh('soon'))
+        self.assertEqual(len(self.robot_data.get_mbh('d_add')), 1)
+        self.assertEqual(self.robot_data._robot_map['d_add']['completions'], { 'AB': 1 })
+        self.assertEqual(MentorBehavior.objects.count(), 1)
+
+
+class CompletionSummaryTests(TestCase):
+    def setUp(self):
+        self.device = MoxieDevice.objects.create(device_id='d_done')
+
+    def behavior(self, module_id, action='COMPLETED', device=None):
+        return MentorBehavior(device=device or self.device, module_id=module_id, action=action, timestamp=1, instance_id=1)
+
+    def test_count_only_completed(self):
+        recs = [ self.behavior('AB'), self.behavior('AB'), self.behavior('AB', action='QUIT'), self.behavior(None) ]
+        self.assertEqual(count_completions(recs), { self.device.pk: { 'AB': 2, '': 1 } })
+
+    def test_add_creates_then_increments(self):
+        run_db_atomic(add_completions_atomic, { self.device.pk: { 'AB': 1 } })
+        run_db_atomic(add_completions_atomic, { self.device.pk: { 'AB': 2, 'CD': 1 } })
+        self.assertEqual(load_completions([ self.device.pk ]), { self.device.pk: { 'AB': 3, 'CD': 1 } })
+
+    def test_rebuild_matches_behaviors(self):
+        other = MoxieDevice.objects.create(device_id='d_none')
+        MentorBehavior.objects.bulk_create([ self.behavior('AB'), self.behavior('AB'), self.behavior('CD', action='QUIT') ])
+        run_db_atomic(add_completions_atomic, { self.device.pk: { 'AB': 10 }, other.pk: { 'AB': 1 } })
+        self.assertEqual(run_db_atomic(rebuild_completions_atomic, [ self.device.pk, other.pk ]), 2)
+        self.assertEqual(load_completions([ self.device.pk, other.pk ]), { self.device.pk: { 'AB': 2 }, other.pk: {} })
+
+    def test_load_without_summary(self):
+        self.assertEqual(load_completions([ self.device.pk ]), { self.device.pk: {} })
+
+
+class SpreadSelectTests(SimpleTestCase):
+    def test_never_scores_worse_than_ransac(self):
+        for seed in range(50):
+            rng = random.Random(seed)
+            modules = make_modules({ 'Story': rng.randint(1, 6), 'Game': rng.randint(1, 6), 'Mission': rng.randint(1, 4), 'User': rng.randint(0, 3) })
+            count = rng.randint(1, len(modules))
+            random.seed(seed)
+            ransac = ransac_select(modules, count)
+            spread = spread_select(modules, count, rng=random.Random(seed))
+            self.assertEqual(len(spread), len(ransac))
+            self.assertLessEqual(schedule_score(spread), schedule_score(ransac), f'seed {seed}')
+
+    def test_no_adjacent_categories_when_avoidable(self):
+        modules = make_modules({ 'Story': 3, 'Game': 3, 'Mission': 2 })
+        for seed in range(20):
+            picked = spread_select(modules, 6, rng=random.Random(seed))
+            cats = [ m['category'] for m in picked ]
+            self.assertTrue(all(a != b for a, b in zip(cats, cats[1:])), cats)
+            self.assertEqual(len({ m['module_id'] for m in picked }), 6)
+
+    def test_count_larger_than_modules(self):
+        modules = make_modules({ 'Story': 2, 'Game': 1 })
+        self.assertEqual(len(spread_select(modules, 10, rng=random.Random(1))), 3)
+
+    def test_same_seed_same_schedule(self):
+        modules = make_modules({ 'Story': 4, 'Game': 4, 'Mission': 4 })
+        self.assertEqual(spread_select(modules, 5, rng=random.Random(7)), spread_select(modules, 5, rng=random.Random(7)))
+
+
+class ScheduleCacheTests(TestCase):
+    def setUp(self):
+        self.robot_data = RobotData()
+        self.robot_data._robot_map['d_sched'] = { 'schedule': { 'name': 'test' }, 'schedule_pk': 7, 'completions': {} }
+        patcher = mock.patch('hive.mqtt.robot_data.expand_schedule', side_effect=lambda s, robot_id, completions: dict(s))
+        self.expand = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.robot_data.shutdown()
+
+    def test_reused_while_key_unchanged(self):
+        first = self.robot_data.get_schedule_payload('d_sched')
+        self.assertIs(self.robot_data.get_schedule_payload('d_sched'), first)
+        self.assertEqual(self.expand.call_count, 1)
+
+    def test_schedule_change_expands_again(self):
+        self.robot_data.get_schedule('d_sched')
+        self.robot_data.apply_schedule(7, { 'name': 'changed' })
+        self.assertEqual(self.robot_data.get_schedule('d_sched'), { 'name': 'changed' })
+        self.assertEqual(self.expand.call_count, 2)
+
+    def test_other_schedule_change_ignored(self):
+        self.robot_data.get_schedule('d_sched')
+        self.robot_data.apply_schedule(8, { 'name': 'other' })
+        self.robot_data.get_schedule('d_sched')
+        self.assertEqual(self.expand.call_count, 1)
+
+    def test_ftue_progress_expands_again(self):
+        self.robot_data.get_schedule('d_sched')
+        # any completion ends the welcome content
+        self.robot_data._robot_map['d_sched']['completions']['AB'] = 1
+        self.robot_data.get_schedule('d_sched')
+        self.assertEqual(self.expand.call_count, 2)
+
+    def test_cache_window_expires(self):
+        self.robot_data._schedule_cache_seconds = 0
+        self.robot_data.get_schedule('d_sched')
+        self.robot_data.get_schedule('d_sched')
+        self.assertEqual(self.expand.call_count, 2)
+
+    def test_offline_device_not_cached(self):
+        self.robot_data.get_schedule('d_offline')
+        self.robot_data.get_schedule('d_offline')
+        self.assertEqual(self.expand.call_count, 2)
+
+
+class StreamingMarkupTests(SimpleTestCase):
+    TEXTS = [
+        'Hello there!',
+        'I love talking about space. Did you know the moon has no air? What do you think about that?',
+        'Wow, that is great! Tell me more. I am so happy to hear it... Really, I am.',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.rules = initialize_rules()
+
+    def test_finish_matches_process(self):
+        for seed in range(3):
+            for text in self.TEXTS:
+                random.seed(seed)
+                expected = process(text, self.rules)
+                random.seed(seed)
+                stream = StreamingMarkup(self.rules)
+                # fed a few characters at a time, like a streamed inference
+                for end in range(5, len(text), 5):
+                    stream.feed(text[:end])
+                self.assertEqual(stream.finish(text), expected, text)
+
+    def test_finish_without_feed(self):
+        text = self.TEXTS[1]
+        random.seed(1)
+        expected = process(text, self.rules)
+        random.seed(1)
+        self.assertEqual(StreamingMarkup(self.rules).finish(text), expected)
+
+
+class FakeStream:
+    def __init__(self, pieces, gate):
+        self.pieces = pieces
+        self.gate = gate
+        self.closed = False
+
+    def __iter__(self):
+        for i, piece in enumerate(self.pieces):
+            if i:
+                self.gate.wait(5)
+            yield SimpleNamespace(choices=[ SimpleNamespace(delta=SimpleNamespace(content=piece)) ])
+
+    def close(self):
+        self.closed = True
+
+class GatewayLifetimeTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = LLMGateway('test-key', max_concurrent=1)
+        self.gateway._client = mock.Mock()
+
+    def test_close_when_idle(self):
+        self.gateway.close()
+        self.gateway._client.close.assert_called_once()
+
+    def test_close_waits_for_running_call(self):
+        started = threading.Event()
+        release = threading.Event()
+        def fn(client, timeout):
+            started.set()
+            release.wait(5)
+            return 'done'
+        t = threading.Thread(target=self.gateway.call, args=('chat', 'm', fn))
+        t.start()
+        self.assertTrue(started.wait(5))
+        self.gateway.close()
+        self.gateway._client.close.assert_not_called()
+        release.set()
+        t.join(5)
+        self.gateway._client.close.assert_called_once()
+
+    def test_stream_holds_slot_until_drained(self):
+        gate = threading.Event()
+        stream = FakeStream([ 'a', 'b' ], gate)
+        out = queue.Queue()
+        _StreamReader(self.gateway, 'm', lambda client, t: stream, time.monotonic() + 5, out)
+        self.assertEqual(out.get(timeout=5)[1], 'a')
+        self.assertFalse(self.gateway._slots.acquire(blocking=False))
+        self.gateway.close()
+        self.gateway._client.close.assert_not_called()
+        gate.set()
+        self.assertEqual(out.get(timeout=5)[1], 'b')
+        self.assertTrue(wait_for(lambda: self.gateway._client.close.called))
+        self.assertTrue(stream.closed)
+        self.assertTrue(self.gateway._slots.acquire(blocking=False))
+
+    def test_cancelled_stream_releases_slot(self):
+        gate = threading.Event()
+        out = queue.Queue()
+        reader = _StreamReader(self.gateway, 'm', lambda client, t: FakeStream([ 'a', 'b' ], gate), time.monotonic() + 5, out)
+        out.get(timeout=5)
+        reader.cancel()
+        gate.set()
+        self.assertTrue(wait_for(lambda: self.gateway._slots.acquire(blocking=False)))
+
+
+class ChatHistoryTests(SimpleTestCase):
+    def test_trims_to_message_count(self):
+        history = ChatHistory(max_messages=4, token_budget=10000)
+        for i in range(10):
+            history.add('user' if i % 2 == 0 else 'assistant', f'message {i}')
+        self.assertEqual([ m['content'] for m in history.messages() ], [ f'message {i}' for i in range(6, 10) ])
+
+    def test_trims_to_token_budget(self):
+        history = ChatHistory(max_messages=100, token_budget=100)
+        for i in range(10):
+            history.add('user' if i % 2 == 0 else 'assistant', 'x' * 100)
+        self.assertLessEqual(history.tokens, 100)
+        self.assertEqual(history.tokens, messages_tokens(history.messages()))
+
+    def test_keeps_newest_message_over_budget(self):
+        history = ChatHistory(max_messages=10, token_budget=10)
+        history.add('user', 'x' * 400)
+        self.assertEqual(len(history), 1)
+
+    def test_same_role_appends(self):
+        history = ChatHistory()
+        history.add('user', 'hello')
+        history.add('user', 'there')
+        self.assertEqual(history.messages(), [ { 'role': 'user', 'content': 'hello there' } ])
+
+    def test_rolled_messages_kept_until_summarized(self):
+        release = threading.Event()
+        def summarizer(previous, msgs):
+            release.wait(5)
+            return f'{len(msgs)} messages'
+        history = ChatHistory(max_messages=2, token_budget=10000, summarizer=summarizer)
+        for i in range(6):
+            history.add('user' if i % 2 == 0 else 'assistant', f'{i} ' + 'x' * 400)
+        # summary still running, nothing is lost meanwhile
+        self.assertEqual(len(history.messages()), 6)
+        release.set()
+        self.assertTrue(wait_for(lambda: history.summary is not None))
+        msgs = history.messages()
+        self.assertEqual(msgs[0]['role'], 'system')
+        self.assertIn(history.summary, msgs[0]['content'])
+        self.assertEqual(msgs[-1]['content'][0], '5')
+
+
+class ChatHistoryOverlayTests(SimpleTestCase):
+    def test_pending_overlay_matches_add(self):
+        for pending in (('user', 'new'), ('assistant', 'more')):
+            history = ChatHistory(max_messages=3, token_budget=10000)
+            for i in range(3):
+                history.add('user' if i % 2 == 0 else 'assistant', f'message {i}')
+            before = history.messages()
+            overlaid = history.messages(pending=pending)
+            self.assertEqual(history.messages(), before)
+            history.add(*pending)
+            self.assertEqual(overlaid, history.messages())
+
+    def test_entries_are_never_changed(self):
+        history = ChatHistory()
+        history.add('user', 'hello')
+        first = history.messages()[0]
+        history.messages(pending=('user', 'there'))
+        history.add('user', 'there')
+        self.assertEqual(first, { 'role': 'user', 'content': 'hello' })
+
+
+class ChatPrototypeCodeTests(SimpleTestCase):
+    def make_source(self, code):
+        return SinglePromptChat(name='test', prompt='You are Moxie.', opener='Hi', code=code)
+
+    def test_code_can_use_documented_names(self):
+        code = ("def helper(text):\n"
+                "    return Template('{{ t }}!').render(Context({ 't': copy.copy(text) }))\n"
+                "def post_process(volley, session):\n"
+                "    return helper(volley) if create_openai else None\n")
+        proto = ChatPrototype(self.make_source(code))
+        self.assertEqual(proto.filters['post_filter']('hi', None), 'hi!')
+
+    def test_bad_code_logs_and_has_no_filters(self):
+        with self.assertLogs('hive.mqtt.conversations', level='ERROR') as logs:
+            proto = ChatPrototype(self.make_source('def pre_process(:'))
+        self.assertEqual(proto.filters, {})
+        self.assertIn('Traceback', logs.output[0])
+
+
+class PromptTemplateTests(SimpleTestCase):
+    VALUES = { 'robot': { 'name': 'Moxie', 'age': 3 }, 'child': 'Sam', 'topics': [ 'space', 'dogs' ], 'unused': 'x' }
+    SOURCES = [
+        'You are a friendly robot.',
+        'Talk to {{ child }} about anything.',
+        'You are {{ robot.name }}, {{ robot.age }} years old.',
+        '{% if child %}Greet {{ child|upper }}.{% else %}Greet the user.{% endif %}',
+        'Topics: {% for t in topics %}{{ t }}{% if not forloop.last %}, {% endif %}{% endfor %}',
+        '{# note #}Missing {{ nobody }} is blank.',
+    ]
+
+    def test_render_matches_template(self):
+        for source in self.SOURCES:
+            expected = Template(source).render(Context(self.VALUES))
+            self.assertEqual(PromptTemplate(source).render(**self.VALUES), expected, source)
+
+    def test_static_detection(self):
+        self.assertTrue(PromptTemplate('Plain text, with {braces} and % signs.').static)
+        for source in self.SOURCES[1:]:
+            self.assertFalse(PromptTemplate(source).static, source)
+
+    def test_static_context_is_shared(self):
+        prompt = PromptTemplate('You are a friendly robot.')
+        self.assertIs(prompt.system_context(), prompt.system_context(child='Sam'))
+        self.assertEqual(prompt.system_context(), [ { 'role': 'system', 'content': 'You are a friendly robot.' } ])
+
+
+class SessionStoreEvictionTests(SimpleTestCase):
+    def setUp(self):
+        self.evicted = []
+
+    def make_store(self, **kwargs):
+        return SessionStore(on_evict=lambda key, id, session: self.evicted.append((key, id)), **kwargs)
+
+    def test_count_limit_evicts_least_recently_used(self):
+        store = self.make_store(max_entries=2)
+        store.put('a', 'm/a', ChatSession())
+        store.put('b', 'm/b', ChatSession())
+        store.get('a')
+        store.put('c', 'm/c', ChatSession())
+        self.assertEqual(self.evicted, [ ('b', 'm/b') ])
+        self.assertIn('a', store)
+        self.assertEqual(store.metrics()['evictions']['entries'], 1)
+
+    def test_memory_limit_keeps_newest(self):
+        store = self.make_store(max_bytes=1)
+        store.put('a', 'm/a', ChatSession())
+        store.put('b', 'm/b', ChatSession())
+        self.assertEqual(self.evicted, [ ('a', 'm/a') ])
+        self.assertIn('b', store)
+        self.assertEqual(store.metrics()['evictions']['memory'], 1)
+
+    def test_idle_sweep(self):
+        store = self.make_store(idle_ttl=10)
+        store.put('a', 'm/a', ChatSession())
+        store.put('b', 'm/b', ChatSession())
+        store.peek('a').last_used -= 20
+        store.sweep()
+        self.assertEqual(self.evicted, [ ('a', 'm/a') ])
+        self.assertEqual(store.metrics()['sessions'], 1)
+
+    def test_pop_is_not_an_eviction(self):
+        store = self.make_store()
+        store.put('a', 'm/a', ChatSession())
+        self.assertEqual(store.pop('a').id, 'm/a')
+        self.assertEqual(self.evicted, [])
+        self.assertIsNone(store.get('a'))
+
+class CompleteHookTests(SimpleTestCase):
+    def setUp(self):
+        self.server = mock.Mock()
+        self.server.robot_data.return_value.get_volley_data.return_value = { 'persist': { 'visits': 1 } }
+        self.chat = RemoteChat(self.server)
+        self.session = mock.Mock(local_data={})
+
+    def tearDown(self):
+        self.chat.shutdown()
+
+    def test_hook_runs_for_loaded_device(self):
+        self.server.robot_data.return_value.device_online.return_value = True
+        self.chat.run_complete_hook('d_hook', 'm/c', self.session)
+        volley = self.session.complete_hook.call_args.args[0]
+        self.assertEqual(volley.persist_data, { 'visits': 1 })
+
+    def test_hook_skipped_for_device_not_loaded(self):
+        self.server.robot_data.return_value.device_online.return_value = False
+        self.chat.run_complete_hook('d_hook', 'm/c', self.session)
+        self.session.complete_hook.assert_not_called()
+
+
+class ChatHistoryStateTests(SimpleTestCase):
+    def test_state_round_trip(self):
+        history = ChatHistory()
+        history.add('user', 'hello')
+        history.add('assistant', 'hi')
+        copy = ChatHistory()
+        copy.set_state(history.get_state())
+        self.assertEqual(copy.messages(), history.messages())
+        self.assertEqual(copy.tokens, history.tokens)
+
+class SQLiteSessionStoreTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / 'sessions.sqlite3'
+        self.evicted = []
+
+    def make_store(self, **kwargs):
+        store = SessionStore(on_evict=lambda key, id, session: self.evicted.append(key), backend=SQLiteSessionBackend(self.path),
+                             restore=lambda id: ChatSession(), **kwargs)
+        self.addCleanup(store.shutdown)
+        return store
+
+    def make_session(self):
+        session = ChatSession()
+        session.add_history('user', 'hello')
+        session.add_history('assistant', 'hi there')
+        session.local_data['step'] = 2
+        return session
+
+    def test_backend_write_load_delete(self):
+        backend = SQLiteSessionBackend(self.path)
+        backend.write({ 'a': ('m/a', compress_state(state_to_json({ 'x': 1 }))) })
+        self.assertEqual(backend.load('a'), ('m/a', { 'x': 1 }))
+        backend.write({ 'a': None })
+        self.assertIsNone(backend.load('a'))
+
+    def test_backend_prune(self):
+        backend = SQLiteSessionBackend(self.path)
+        backend.write({ 'a': ('m/a', compress_state('{}')) })
+        self.assertEqual(backend.prune(3600), 0)
+        self.assertEqual(backend.prune(-1), 1)
+
+    def test_restart_round_trip(self):
+        session = self.make_session()
+        store = self.make_store()
+        store.put('d_1', 'm/a', session)
+        store.shutdown()
+        entry = self.make_store().get('d_1')
+        self.assertEqual(entry.id, 'm/a')
+        self.assertEqual(entry.session.get_state(), session.get_state())
+
+    def test_count_eviction_only_saves(self):
+        store = self.make_store(max_entries=1)
+        session = self.make_session()
+        store.put('d_1', 'm/a', session)
+        store.put('d_2', 'm/b', ChatSession())
+        self.assertEqual(self.evicted, [])
+        self.assertNotIn('d_1', store)
+        # still waiting to be written, the pending copy is used
+        self.assertEqual(store.get('d_1').session.get_state(), session.get_state())
+        self.assertEqual(store.metrics()['loads'], 1)
+
+    def test_idle_eviction_completes_and_deletes(self):
+        store = self.make_store()
+        store.put('d_1', 'm/a', self.make_session())
+        store.peek('d_1').last_used -= 7200
+        store.sweep()
+        self.assertEqual(self.evicted, [ 'd_1' ])
+        self.assertIsNone(store.get('d_1'))
+        store.shutdown()
+        self.assertIsNone(SQLiteSessionBackend(self.path).load('d_1'))
+
+
+class MentorBehaviorWriteBehindTests(TestCase):
+    def setUp(self):
+        self.device = MoxieDevice.objects.create(device_id='d_mbh')
+        # flushed by the tests, never by the background thread
+        self.writer = MentorBehaviorWriteBehind(flush_interval=3600, flush_threshold=10000)
+
+    def tearDown(self):
+        # write anything left here, the flush thread can't see the test transaction
+        self.writer.flush()
+        self.writer.shutdown()
+
+    def make_mbh(self, **fields):
+        rec = MentorBehavior()
+        rec.__dict__.update({ 'module_id': 'AB', 'content_id': 'c', 'timestamp': 1000, 'action': 'COMPLETED', 'instance_id': 1, **fields })
+        return rec
+
+    def test_flush_writes_batch_and_completions(self):
+        self.writer.set_device_pk('d_mbh', self.device.pk)
+        for i in range(3):
+            self.writer.put('d_mbh', self.make_mbh(timestamp=1000 + i))
+        self.writer.flush()
+        self.assertEqual(MentorBehavior.objects.filter(device=self.device).count(), 3)
+        self.assertEqual(CompletionSummary.objects.get(device=self.device).counts, { 'AB': 3 })
+        self.assertEqual(self.writer.pending_count(), 0)
+
+    def test_unknown_device_is_looked_up(self):
+        self.writer.put('d_mbh', self.make_mbh())
+        self.writer.flush()
+        self.assertEqual(MentorBehavior.objects.filter(device=self.device).count(), 1)
+
+    def test_bad_record_only_drops_itself(self):
+        self.writer.set_device_pk('d_mbh', self.device.pk)
+        self.writer.put('d_mbh', self.make_mbh(timestamp=1000))
+        self.writer.put('d_mbh', self.make_mbh(timestamp=None))
+        self.writer.put('d_mbh', self.make_mbh(timestamp=1002))
+        self.writer.flush()
+        self.assertEqual(sorted(MentorBehavior.objects.values_list('timestamp', flat=True)), [ 1000, 1002 ])
+        self.assertEqual(CompletionSummary.objects.get(device=self.device).counts, { 'AB': 2 })
+        self.assertEqual(self.writer.metrics()['dropped'], 1)
+        self.assertEqual(self.writer.pending_count(), 0)
+
+    def test_failed_flush_retries_then_drops(self):
+        self.writer.set_device_pk('d_mbh', self.device.pk)
+        self.writer.put('d_mbh', self.make_mbh())
+        with mock.patch.object(self.writer, 'write_atomic', side_effect=DatabaseError('down')):
+            for i in range(_MBH_MAX_ATTEMPTS - 1):
+                with self.assertRaises(DatabaseError):
+                    self.writer.flush()
+                self.assertEqual(self.writer.pending_count(), 1)
+            with self.assertRaises(DatabaseError):
+                self.writer.flush()
+        self.assertEqual(self.writer.pending_count(), 0)
+        self.assertEqual(self.writer.metrics()['dropped'], 1)
+
+    def test_retry_keeps_order(self):
+        self.writer.set_device_pk('d_mbh', self.device.pk)
+        self.writer.put('d_mbh', self.make_mbh(timestamp=1))
+        with mock.patch.object(self.writer, 'write_atomic', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                self.writer.flush()
+        self.writer.put('d_mbh', self.make_mbh(timestamp=2))
+        self.writer.flush()
+        self.assertEqual(list(MentorBehavior.objects.order_by('id').values_list('timestamp', flat=True)), [ 1, 2 ])
@@ -5,7 +5,7 @@ from django.contrib.auth import get_user_model
 from django.views import generic
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponse,HttpResponseRedirect
 from django.conf import settings
@@ -17,9 +17,14 @@ from .models import GlobalResponse, SinglePromptChat, MoxieDevice, MoxieSchedule
 from .content.data import DM_MISSION_CONTENT_IDS, get_moxie_customization_groups
 from .data_import import update_import_status, import_content
 from .mqtt.moxie_server import get_instance
+from .mqtt.completions import rebuild_completions_atomic
+from .mqtt.hive_config import get_hive_config
+from .mqtt.util import run_db_atomic
 from .mqtt.robot_data import DEFAULT_ROBOT_CONFIG, DEFAULT_ROBOT_SETTINGS
 from .mqtt.volley import Volley
 import json
+import queue
+import threading
 import uuid
 import logging
 
@@ -27,8 +32,7 @@ logger = logging.getLogger(__name__)
 
 # ROOT - Show setup if we have no config record, dashboard otherwise
 def root_view(request):
-    cfg = HiveConfiguration.objects.filter(name='default')
-    if cfg:
+    if get_hive_config():
         return HttpResponseRedirect(reverse("hive:dashboard"))
     else:
         return HttpResponseRedirect(reverse("hive:setup"))
@@ -41,7 +45,7 @@ class SetupView(generic.TemplateView):
         context = super().get_context_data(**kwargs)
         User = get_user_model()
         context['needs_admin'] = not User.objects.filter(is_superuser=True).exists()
-        curr_cfg = HiveConfiguration.objects.filter(name='default').first()
+        curr_cfg = get_hive_config()
         if curr_cfg:
             context['object'] = curr_cfg
         return context
@@ -94,7 +98,7 @@ class DashboardView(generic.TemplateView):
         context['recent_devices'] = MoxieDevice.objects.all()
         context['conversations'] = SinglePromptChat.objects.all()
         context['schedules'] = MoxieSchedule.objects.all()
-        context['live'] = get_instance().robot_data().connected_list()
+        context['live'] = get_instance().connected_list()
         return context
 
 # INTERACT - Chat with a remote conversation
@@ -107,7 +111,21 @@ class InteractionView(generic.DetailView):
         context['token'] = uuid.uuid4().hex
         return context
 
-# INTERACT-POST - Handle user input during interact
+# Run a volley on a thread, yielding NDJSON lines with the partial text as it streams in, then the result
+def stream_volley(session, volley):
+    lines = queue.Queue()
+    def run():
+        try:
+            session.handle_volley(volley, on_partial=lambda text: lines.put({'partial': text}))
+            get_instance().save_web_session(volley.device_id)
+        finally:
+            lines.put(None)
+    threading.Thread(target=run, daemon=True).start()
+    while (line := lines.get()) is not None:
+        yield json.dumps(line) + '\n'
+    yield json.dumps({'message': volley.debug_response_string(), 'details': volley.response}) + '\n'
+
+# INTERACT-POST - Handle user input during interact, with 'stream' set the response is NDJSON with partial text
 @require_http_methods(["POST"])
 @csrf_exempt
 def interact_update(request):
@@ -119,13 +137,19 @@ def interact_update(request):
     volley = Volley.request_from_speech(speech, device_id=token, module_id=module_id, content_id=content_id, local_data=session.local_data)
     # Check global responses manually
     gresp = get_instance().get_web_session_global_response(volley) if speech else None
+    stream = request.POST.get('stream')
     if gresp:
         line = gresp
         details = {}
+    elif stream:
+        return StreamingHttpResponse(stream_volley(session, volley), content_type='application/x-ndjson')
     else:
         session.handle_volley(volley)
+        get_instance().save_web_session(token)
         line = volley.debug_response_string()
         details = volley.response
+    if stream:
+        return StreamingHttpResponse([ json.dumps({'message': line, 'details': details}) + '\n' ], content_type='application/x-ndjson')
     return JsonResponse({'message': line, 'details': details})
 
 # RELOAD - Reload any records initialized from the database
@@ -249,9 +273,10 @@ def puppet_api(request, pk):
         device = MoxieDevice.objects.get(pk=pk)
         if request.method == 'GET':
             # Handle GET request
+            state = get_instance().get_device_state(device.device_id)
             result = { 
-                "online": get_instance().robot_data().device_online(device.device_id),
-                "puppet_state": get_instance().robot_data().get_puppet_state(device.device_id),
+                "online": state["online"],
+                "puppet_state": state["puppet_state"],
                 "puppet_enabled": device.robot_config.get("moxie_mode") == "TELEHEALTH" if device.robot_config else False
             }
             return JsonResponse(result)
@@ -296,9 +321,13 @@ def mission_edit(request, pk):
         device = MoxieDevice.objects.get(pk=pk)
 
         mission_action = request.POST["mission_action"]
+        # any queued reports need to land before we change the records
+        if not get_instance().flush_mbh(device.device_id):
+            logger.warning(f'Queued reports for {device} may not be written before the edit')
         if mission_action == "reset":
             # Delete all MBH to start fresh
             MentorBehavior.objects.filter(device=device).delete()
+            run_db_atomic(rebuild_completions_atomic, [device.pk])
             msg = f'Reset ALL progress for {device}'
         else:
             # Handle mission set actions... get all the CIDs for the selected sets
@@ -307,11 +336,13 @@ def mission_edit(request, pk):
             if mission_action == "forget":
                 # Delete any records with these module/content ID (completed, quit)
                 MentorBehavior.objects.filter(device=device, module_id='DM', content_id__in=dm_cid_list).delete()
+                run_db_atomic(rebuild_completions_atomic, [device.pk])
                 msg = f'Forgot {len(mission_sets)} Daily Mission Sets ({len(dm_cid_list)} missions) for {device}'
             else: # == "complete"
                 # Create new completions for all these mission content IDs
                 get_instance().robot_data().add_mbh_completion_bulk(device.device_id, module_id="DM", content_id_list=dm_cid_list)
                 msg = f'Completed {len(mission_sets)} Daily Mission Sets ({len(dm_cid_list)} missions) for {device}'
+        get_instance().handle_mbh_updated(device.device_id)
 
         return redirect('hive:dashboard_alert', alert_message=msg)
     except MoxieDevice.DoesNotExist as e:
@@ -102,6 +102,33 @@ MQTT_ENDPOINT = {
     'port': 8883,
     'project': 'openmoxie',
     'cert_required': False,
+    # Number of server processes, devices are partitioned between them by device_id
+    'shards': 1,
+    # MQTT network IO on paho's thread ('thread') or an asyncio event loop ('asyncio')
+    'transport': 'thread',
+}
+
+# How long (seconds) a generated schedule is reused for a device before generating a new one
+SCHEDULE_CACHE_SECONDS = 3600
+
+# Where active chat sessions are kept.  'memory' keeps them in the server process only, 'sqlite'
+# also saves them to a file, so conversations survive a restart and can move between processes.
+CHAT_SESSION_STORE = {
+    'backend': 'memory',
+    # 'backend': 'sqlite',
+    'path': DATA_STORE_DIR / 'chat_sessions.sqlite3',
+}
+
+# Local models for conversations using the LOCAL AI vendor, needs llama-cpp-python.  Conversation
+# model names are GGUF files in model_dir.  Requests arriving within batch_wait_ms are taken
+# together, and identical ones only run once.
+LOCAL_LLM = {
+    'model_dir': DATA_STORE_DIR / 'models',
+    'threads': 4,
+    'context': 2048,
+    'batch_size': 8,
+    'batch_wait_ms': 10,
+    'timeout': 20.0,
 }
 
 BOOTSTRAP5 = {